@@ -0,0 +1,157 @@
+import hashlib
+import random
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash
+from dbapp import db
+from dbapp.models.tables import USERS, STUDIES, FILES, TAGS, VOTES, STUDY_TAG, STUDY_USER, USER_FILE, ulid_new_str
+
+# 研究テーマに使う語(先頭ほど多く出現する)
+TOPICS = [
+    '水質', '植物', '微生物', '土壌', '気温', '光合成', '太陽光', '発電', '音響', '振動',
+    '摩擦', '降水量', '酸性雨', '微粒子', '磁場', '電流', '菌類', '発酵', '昆虫', '鳥類',
+    '海洋', '河川', 'プラスチック', '色素', '結晶', '触媒', '酵素', '遺伝子', '統計', 'アルゴリズム',
+    'ロボット', '画像認識', '気象', '地震', '火山', '天体', '惑星', '化学反応', '溶解度', '浸透圧',
+    'メダカ', 'ミジンコ', '粘菌', '納豆菌', '乳酸菌', '紙飛行機', 'ペットボトルロケット', '風力', '水力', '燃料電池',
+    '蛍光', '偏光', '屈折率', '表面張力', '粘性', '熱伝導', '断熱材', '保冷剤', '電磁誘導', '超音波',
+    '渡り鳥', '外来種', '在来種', '里山', '干潟', '藻類', 'マイクロプラスチック', '放射線', '半導体', 'センサー',
+]
+METHODS = ['測定', '観察', '比較', '分析', '実験', '調査', '検証', '再現', '評価', '考察']
+ASPECTS = ['影響', '変化', '関係', '特性', '分布', '効率', '条件', '要因', '仕組み', '応用']
+RESULTS = ['増加する', '減少する', '変化しない', '比例する', '最大になる', '安定する']
+SENTENCES = [
+    '{a}の{aspect}について{method}した。',
+    '{a}と{b}の{aspect}を{method}した結果、{c}が{result}ことが分かった。',
+    '本研究では{a}に着目し、{b}の{aspect}を{method}した。',
+    '{a}は{b}によって{result}と考えられる。',
+    '表{n}に{a}の{method}結果を示す。',
+    '図{n}より、{a}の{aspect}は約{value}%であった。',
+    '先行研究では{a}の{aspect}は{b}に依存するとされている。',
+    '今後は{a}と{c}を組み合わせた{method}を行いたい。',
+]
+TAG_NAMES = TOPICS[:40] + ['SDGs', '環境', '物理', '化学', '生物', '地学', '情報', '数学', '工学', '防災']
+
+# 末尾の語はZipf分布から外し、一部の研究の本文に1回だけ出現させる
+# (ファイルごとに数百文あるため、分布の末尾の語でもほぼすべての研究に出現してしまう)
+RARE_TOPICS = TOPICS[-10:]
+COMMON_TOPICS = TOPICS[:-10]
+# 希少な語を含む研究の割合
+RARE_RATE = 0.2
+
+def weighted_topics(rng, k):
+    # 出現頻度をZipf分布に近づける
+    weights = [1 / (rank + 1) for rank in range(len(COMMON_TOPICS))]
+    return rng.choices(COMMON_TOPICS, weights=weights, k=k)
+
+def sentence(rng, a=None):
+    topics = weighted_topics(rng, 3)
+    a, b, c = a or topics[0], topics[1], topics[2]
+    return rng.choice(SENTENCES).format(
+        a=a, b=b, c=c,
+        aspect=rng.choice(ASPECTS),
+        method=rng.choice(METHODS),
+        result=rng.choice(RESULTS),
+        n=rng.randint(1, 12),
+        value=rng.randint(1, 99)
+    )
+
+# PDFから抽出したような本文(ページごとの改行を含む)を作る
+def document(rng, chars, page_chars=800):
+    text = []
+    length = 0
+    page = 0
+    while length < chars:
+        line = sentence(rng)
+        text.append(line)
+        length += len(line)
+        if length // page_chars > page:
+            page = length // page_chars
+            text.append(f'\n- {page} -\n')
+    return ''.join(text)
+
+# 架空のユーザー・タグ・研究・ファイル・投票をデータベースに追加する
+def generate(studies=100, files_per_study=3, content_chars=8000, users=50, seed=0, batch=100):
+    rng = random.Random(seed)
+    now = datetime(2024, 3, 31)
+    password = generate_password_hash('benchmark')
+
+    user_rows = [
+        {'id': ulid_new_str(), 'create_at': now, 'name': f'bench{i}', 'password': password, 'display_name': f'生徒{i}'}
+        for i in range(users)
+    ]
+    db.session.execute(USERS.__table__.insert(), user_rows)
+
+    tag_rows = [
+        {'id': ulid_new_str(), 'create_at': now, 'name': name, 'tips': f'{name}に関する研究'}
+        for name in TAG_NAMES
+    ]
+    db.session.execute(TAGS.__table__.insert(), tag_rows)
+
+    for start in range(0, studies, batch):
+        study_rows, file_rows, tag_links, author_links, file_authors, vote_rows = [], [], [], [], [], []
+        for i in range(start, min(start + batch, studies)):
+            a, b = weighted_topics(rng, 2)
+            create_at = now - timedelta(days=rng.randint(0, 5 * 365))
+            study_id = ulid_new_str()
+            summary = ''.join(sentence(rng) for _ in range(rng.randint(2, 6)))
+            authors = rng.sample(user_rows, rng.randint(1, 4))
+
+            study_rows.append({
+                'id': study_id,
+                'create_at': create_at,
+                'update_at': create_at + timedelta(days=rng.randint(0, 180)),
+                'name': f'{a}における{b}の{rng.choice(ASPECTS)}の{rng.choice(METHODS)} その{i}',
+                'summary': f'<p>{summary}</p>',
+                'raw_markdown': summary,
+                'field': rng.randint(1, 4),
+                'grave_data': rng.random() < 0.05,
+            })
+            for tag in rng.sample(tag_rows, rng.randint(0, 4)):
+                tag_links.append({'id': ulid_new_str(), 'create_at': create_at, 'study_id': study_id, 'tag_id': tag['id']})
+            for user in authors:
+                author_links.append({'id': ulid_new_str(), 'create_at': create_at, 'user_id': user['id'], 'study_id': study_id})
+            for user in rng.sample(user_rows, rng.randint(0, 10)):
+                vote_rows.append({'id': ulid_new_str(), 'create_at': create_at, 'user_id': user['id'], 'study_id': study_id, 'helpful': rng.random() < 0.8})
+
+            rare_file = rng.randrange(files_per_study) if rng.random() < RARE_RATE else None
+            total_access = total_preview = 0
+            for j in range(files_per_study):
+                file_id = ulid_new_str()
+                content = document(rng, rng.randint(content_chars // 2, content_chars * 3 // 2))
+                if j == rare_file:
+                    content += sentence(rng, a=rng.choice(RARE_TOPICS))
+                access_count = int(rng.paretovariate(1.5)) - 1
+                preview_count = int(rng.paretovariate(1.2)) - 1
+                grave = rng.random() < 0.03
+                if not grave:
+                    total_access += access_count
+                    total_preview += preview_count
+                file_rows.append({
+                    'id': file_id,
+                    'create_at': create_at + timedelta(days=j),
+                    'hashsum': hashlib.sha256(f'{seed}:{study_id}:{j}'.encode()).hexdigest(),
+                    'name': f'{a}の{rng.choice(METHODS)}_{j}.pdf',
+                    'summary': sentence(rng),
+                    'type': rng.randint(0, 5),
+                    'filename': f'{file_id}.pdf',
+                    'pubyear': create_at.year,
+                    'access_count': access_count,
+                    'preview_count': preview_count,
+                    'content': content,
+                    'grave_data': grave,
+                    'study_id': study_id,
+                })
+                file_authors.append({'id': ulid_new_str(), 'create_at': create_at, 'user_id': authors[0]['id'], 'file_id': file_id})
+            study_rows[-1]['total_access_count'] = total_access
+            study_rows[-1]['total_preview_count'] = total_preview
+
+        db.session.execute(STUDIES.__table__.insert(), study_rows)
+        db.session.execute(FILES.__table__.insert(), file_rows)
+        db.session.execute(STUDY_USER.__table__.insert(), author_links)
+        db.session.execute(USER_FILE.__table__.insert(), file_authors)
+        if tag_links:
+            db.session.execute(STUDY_TAG.__table__.insert(), tag_links)
+        if vote_rows:
+            db.session.execute(VOTES.__table__.insert(), vote_rows)
+        db.session.commit()
+
+    return [tag['id'] for tag in tag_rows]
@@ -0,0 +1,231 @@
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from urllib.parse import urlencode
+from sqlalchemy import event
+from dbapp import app, db, config_watcher
+from dbapp.tools import SearchEngine
+from dbapp.search.index import get_search_index
+from dbapp.models.tables import TAGS
+from benchmarks.corpus import generate, TOPICS, RARE_TOPICS, TAG_NAMES
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# 検索の種類ごとの条件(SearchEngineの引数)
+def query_mix(tag_ids):
+    common = TOPICS[:5]
+    rare = RARE_TOPICS[:5]
+    return {
+        'common': [{'search_terms': word} for word in common],
+        'rare': [{'search_terms': word} for word in rare],
+        'two_words': [{'search_terms': f'{a} {b}'} for a, b in zip(common, TOPICS[5:10])],
+        # N-gramより短い語はインデックスを使えない
+        'short': [{'search_terms': word} for word in ['水', '光', '菌']],
+        'relevance': [{'search_terms': word, 'sort_column': 'relevance', 'ascending': False} for word in common],
+        'filtered': [{'search_terms': word, 'field': 1 + i % 4, 'pubyear': 2020 + i} for i, word in enumerate(common)],
+        'tag': [{'tag': tag_id} for tag_id in tag_ids[:5]],
+        'browse': [{'sort_column': 'access_count', 'ascending': False}, {'sort_column': 'create_at'}],
+        'deep_page': [{'search_terms': word, 'page': 5} for word in common],
+    }
+
+# SearchEngineの引数を/searchのクエリ文字列に変換する
+def route_url(params):
+    args = {
+        'query': params.get('search_terms', ''),
+        'sort_column': params.get('sort_column', 'update_at'),
+        'ascending': str(params.get('ascending', True)),
+        'field': params.get('field', 0),
+    }
+    for key in ['pubyear', 'filetype', 'tag', 'page']:
+        if key in params:
+            args[key] = params[key]
+    return '/search?' + urlencode(args)
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.increment)
+
+    def increment(self, *args):
+        self.count += 1
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+def summarize(timings, statements):
+    return {
+        'samples': len(timings),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'mean_ms': round(statistics.mean(timings), 3),
+        'statements': round(statistics.mean(statements), 2),
+    }
+
+def measure(function, repeat, counter):
+    timings, statements = [], []
+    # 1回目はキャッシュの温まりを除くため集計しない
+    function()
+    db.session.remove()
+    for _ in range(repeat):
+        counter.count = 0
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+        statements.append(counter.count)
+        # リクエストごとに新しいセッションを使う状態に揃える
+        db.session.remove()
+    return timings, statements
+
+def run_queries(mix, repeat):
+    counter = StatementCounter(db.engine)
+    client = app.test_client()
+    results = {'engine': {}, 'route': {}}
+    for kind, queries in mix.items():
+        engine_timings, engine_statements, route_timings, route_statements = [], [], [], []
+        for params in queries:
+            timings, statements = measure(lambda: SearchEngine(**params), repeat, counter)
+            engine_timings += timings
+            engine_statements += statements
+
+            url = route_url(params)
+            timings, statements = measure(lambda: client.get(url), repeat, counter)
+            route_timings += timings
+            route_statements += statements
+        results['engine'][kind] = summarize(engine_timings, engine_statements)
+        results['route'][kind] = summarize(route_timings, route_statements)
+    return results
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(BASELINE_DIR),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# 基準値と比べてp95または文の数が増えた項目を返す
+def compare(results, baseline, tolerance):
+    regressions = []
+    for target, kinds in results.items():
+        for kind, current in kinds.items():
+            previous = baseline['results'].get(target, {}).get(kind)
+            if previous is None:
+                continue
+            p95_ratio = current['p95_ms'] / previous['p95_ms'] if previous['p95_ms'] else 1
+            regressed = p95_ratio > 1 + tolerance or current['statements'] > previous['statements']
+            print(f"{target:6} {kind:10} p95 {previous['p95_ms']:9.2f} -> {current['p95_ms']:9.2f} ms ({p95_ratio:5.2f}x)  "
+                  f"SQL {previous['statements']:6.1f} -> {current['statements']:6.1f}{'  REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append((target, kind))
+    return regressions
+
+def print_results(results):
+    print(f"{'target':6} {'kind':10} {'p50':>9} {'p95':>9} {'p99':>9} {'SQL':>6}")
+    for target, kinds in results.items():
+        for kind, summary in kinds.items():
+            print(f"{target:6} {kind:10} {summary['p50_ms']:9.2f} {summary['p95_ms']:9.2f} {summary['p99_ms']:9.2f} {summary['statements']:6.1f}")
+
+def main():
+    arg = ArgumentParser(description='検索のベンチマーク')
+
+    arg.add_argument('--database', help='使い捨てのデータベースのURI(省略時は一時ディレクトリのSQLite)')
+    arg.add_argument('--studies', type=int, default=100, help='生成する研究の数')
+    arg.add_argument('--files', type=int, default=3, help='研究ごとのファイルの数')
+    arg.add_argument('--chars', type=int, default=8000, help='ファイルの本文の平均文字数')
+    arg.add_argument('--seed', type=int, default=0)
+    arg.add_argument('--engine', help='検索エンジン(ngram, native, like)')
+    arg.add_argument('--repeat', type=int, default=10, help='各検索を繰り返す回数')
+    arg.add_argument('--reuse', action='store_true', help='既存のデータベースをそのまま使う')
+    arg.add_argument('--output', help='結果を書き出すJSONファイル')
+    arg.add_argument('--save-baseline', metavar='NAME', help='結果を基準値として保存する')
+    arg.add_argument('--compare', metavar='NAME', help='保存した基準値と比較する')
+    arg.add_argument('--tolerance', type=float, default=0.2, help='p95の悪化を許容する割合')
+
+    args = arg.parse_args()
+
+    temp_dir = None
+    database = args.database
+    if database is None:
+        temp_dir = tempfile.mkdtemp(prefix='search-bench-')
+        database = 'sqlite:///' + os.path.join(temp_dir, 'bench.db')
+    if database == app.config['SQLALCHEMY_DATABASE_URI']:
+        sys.exit('The benchmark drops all tables; use a throwaway database instead of the configured one')
+
+    # 計測に影響する検索結果のキャッシュとリクエスト後の索引の更新を止める
+    config = config_watcher.get_config()
+    config['SearchCache'] = {'enabled': False}
+    config['IndexQueue'] = {'inline': False}
+    if args.engine:
+        config['Search'] = dict(config.get('Search') or {}, engine=args.engine)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database
+
+    try:
+        with app.app_context():
+            if not args.reuse:
+                db.drop_all()
+                db.create_all()
+                start = time.perf_counter()
+                tag_ids = generate(args.studies, args.files, args.chars, seed=args.seed)
+                print(f'Generated corpus in {time.perf_counter() - start:.1f}s')
+
+                start = time.perf_counter()
+                get_search_index().rebuild()
+                print(f'Built {get_search_index().name} index in {time.perf_counter() - start:.1f}s')
+            else:
+                # 生成時と同じ順序でタグを並べて同じ検索条件にする
+                tags = {tag.name: tag.id for tag in TAGS.query.filter(TAGS.name.in_(TAG_NAMES)).all()}
+                tag_ids = [tags[name] for name in TAG_NAMES if name in tags]
+
+            results = run_queries(query_mix(tag_ids), args.repeat)
+            report = {
+                'meta': {
+                    'revision': git_revision(),
+                    'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'dialect': db.engine.dialect.name,
+                    'engine': get_search_index().name,
+                    'studies': args.studies,
+                    'files_per_study': args.files,
+                    'content_chars': args.chars,
+                    'seed': args.seed,
+                    'repeat': args.repeat,
+                },
+                'results': results,
+            }
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(os.path.join(BASELINE_DIR, f'{args.save_baseline}.json'), 'w', encoding='utf8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f'{args.compare}.json'), encoding='utf8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -11,7 +11,7 @@ from .config import ConfigWatcher
 app = Flask(__name__)
 
 config_watcher = ConfigWatcher(app)
-config_thread = threading.Thread(target=config_watcher.run)
+config_thread = threading.Thread(target=config_watcher.run, daemon=True)
 config_thread.start()
 
 Session(app)
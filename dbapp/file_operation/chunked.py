@@ -0,0 +1,130 @@
+import hashlib
+import math
+import os
+import time
+import ulid
+from dbapp import config_watcher
+from dbapp.file_operation.ingest import get_redis, upload_filename, accept_upload
+from dbapp.file_operation.storage import get_blob_store
+from dbapp.tools import sha256_hash
+
+UPLOAD_PREFIX = 'upload:'
+# 受信したチャンクの番号の集合
+CHUNKS_SUFFIX = ':chunks'
+PART_SUFFIX = '.upload'
+
+def chunked_config():
+    chunked = config_watcher.get_config().get('ChunkedUpload') or {}
+    return {
+        'chunk_size': int(chunked.get('chunk_size_mb', 8)) * 1024 * 1024,
+        'max_size': int(chunked.get('max_size_mb', 4096)) * 1024 * 1024,
+        'ttl': int(chunked.get('ttl', 86400)),
+    }
+
+def part_path(upload_id):
+    return os.path.join(get_blob_store().temp_dir(), upload_id + PART_SUFFIX)
+
+# 期限切れで状態が消えたアップロードの書き込み途中のファイルを削除する
+def purge_expired():
+    ttl = chunked_config()['ttl']
+    for entry in os.scandir(get_blob_store().temp_dir()):
+        if entry.name.endswith(PART_SUFFIX) and entry.stat().st_mtime < time.time() - ttl:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+def get_upload(upload_id):
+    redis = get_redis()
+    upload = redis.hgetall(UPLOAD_PREFIX + upload_id)
+    if not upload:
+        return None
+    upload = {key.decode(): value.decode() for key, value in upload.items()}
+    for key in ['size', 'chunk_size', 'chunks', 'type', 'pubyear']:
+        upload[key] = int(upload[key])
+    upload['id'] = upload_id
+    upload['received'] = sorted(int(index) for index in redis.smembers(UPLOAD_PREFIX + upload_id + CHUNKS_SUFFIX))
+    return upload
+
+def touch_upload(upload_id):
+    ttl = chunked_config()['ttl']
+    pipe = get_redis().pipeline()
+    pipe.expire(UPLOAD_PREFIX + upload_id, ttl)
+    pipe.expire(UPLOAD_PREFIX + upload_id + CHUNKS_SUFFIX, ttl)
+    pipe.execute()
+
+# アップロードを開始して書き込み先のファイルをファイルサイズ分確保する
+def create_upload(user_id, parent_id, name, size, summary, filetype, pubyear):
+    config = chunked_config()
+    if size <= 0 or size > config['max_size']:
+        raise Exception(f"ファイルサイズは{config['max_size'] // (1024 * 1024)}MBまでです")
+    if not summary:
+        raise Exception("概要を入力してください")
+    filename = upload_filename(name)
+
+    purge_expired()
+
+    upload_id = ulid.new().str
+    with open(part_path(upload_id), 'wb') as f:
+        f.truncate(size)
+
+    get_redis().hset(UPLOAD_PREFIX + upload_id, mapping={
+        'user_id': user_id,
+        'study_id': parent_id,
+        'name': name,
+        'filename': filename,
+        'size': size,
+        'chunk_size': config['chunk_size'],
+        'chunks': math.ceil(size / config['chunk_size']),
+        'summary': summary,
+        'type': filetype,
+        'pubyear': pubyear,
+    })
+    touch_upload(upload_id)
+    return get_upload(upload_id)
+
+# チャンクをメモリ上で確認し、大きさとSHA-256が一致した場合のみファイルの該当する位置に書き込んで受信済みにする
+# 受信済みのチャンクを壊れた内容で送り直しても書き込まれない
+def write_chunk(upload, index, stream, checksum):
+    if index < 0 or index >= upload['chunks']:
+        raise Exception("チャンクの番号が不正です")
+    offset = index * upload['chunk_size']
+    length = min(upload['chunk_size'], upload['size'] - offset)
+
+    # 長すぎる本文を読み込まないように1バイト多く読んで確認する
+    chunk = b''
+    while len(chunk) <= length:
+        data = stream.read(length + 1 - len(chunk))
+        if not data:
+            break
+        chunk += data
+    if len(chunk) != length:
+        raise Exception(f"チャンクの大きさが不正です({len(chunk)}/{length}バイト)")
+    if hashlib.sha256(chunk).hexdigest() != (checksum or '').lower():
+        raise Exception("チャンクのSHA-256が一致しません")
+
+    with open(part_path(upload['id']), 'r+b') as f:
+        f.seek(offset)
+        f.write(chunk)
+
+    get_redis().sadd(UPLOAD_PREFIX + upload['id'] + CHUNKS_SUFFIX, index)
+    touch_upload(upload['id'])
+    os.utime(part_path(upload['id']))
+    return len(upload['received']) + (index not in upload['received'])
+
+# すべてのチャンクがそろったファイルを通常のアップロードと同じ処理に渡す
+def complete_upload(upload, user):
+    if len(upload['received']) != upload['chunks']:
+        raise Exception("受信していないチャンクがあります")
+
+    redis = get_redis()
+    # 同じアップロードを二重に登録しないようにする
+    if not redis.hsetnx(UPLOAD_PREFIX + upload['id'], 'completing', 1):
+        raise Exception("このアップロードはすでに処理されています")
+
+    temppath = part_path(upload['id'])
+    try:
+        filehash = sha256_hash(temppath)
+        return accept_upload(temppath, filehash, upload['name'], upload['filename'], upload['study_id'], user, upload['summary'], upload['type'], upload['pubyear'])
+    finally:
+        redis.delete(UPLOAD_PREFIX + upload['id'], UPLOAD_PREFIX + upload['id'] + CHUNKS_SUFFIX)
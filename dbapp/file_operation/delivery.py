@@ -0,0 +1,71 @@
+import os
+from datetime import timezone
+from urllib.parse import quote
+from flask import request, send_file
+from werkzeug.http import is_resource_modified
+from werkzeug.utils import send_file as send_file_header
+from dbapp import app, config_watcher
+
+# ファイルの送り方
+DELIVERY_PYTHON = 'python'
+DELIVERY_SENDFILE = 'x-sendfile'
+DELIVERY_ACCEL = 'x-accel'
+
+def delivery_config():
+    delivery = config_watcher.get_config().get('Delivery') or {}
+    return {
+        'mode': delivery.get('mode') or DELIVERY_PYTHON,
+        'accel_root': delivery.get('accel_root') or app.config['UPLOAD_FOLDER'],
+        'accel_prefix': delivery.get('accel_prefix') or '/protected/',
+        'max_age': int(delivery.get('max_age', 604800)),
+    }
+
+# nginxの内部ロケーションのURIに変換する(accel_rootの外にあるファイルはNoneを返す)
+def accel_uri(path, config):
+    root = os.path.abspath(config['accel_root'])
+    if os.path.commonpath([root, path]) != root:
+        return None
+    return config['accel_prefix'].rstrip('/') + '/' + quote(os.path.relpath(path, root).replace(os.sep, '/'))
+
+# 公開されているファイルは共有キャッシュにも保存させ、それ以外は毎回確認させる
+def set_cache_headers(response, etag, last_modified, public, config):
+    if etag:
+        response.set_etag(etag)
+    response.last_modified = last_modified
+    if public:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = config['max_age']
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+# アクセスの確認後に呼び出し、x-sendfile・x-accelではファイルの送信をフロントエンドのサーバーに任せる
+# ファイルの内容は変わらないため、ETagにはSHA-256を、Last-Modifiedには登録日時を使う
+def send_stored_file(path, mimetype, download_name, etag=None, created_at=None, public=False):
+    config = delivery_config()
+    path = os.path.abspath(path)
+    # 登録日時はローカル時刻で保存されている
+    last_modified = created_at.astimezone(timezone.utc) if created_at is not None else None
+
+    # If-None-Match・If-Modified-Sinceが一致すればファイルを開かずに304を返す
+    if (etag or last_modified) and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = app.response_class(status=304)
+        return set_cache_headers(response, etag, last_modified, public, config)
+
+    if config['mode'] in [DELIVERY_SENDFILE, DELIVERY_ACCEL]:
+        uri = accel_uri(path, config) if config['mode'] == DELIVERY_ACCEL else path
+        if uri is not None:
+            response = send_file_header(path, request.environ, mimetype=mimetype, download_name=download_name, use_x_sendfile=True, conditional=False, etag=False)
+            # 本文を持たない応答にファイルの長さが付かないようにする(長さとRangeの処理はフロントエンドのサーバーが行う)
+            del response.headers['Content-Length']
+            response.automatically_set_content_length = False
+            if config['mode'] == DELIVERY_ACCEL:
+                del response.headers['X-Sendfile']
+                response.headers['X-Accel-Redirect'] = uri
+            return set_cache_headers(response, etag, last_modified, public, config)
+
+    # Rangeヘッダーがあれば206で一部分だけを返す(If-RangeはETagと登録日時で判定する)
+    response = send_file(path, mimetype=mimetype, download_name=download_name, conditional=True, etag=etag or False, last_modified=last_modified)
+    return set_cache_headers(response, etag, last_modified, public, config)
@@ -0,0 +1,95 @@
+import json
+import os
+import tempfile
+from dbapp import app, config_watcher
+from dbapp.file_operation.pdf import PDF_extractor
+
+# 抽出処理の出力が変わった場合に古いキャッシュを使わないための版数
+EXTRACT_VERSION = 2
+
+def cache_config():
+    extract_cache = config_watcher.get_config().get('ExtractCache') or {}
+    return {
+        'enabled': extract_cache.get('enabled', True),
+        'directory': extract_cache.get('directory') or os.path.join(app.config['UPLOAD_FOLDER'], '.extract_cache'),
+        'max_bytes': int(extract_cache.get('max_size_mb', 512)) * 1024 * 1024,
+    }
+
+# PDFのSHA-256をキーにして抽出結果をJSONファイルに保存する
+# 最終利用時刻をファイルの更新日時で表し、上限を超えたら古いものから削除する
+class ExtractCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + '.json')
+
+    def get(self, digest):
+        path = self.path(digest)
+        try:
+            with open(path, encoding='utf8') as f:
+                cached = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if cached.get('version') != EXTRACT_VERSION:
+            return None
+        return cached['result']
+
+    def put(self, digest, result):
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 書き込み途中のファイルを読まないように一時ファイルから置き換える
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf8') as f:
+                json.dump({'version': EXTRACT_VERSION, 'result': result}, f, ensure_ascii=False)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+def get_extract_cache():
+    config = cache_config()
+    if not config['enabled']:
+        return None
+    return ExtractCache(config['directory'], config['max_bytes'])
+
+# キャッシュにあればそれを返し、なければPDFを解析して保存する
+def cached_PDF_extractor(source, digest, **kwargs):
+    cache = get_extract_cache()
+    if cache is not None:
+        result = cache.get(digest)
+        if result is not None:
+            return result
+
+    result = PDF_extractor(source, **kwargs)
+    if cache is not None and result is not None:
+        cache.put(digest, result)
+    return result
@@ -0,0 +1,290 @@
+import os
+import sys
+import time
+import ulid
+from datetime import datetime
+from cv2 import VideoCapture
+from werkzeug.utils import secure_filename
+from sqlalchemy.exc import IntegrityError
+from PIL import Image, UnidentifiedImageError
+from dbapp import app, db, config_watcher
+from dbapp.models.tables import FILES, FILEPAGES, STUDIES, FILE_PENDING, FILE_PROCESSING, FILE_READY
+from dbapp.file_operation.extract_cache import cached_PDF_extractor
+from dbapp.file_operation.storage import file_path, store_upload, discard, release
+from dbapp.tools import sha256_hash
+
+UPLOAD_EXTENSIONS = ['.pdf', '.mp4', '.png']
+
+QUEUE_KEY = 'ingest:queue'
+# ワーカーが処理中のジョブ(ワーカーが異常終了した場合に再登録する)
+PROCESSING_KEY = 'ingest:processing'
+JOB_PREFIX = 'ingest:job:'
+
+# ジョブの状態
+JOB_QUEUED = 'queued'
+JOB_PROCESSING = 'processing'
+JOB_SUCCESS = 'success'
+JOB_FAILED = 'failed'
+
+def ingest_config():
+    ingest = config_watcher.get_config().get('Ingest') or {}
+    return {
+        'job_ttl': int(ingest.get('job_ttl', 86400)),
+        'timeout': int(ingest.get('timeout', 5)),
+        'pdf_workers': int(ingest.get('pdf_workers', 0)),
+        'pdf_min_pages': int(ingest.get('pdf_min_pages', 8)),
+    }
+
+def get_redis():
+    return app.config['SESSION_REDIS']
+
+def set_job(job_id, **fields):
+    redis = get_redis()
+    pipe = redis.pipeline()
+    pipe.hset(JOB_PREFIX + job_id, mapping={key: str(value) for key, value in fields.items()})
+    pipe.expire(JOB_PREFIX + job_id, ingest_config()['job_ttl'])
+    pipe.execute()
+
+def get_job(job_id):
+    job = get_redis().hgetall(JOB_PREFIX + job_id)
+    if not job:
+        return None
+    return {key.decode(): value.decode() for key, value in job.items()}
+
+# ジョブはアップロードしたユーザーと管理者だけが参照できる
+def can_view_job(job, user):
+    return job.get('user_id') == str(user.id) or user.has_role('Admin')
+
+# アップロードされたファイルの解析をキューに登録してジョブIDを返す
+def enqueue_ingest(file_id, user_id):
+    job_id = ulid.new().str
+    set_job(job_id, file_id=file_id, user_id=user_id, status=JOB_QUEUED, reason='', enqueued_at=time.time())
+    get_redis().lpush(QUEUE_KEY, job_id)
+    return job_id
+
+# 保存するファイル名を作る(拡張子の確認のみ行い、ファイルの解析はワーカーで行う)
+def upload_filename(name):
+    filename = secure_filename(datetime.now().strftime('%Y%m%d%H%M%S') + '-' + name)
+    if os.path.splitext(filename)[1].lower() not in UPLOAD_EXTENSIONS:
+        raise Exception("不正なファイルがアップロードされました")
+    return filename
+
+# 書き込み済みの一時ファイルを登録して解析をキューに登録し、ファイルIDとジョブIDを返す
+# 重複していれば解析する前に取り消す
+def accept_upload(temppath, filehash, name, filename, parent_id, user, summary, filetype, pubyear):
+    file_id = ulid.new().str
+    stored = False
+    try:
+        # 同じ内容のファイルは他の研究と実体を共有して登録できるが、同じ研究には登録できない
+        if FILES.query.filter(FILES.hashsum == filehash, FILES.study_id == parent_id).first() is not None:
+            raise Exception("この研究にはすでに同じファイルがアップロードされています")
+
+        store_upload(temppath, filehash)
+        stored = True
+
+        add_file = FILES(
+            id=file_id,
+            name=name,
+            summary=summary,
+            type=filetype,
+            content='',
+            hashsum=filehash,
+            filename=filename,
+            pubyear=pubyear,
+            status=FILE_PENDING,
+            author=[user],
+            study_id=parent_id
+        )
+
+        db.session.add(add_file)
+
+        try:
+            db.session.flush()
+            db.session.commit()
+        except IntegrityError:
+            # 同じファイルが同時にアップロードされ、先に登録された場合
+            raise Exception("この研究にはすでに同じファイルがアップロードされています")
+
+        job_id = enqueue_ingest(file_id, user.id)
+
+    except Exception:
+        if os.path.exists(temppath):
+            os.remove(temppath)
+
+        db.session.rollback()
+
+        # キューへの登録に失敗した場合は登録済みのファイルも取り消す
+        orphan = FILES.query.filter(FILES.id==file_id).one_or_none()
+        if orphan is not None:
+            release(orphan)
+            db.session.delete(orphan)
+            db.session.commit()
+        elif stored:
+            discard(filehash)
+        raise
+
+    return file_id, job_id
+
+# ファイルを検証して本文・種類・ページごとの本文・PDFの発表年度を返す
+# pdf_workersを指定しない場合は設定ファイルのプロセス数でPDFを解析する
+# 保存先のファイル名に拡張子がない場合はfilenameの拡張子で種類を判定する
+def inspect_file(savepath, filetype, filehash, pdf_workers=None, filename=None):
+    content = ''
+    pages = []
+    pubyear = None
+    file_extension = os.path.splitext(filename or savepath)[1].lower()
+    if file_extension == ".pdf":
+        config = ingest_config()
+        workers = config['pdf_workers'] if pdf_workers is None else pdf_workers
+        pdf = cached_PDF_extractor(savepath, filehash, workers=workers, min_pages=config['pdf_min_pages'])
+
+        if pdf is None:
+            raise Exception("PDFドキュメントの解析に失敗しました。PDFドキュメントが破損している可能性があります。")
+
+        content = pdf["content"]
+        pages = pdf["pages"]
+        pubyear = pdf["pubyear"]
+
+    elif file_extension == ".mp4":
+        check_mp4 = VideoCapture(savepath)
+        if not check_mp4.isOpened():
+            raise Exception("MP4動画の解析に失敗しました。MP4動画が破損している可能性があります。")
+
+        filetype = 5
+        check_mp4.release()
+
+    elif file_extension == ".png":
+        try:
+            check_png = Image.open(savepath)
+
+            check_png.verify()
+
+            filetype = 6
+            check_png.close()
+        except UnidentifiedImageError:
+            raise Exception('PNG画像の解析に失敗しました。PNG画像が破損している可能性があります')
+
+    else:
+        raise Exception("不正なファイルがアップロードされました")
+
+    return content, filetype, pages, pubyear
+
+def pdf_pages(pages):
+    return [FILEPAGES(page=page, content=text) for page, text in enumerate(pages, 1)]
+
+def process_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return
+
+    file = FILES.query.filter(FILES.id==job['file_id']).one_or_none()
+    if file is None:
+        set_job(job_id, status=JOB_FAILED, reason='ファイルが存在しません')
+        return
+
+    set_job(job_id, status=JOB_PROCESSING)
+    file.status = FILE_PROCESSING
+    db.session.commit()
+
+    savepath = file_path(file)
+    try:
+        # 重複したファイルは解析する前に取り消す(アップロード時に計算したハッシュ値があればそれを使う)
+        filehash = file.hashsum or sha256_hash(savepath)
+
+        fileUniqueCheck = FILES.query.filter(FILES.hashsum == filehash, FILES.study_id == file.study_id, FILES.id != file.id).first()
+        if fileUniqueCheck is not None:
+            raise Exception("この研究にはすでに同じファイルがアップロードされています")
+
+        content, filetype, pages, pubyear = inspect_file(savepath, file.type, filehash, filename=file.filename)
+
+        file.content = content
+        file.type = filetype
+        file.hashsum = filehash
+        file.status = FILE_READY
+        file.pages = pdf_pages(pages)
+
+        parent = STUDIES.query.filter(STUDIES.id==file.study_id).one()
+        parent.update_at = datetime.now()
+
+        db.session.flush()
+        db.session.commit()
+
+        set_job(job_id, status=JOB_SUCCESS, name=file.name, finished_at=time.time())
+
+    except Exception as e:
+        db.session.rollback()
+
+        # 解析に失敗したファイルは登録を取り消す
+        file = FILES.query.filter(FILES.id==job['file_id']).one_or_none()
+        if file is not None:
+            release(file)
+            db.session.delete(file)
+            db.session.commit()
+
+        set_job(job_id, status=JOB_FAILED, reason=e, finished_at=time.time())
+
+# 異常終了したワーカーが処理していたジョブをキューに戻す
+def recover_jobs():
+    redis = get_redis()
+    while redis.rpoplpush(PROCESSING_KEY, QUEUE_KEY) is not None:
+        pass
+
+# ページごとの本文がない既存のPDFを解析し直して登録する
+def backfill_pages():
+    config = ingest_config()
+    files = FILES.query.filter(~FILES.pages.any(), FILES.filename.ilike('%.pdf')).all()
+    for file in files:
+        savepath = file_path(file)
+        if not os.path.isfile(savepath):
+            continue
+        pdf = cached_PDF_extractor(savepath, file.hashsum or sha256_hash(savepath), workers=config['pdf_workers'], min_pages=config['pdf_min_pages'])
+        if pdf is None:
+            sys.stderr.write(f'Failed to extract pages of {file.id}\n')
+            continue
+        file.pages = pdf_pages(pdf["pages"])
+        db.session.commit()
+
+def run_worker():
+    redis = get_redis()
+    while True:
+        job_id = redis.brpoplpush(QUEUE_KEY, PROCESSING_KEY, timeout=ingest_config()['timeout'])
+        if job_id is None:
+            continue
+        try:
+            process_job(job_id.decode())
+        except Exception as e:
+            sys.stderr.write(f'Ingest job {job_id.decode()} failed: {e}\n')
+            db.session.rollback()
+        finally:
+            redis.lrem(PROCESSING_KEY, 1, job_id)
+            db.session.remove()
+
+def start_worker():
+    with app.app_context():
+        run_worker()
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from multiprocessing import Process
+
+    arg = ArgumentParser()
+
+    arg.add_argument('-w', '--workers', type=int, default=1, help='起動するワーカープロセスの数')
+    arg.add_argument('-r', '--recover', action='store_true', help='処理中のまま残っているジョブをキューに戻す')
+    arg.add_argument('--backfill-pages', action='store_true', help='既存のPDFのページごとの本文を登録して終了する')
+
+    args = arg.parse_args()
+    if args.backfill_pages:
+        with app.app_context():
+            backfill_pages()
+        sys.exit()
+
+    if args.recover:
+        with app.app_context():
+            recover_jobs()
+
+    processes = [Process(target=start_worker) for _ in range(args.workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import ulid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime
+from dbapp import app, db
+from dbapp.models.tables import USERS, FILES, STUDIES, FILE_READY
+from dbapp.file_operation.ingest import inspect_file, pdf_pages
+from dbapp.file_operation.storage import get_blob_store, add_reference, discard
+from dbapp.tools import sha256_hash
+
+SUPPORTED_EXTENSIONS = ['.pdf', '.mp4', '.png']
+# データベースに既存のハッシュ値を問い合わせる件数
+HASH_QUERY_SIZE = 500
+
+# 取り込みの進み具合を保存するファイル(取り込むディレクトリごとに分ける)
+def default_state_path(root):
+    digest = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()
+    return os.path.join(app.config['UPLOAD_FOLDER'], '.legacy', digest + '.json')
+
+def load_state(path):
+    try:
+        with open(path, encoding='utf8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    state.setdefault('hashes', {})
+    state.setdefault('done', {})
+    state.setdefault('failed', {})
+    return state
+
+def save_state(path, state):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 中断されても壊れたファイルが残らないように一時ファイルから置き換える
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+# 直下のディレクトリを研究、その中のファイルを研究のファイルとして列挙する
+def scan(root):
+    entries = []
+    for study in sorted(os.scandir(root), key=lambda entry: entry.name):
+        if not study.is_dir():
+            continue
+        for directory, dirnames, filenames in os.walk(study.path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1].lower() not in SUPPORTED_EXTENSIONS:
+                    continue
+                relpath = os.path.relpath(os.path.join(directory, filename), root)
+                entries.append((study.name, relpath))
+    return entries
+
+# ファイルのハッシュ値を並列に計算する(サイズと更新日時が変わらないファイルは前回の値を使う)
+def hash_files(root, relpaths, state, workers):
+    def hash_one(relpath):
+        path = os.path.join(root, relpath)
+        stat = os.stat(path)
+        cached = state['hashes'].get(relpath)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+            return relpath, cached
+        return relpath, [stat.st_size, stat.st_mtime, sha256_hash(path)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for relpath, hashed in executor.map(hash_one, relpaths):
+            state['hashes'][relpath] = hashed
+
+# 登録済みのハッシュ値を返す
+def existing_hashes(hashes):
+    hashes = list(hashes)
+    existing = set()
+    for start in range(0, len(hashes), HASH_QUERY_SIZE):
+        chunk = hashes[start:start + HASH_QUERY_SIZE]
+        existing.update(hashsum for hashsum, in db.session.query(FILES.hashsum).filter(FILES.hashsum.in_(chunk)))
+    return existing
+
+# プロセスプールで実行する解析(PDFの解析をさらに並列化しないようにする)
+def inspect_worker(task):
+    path, filetype, filehash = task
+    try:
+        return inspect_file(path, filetype, filehash, pdf_workers=1), None
+    except Exception as e:
+        return None, str(e)
+
+def get_study(name, field, user, studies):
+    study = studies.get(name)
+    if study is None:
+        study = STUDIES.query.filter(STUDIES.name == name).one_or_none()
+    if study is None:
+        study = STUDIES(
+            id=ulid.new().str,
+            name=name,
+            summary='',
+            raw_markdown='',
+            field=field,
+            authors=[user]
+        )
+        db.session.add(study)
+    studies[name] = study
+    return study
+
+# 1バッチ分のファイルを解析して1つのトランザクションで登録する
+def import_batch(root, batch, state, user, filetype, field, executor):
+    tasks = [(os.path.join(root, relpath), filetype, state['hashes'][relpath][2]) for study_name, relpath in batch]
+    results = list(executor.map(inspect_worker, tasks))
+
+    store = get_blob_store()
+    copied = []
+    imported = {}
+    studies = {}
+    try:
+        for (study_name, relpath), (result, error) in zip(batch, results):
+            if error is not None:
+                state['failed'][relpath] = error
+                sys.stderr.write(f'{relpath}: {error}\n')
+                continue
+            content, inspected_type, pages, pubyear = result
+            path = os.path.join(root, relpath)
+            study = get_study(study_name, field, user, studies)
+
+            file_id = ulid.new().str
+            filehash = state['hashes'][relpath][2]
+            store.copy(path, filehash)
+            copied.append(filehash)
+            add_reference(filehash, os.path.getsize(path))
+
+            db.session.add(FILES(
+                id=file_id,
+                name=os.path.basename(relpath),
+                summary=relpath,
+                type=inspected_type,
+                content=content,
+                hashsum=filehash,
+                filename=file_id + os.path.splitext(relpath)[1].lower(),
+                pubyear=pubyear or datetime.fromtimestamp(os.stat(path).st_mtime).year,
+                status=FILE_READY,
+                author=[user],
+                study_id=study.id,
+                pages=pdf_pages(pages)
+            ))
+            study.update_at = datetime.now()
+            imported[relpath] = file_id
+
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        # 登録できなかったバッチのファイルは削除し、次回に取り込み直す(Ctrl+Cで中断された場合も含む)
+        for filehash in copied:
+            discard(filehash)
+        raise
+
+    for relpath in imported:
+        state['failed'].pop(relpath, None)
+    state['done'].update(imported)
+    return len(imported)
+
+def import_tree(root, user_name, filetype=3, field=1, workers=None, batch_size=50, state_path=None):
+    workers = workers or os.cpu_count()
+    state_path = state_path or default_state_path(root)
+
+    user = USERS.query.filter(USERS.name == user_name).one_or_none()
+    if user is None:
+        raise Exception(f'ユーザー{user_name}が存在しません')
+
+    state = load_state(state_path)
+    entries = [(study_name, relpath) for study_name, relpath in scan(root) if relpath not in state['done']]
+    sys.stderr.write(f'{len(entries)} files to import\n')
+
+    hash_files(root, [relpath for study_name, relpath in entries], state, workers)
+    save_state(state_path, state)
+
+    # 登録済みのファイルと、今回取り込むファイル同士の重複を除く
+    existing = existing_hashes(state['hashes'][relpath][2] for study_name, relpath in entries)
+    pending = []
+    seen = set()
+    for study_name, relpath in entries:
+        filehash = state['hashes'][relpath][2]
+        if filehash in existing or filehash in seen:
+            state['done'][relpath] = None
+            continue
+        seen.add(filehash)
+        pending.append((study_name, relpath))
+    sys.stderr.write(f'{len(entries) - len(pending)} duplicates skipped\n')
+    save_state(state_path, state)
+
+    imported = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(pending), batch_size):
+            imported += import_batch(root, pending[start:start + batch_size], state, user, filetype, field, executor)
+            save_state(state_path, state)
+            sys.stderr.write(f'{min(start + batch_size, len(pending))}/{len(pending)} processed, {imported} imported\n')
+
+    return imported, len(state['failed'])
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    arg = ArgumentParser(description='旧ファイルサーバーのディレクトリを研究・ファイルとして取り込む')
+
+    arg.add_argument('root', help='取り込むディレクトリ(直下のディレクトリが研究になります)')
+    arg.add_argument('-u', '--user', required=True, help='研究とファイルの著者にするユーザー名')
+    arg.add_argument('-t', '--type', type=int, default=3, help='ファイルの種類(1: ポスター発表, 2: プレゼンテーション, 3: 報告書, 4: 要旨)')
+    arg.add_argument('-f', '--field', type=int, default=1, help='新しく作る研究の分野')
+    arg.add_argument('-w', '--workers', type=int, help='ハッシュ値の計算と解析に使う並列数(省略時はCPU数)')
+    arg.add_argument('-b', '--batch', type=int, default=50, help='1つのトランザクションで登録するファイルの数')
+    arg.add_argument('-s', '--state', help='進み具合を保存するファイル')
+
+    args = arg.parse_args()
+    with app.app_context():
+        imported, failed = import_tree(args.root, args.user, args.type, args.field, args.workers, args.batch, args.state)
+    print(f'Imported {imported} files ({failed} failed)')
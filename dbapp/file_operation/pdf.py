@@ -1,5 +1,8 @@
-import io
+import mmap
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
 from pdfminer.converter import PDFPageAggregator
@@ -9,25 +12,46 @@ from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
 from pdfminer.pdfpage import PDFPage, PDFTextExtractionNotAllowed
 from pdfminer.pdfparser import PDFParser
 
-def PDF_extractor(file_obj):
+# PDFをメモリにコピーせずに読み込めるストリームを返す
+@contextmanager
+def pdf_stream(source):
+    if isinstance(source, (str, os.PathLike)):
+        # パスの場合はmmapで開き、ページキャッシュを直接参照する
+        with open(source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+    else:
+        # werkzeugのFileStorageは一時ファイルなどのストリームをそのまま使う
+        stream = getattr(source, 'stream', source)
+        stream.seek(0)
+        yield stream
+
+def PDF_extractor(source, workers=1, min_pages=8):
+    result = None
     try:
-        result = None
-        data = io.BytesIO(file_obj.read())
-        parser = PDFParser(data)
-        document = PDFDocument(parser)
-        if not document.is_extractable:
-            raise PDFTextExtractionNotAllowed
+        with pdf_stream(source) as data:
+            # 複数のプロセスで解析する場合は各プロセスがパスから開き直す
+            path = source if isinstance(source, (str, os.PathLike)) else None
+            result = extract(data, path, workers, min_pages)
 
-        rsrcmgr = PDFResourceManager()
-        laparams = LAParams()
-        device = PDFPageAggregator(rsrcmgr, laparams=laparams)
-        interpreter = PDFPageInterpreter(rsrcmgr, device)
+    except Exception as e:
+        print(e)
 
-        texts = ['']
-        font_sizes = []
-        text_fontsize = []
-        before_font_size = 0
-        for page in PDFPage.get_pages(data):
+    return result
+
+# 指定したページ(Noneの場合はすべて)のレイアウトを解析し、行ごとの(ページ番号, フォントサイズ, テキスト)を返す
+def page_lines(data, pagenos=None):
+    rsrcmgr = PDFResourceManager()
+    laparams = LAParams()
+    device = PDFPageAggregator(rsrcmgr, laparams=laparams)
+    interpreter = PDFPageInterpreter(rsrcmgr, device)
+
+    lines = []
+    try:
+        for pageno, page in enumerate(PDFPage.get_pages(data)):
+            if pagenos is not None and pageno not in pagenos:
+                if pageno > max(pagenos):
+                    break
+                continue
             interpreter.process_page(page)
             layout = device.get_result()
 
@@ -41,36 +65,105 @@ def PDF_extractor(file_obj):
                                 if isinstance(char, LTChar):
                                     font_size = max(font_size, abs(char.matrix[0]))
 
-                            if font_size == before_font_size or texts[-1] == '':
-                                texts[-1] += line_text
-                            else:
-                                text_fontsize.append((before_font_size, texts[-1]))
-                                font_sizes.append(before_font_size)
-                                texts.append(line_text)
+                            lines.append((pageno, font_size, line_text))
+    finally:
+        device.close()
 
-                            before_font_size = font_size
+    return lines
+
+# ProcessPoolExecutorから呼び出すため、モジュールの関数として定義する
+def page_range_lines(path, start, stop):
+    with pdf_stream(path) as data:
+        return page_lines(data, set(range(start, stop)))
+
+# ページを連続した範囲に分けて並列に解析し、ページ順に連結する
+def parallel_page_lines(path, page_count, workers):
+    # 処理時間の偏りを減らすため、プロセス数より多めに分割する
+    chunks = min(page_count, workers * 4)
+    bounds = [page_count * i // chunks for i in range(chunks + 1)]
+    lines = []
+    with ProcessPoolExecutor(max_workers=min(workers, chunks)) as executor:
+        for chunk in executor.map(page_range_lines, [path] * chunks, bounds[:-1], bounds[1:]):
+            lines += chunk
+    return lines
+
+# 同じフォントサイズが続く行を1つの段落にまとめる(ページをまたいでも順に処理する)
+def merge_lines(lines):
+    texts = ['']
+    font_sizes = []
+    text_fontsize = []
+    before_font_size = 0
+    for pageno, font_size, line_text in lines:
+        if font_size == before_font_size or texts[-1] == '':
+            texts[-1] += line_text
+        else:
+            text_fontsize.append((before_font_size, texts[-1]))
+            font_sizes.append(before_font_size)
+            texts.append(line_text)
 
-        match = re.search(r'\d{14}', str(document.info[0]['CreationDate'].decode()))
-        pubyear = datetime.strptime(match.group(), "%Y%m%d%H%M%S")
+        before_font_size = font_size
 
-        if pubyear.month < 4:
-            pubyear_jp = int(f"{pubyear.year - 1}")
-        else:
-            pubyear_jp = int(f"{pubyear.year}")
+    return texts
 
-        content = "\n".join(texts)
+# 作成日時から年度を求める(1月から3月は前年度とする)
+def pdf_pubyear(document):
+    match = re.search(r'\d{14}', str(document.info[0]['CreationDate'].decode()))
+    pubyear = datetime.strptime(match.group(), "%Y%m%d%H%M%S")
 
-        result = {"content": content, "pubyear": pubyear_jp}
+    if pubyear.month < 4:
+        return int(f"{pubyear.year - 1}")
+    else:
+        return int(f"{pubyear.year}")
+
+# トレーラーと文書情報辞書だけを読み、ページのレイアウト解析は行わない
+def PDF_metadata(source, first_page=False):
+    result = None
+    try:
+        with pdf_stream(source) as data:
+            parser = PDFParser(data)
+            try:
+                document = PDFDocument(parser)
+                result = {"pubyear": pdf_pubyear(document)}
+                if first_page:
+                    # 必要な場合は1ページ目のみ解析する
+                    result["first_page"] = "\n".join(line_text for pageno, font_size, line_text in page_lines(data, {0}))
+            finally:
+                parser.close()
 
     except Exception as e:
         print(e)
 
+    return result
+
+def extract(data, path=None, workers=1, min_pages=8):
+    parser = PDFParser(data)
+    try:
+        document = PDFDocument(parser)
+        if not document.is_extractable:
+            raise PDFTextExtractionNotAllowed
+
+        workers = workers or os.cpu_count() or 1
+        page_count = sum(1 for _ in PDFPage.create_pages(document))
+        if path and workers > 1 and page_count >= max(min_pages, 2):
+            lines = parallel_page_lines(path, page_count, workers)
+        else:
+            lines = page_lines(data)
+
+        texts = merge_lines(lines)
+
+        pubyear_jp = pdf_pubyear(document)
+
+        content = "\n".join(texts)
+
+        # ページごとの本文(検索でページ単位の一致を示すために使う)
+        pages = [[] for _ in range(page_count)]
+        for pageno, font_size, line_text in lines:
+            pages[pageno].append(line_text)
+
+        return {"content": content, "pubyear": pubyear_jp, "pages": ["\n".join(page) for page in pages]}
+
     finally:
-        data.close()
         parser.close()
-        device.close()
-
-    return result
 
 if __name__ == "__main__":
     from argparse import ArgumentParser
@@ -79,10 +172,13 @@ if __name__ == "__main__":
     
     arg.add_argument('-f', '--file', type=str, default=None)
     arg.add_argument('-t', '--type', type=str, default="all")
+    arg.add_argument('-w', '--workers', type=int, default=1, help='解析に使うプロセスの数(0はCPUの数)')
 
     args = arg.parse_args()
-    with open(args.file, 'rb') as data:
-        pdf = PDF_extractor(data)
-    
-    if args.type == "all":
+    if args.type == "metadata":
+        pdf = PDF_metadata(args.file, first_page=True)
+    else:
+        pdf = PDF_extractor(args.file, workers=args.workers)
+
+    if args.type in ["all", "metadata"]:
         print(pdf)
\ No newline at end of file
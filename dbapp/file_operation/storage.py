@@ -0,0 +1,159 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from dbapp import app, db, config_watcher
+from dbapp.models.tables import FILES, BLOBS
+
+def storage_config():
+    storage = config_watcher.get_config().get('Storage') or {}
+    return {
+        'directory': storage.get('directory') or os.path.join(app.config['UPLOAD_FOLDER'], 'blobs'),
+    }
+
+# ファイルをSHA-256のハッシュ値で分けたディレクトリに保存する
+# 同じ内容のファイルは1つだけ保存し、参照している数をBLOBSに記録する
+class BlobStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, hashsum):
+        return os.path.join(self.directory, hashsum[:2], hashsum[2:4], hashsum)
+
+    # 保存前のファイルを書き込むディレクトリ(os.replaceで移動できるように同じボリュームに置く)
+    def temp_dir(self):
+        path = os.path.join(self.directory, 'tmp')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def exists(self, hashsum):
+        return os.path.isfile(self.path(hashsum))
+
+    # 一時ファイルを保存先に移動する(同じ内容のファイルがあれば一時ファイルを消す)
+    def put(self, temppath, hashsum):
+        path = self.path(hashsum)
+        if os.path.isfile(path):
+            os.remove(temppath)
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temppath, path)
+        return path
+
+    def copy(self, source, hashsum):
+        if self.exists(hashsum):
+            return self.path(hashsum)
+        fd, temppath = tempfile.mkstemp(dir=self.temp_dir(), suffix='.part')
+        os.close(fd)
+        try:
+            shutil.copyfile(source, temppath)
+        except Exception:
+            os.remove(temppath)
+            raise
+        return self.put(temppath, hashsum)
+
+    def remove(self, hashsum):
+        try:
+            os.remove(self.path(hashsum))
+        except FileNotFoundError:
+            pass
+
+def get_blob_store():
+    return BlobStore(storage_config()['directory'])
+
+# 書き込みながらハッシュ値を計算して一時ファイルのパスとハッシュ値を返す
+def save_stream(stream, chunk_size=1024 * 1024):
+    hasher = hashlib.sha256()
+    fd, temppath = tempfile.mkstemp(dir=get_blob_store().temp_dir(), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                hasher.update(chunk)
+                f.write(chunk)
+    except Exception:
+        os.remove(temppath)
+        raise
+    return temppath, hasher.hexdigest()
+
+# 保存先に移す前の形式(研究ごとのディレクトリ)のパス
+def legacy_path(file):
+    return os.path.join(app.config['UPLOAD_FOLDER'], str(file.study_id), str(file.filename))
+
+# ファイルの実体のパスを返す(移行前のファイルは研究ごとのディレクトリから探す)
+def file_path(file):
+    if file.hashsum:
+        path = get_blob_store().path(file.hashsum)
+        if os.path.isfile(path):
+            return path
+    return legacy_path(file)
+
+# ファイルの参照を追加する(呼び出し側のトランザクションでコミットする)
+# 同じ実体を同時に参照しても数え漏れがないようにデータベース側で加算する
+def add_reference(hashsum, size):
+    updated = BLOBS.query.filter(BLOBS.hashsum == hashsum).update({BLOBS.refcount: BLOBS.refcount + 1}, synchronize_session=False)
+    if not updated:
+        db.session.add(BLOBS(hashsum=hashsum, size=size, refcount=1))
+        db.session.flush()
+
+# 一時ファイルを保存して参照を追加する
+def store_upload(temppath, hashsum):
+    size = os.path.getsize(temppath)
+    get_blob_store().put(temppath, hashsum)
+    add_reference(hashsum, size)
+
+# ファイルの参照を外す。参照がなくなった実体はコミット後に削除する
+def release(file):
+    removals = db.session.info.setdefault('blob_removals', set())
+    if file.hashsum:
+        BLOBS.query.filter(BLOBS.hashsum == file.hashsum).update({BLOBS.refcount: BLOBS.refcount - 1}, synchronize_session=False)
+        if BLOBS.query.filter(BLOBS.hashsum == file.hashsum, BLOBS.refcount <= 0).delete(synchronize_session=False):
+            removals.add(get_blob_store().path(file.hashsum))
+    removals.add(legacy_path(file))
+
+# コミットに失敗した場合に、参照されていない保存済みのファイルを消す
+def discard(hashsum):
+    if db.session.get(BLOBS, hashsum) is None:
+        get_blob_store().remove(hashsum)
+
+@event.listens_for(Session, 'after_commit')
+def remove_released_blobs(session):
+    for path in session.info.pop('blob_removals', set()):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+@event.listens_for(Session, 'after_rollback')
+def keep_released_blobs(session):
+    session.info.pop('blob_removals', None)
+
+# 研究ごとのディレクトリに保存されているファイルを移す
+# 実体を保存すると同じハッシュ値のファイルはすべて保存先から読み込まれるため、参照数は登録数に合わせる
+def migrate_legacy():
+    store = get_blob_store()
+    files = FILES.query.filter(FILES.hashsum.isnot(None)).all()
+    for file in files:
+        path = legacy_path(file)
+        if not os.path.isfile(path):
+            continue
+        store.copy(path, file.hashsum)
+        add_reference(file.hashsum, os.path.getsize(path))
+        references = FILES.query.filter(FILES.hashsum == file.hashsum).count()
+        BLOBS.query.filter(BLOBS.hashsum == file.hashsum).update({BLOBS.refcount: references}, synchronize_session=False)
+        db.session.commit()
+        os.remove(path)
+        sys.stderr.write(f'Moved {file.id}\n')
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    arg = ArgumentParser()
+
+    arg.add_argument('--migrate', action='store_true', help='研究ごとのディレクトリに保存されているファイルを移す')
+
+    args = arg.parse_args()
+    if args.migrate:
+        with app.app_context():
+            migrate_legacy()
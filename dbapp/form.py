@@ -2,8 +2,8 @@ import datetime
 from dbapp import db
 from dbapp.models.tables import STUDIES, FILES, USERS, TAGS, NEWS
 from flask_wtf import FlaskForm
-from wtforms import StringField, FileField, SelectField, TextAreaField, HiddenField, PasswordField, BooleanField, ValidationError, MultipleFileField
-from wtforms.validators import InputRequired
+from wtforms import StringField, FileField, SelectField, TextAreaField, HiddenField, PasswordField, BooleanField, ValidationError, MultipleFileField, IntegerField
+from wtforms.validators import InputRequired, Length, NumberRange
 
 class StudyForm(FlaskForm):
     title = StringField('Title', validators=[InputRequired()])
@@ -50,6 +50,21 @@ class UploadForm(FlaskForm):
     type = SelectField('Type',choices=[(1, 'ポスター発表'), (2, 'プレゼンテーション'), (3, '報告書'), (4, '要旨'), (5, '動画'), (6, '画像')])
     summary = TextAreaField('Summary', validators=[InputRequired()] )
 
+# 分割アップロードの開始時にJSONで受け取るファイルの情報(発表年度・種類・概要はUploadFormと同じ条件で確認する)
+class ChunkedUploadForm(UploadForm):
+    class Meta:
+        csrf = False
+
+    file = None
+    study_id = StringField('Study', validators=[InputRequired()])
+    name = StringField('Name', validators=[InputRequired(), Length(max=255)])
+    size = IntegerField('Size', validators=[InputRequired(), NumberRange(min=1)])
+
+    def validate_study_id(self, study_id):
+        check = STUDIES.query.filter(STUDIES.id == study_id.data, STUDIES.grave_data == False).first()
+        if check is None:
+            raise ValidationError('研究が存在しません')
+
 class FileEditForm(FlaskForm):
     pubyear = SelectField('Published_Year', choices=[(year, str(year) + '年度') for year in reversed(range(2001, int(datetime.datetime.now().strftime('%Y')) + 1))])
     type = SelectField('Type',choices=[(1, 'ポスター発表'), (2, 'プレゼンテーション'), (3, '報告書'), (4, '要旨')])
@@ -3,7 +3,8 @@ from flask_principal import UserNeed, RoleNeed
 from dbapp import db, ma, app
 from datetime import datetime
 from sqlalchemy import create_engine
-from sqlalchemy.orm import relationship
+from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.sql.schema import ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 import ulid
@@ -23,6 +24,9 @@ class STUDIES(db.Model, ModelBase):
     raw_markdown = db.Column(db.Text())
     field = db.Column(db.Integer)
     grave_data = db.Column(db.Boolean, default = False)
+    # 子のFILESのカウントの合計(並び替えのために非正規化して保持する)
+    total_access_count = db.Column(db.Integer, nullable = False, default = 0, server_default = '0', index = True)
+    total_preview_count = db.Column(db.Integer, nullable = False, default = 0, server_default = '0', index = True)
 
     tags = relationship('TAGS', secondary='study_tag', back_populates='studies')
     files = relationship('FILES', back_populates='study')
@@ -46,11 +50,16 @@ class STUDYGRAVES(db.Model, ModelBase):
     reason = db.Column(db.Text(), nullable = False)
     deleted = db.Column(db.Boolean, default = False)
 
+# ファイルの処理状態(アップロード後の解析が終わるまでは管理者以外に表示しない)
+FILE_PENDING = 'pending'
+FILE_PROCESSING = 'processing'
+FILE_READY = 'ready'
+
 class FILES(db.Model, ModelBase):
     __tablename__ = 'files'
     id = db.Column(db.String(26), primary_key=True, default = ulid_new_str)
     create_at = db.Column(db.DateTime, nullable = False, default = datetime.now)
-    hashsum = db.Column(db.Text(), unique = True)
+    hashsum = db.Column(db.String(64), index = True)
     name = db.Column(db.String(255))
     summary = db.Column(db.Text())
     type = db.Column(db.Integer, default = 0)
@@ -58,13 +67,36 @@ class FILES(db.Model, ModelBase):
     pubyear = db.Column(db.Integer)
     access_count = db.Column(db.Integer, default = 0)
     preview_count = db.Column(db.Integer, default = 0)
-    content = db.Column(db.Text())
+    # 本文は大きいため、必要な場合のみ読み込む
+    content = deferred(db.Column(db.Text()))
     grave_data = db.Column(db.Boolean, default = False)
+    status = db.Column(db.String(16), nullable = False, default = FILE_READY, server_default = FILE_READY, index = True)
     
     study_id = db.Column(db.String(26), ForeignKey('studies.id'))
     study = relationship('STUDIES')
 
     author = relationship('USERS', secondary='user_file', back_populates='files')
+    pages = relationship('FILEPAGES', cascade='all, delete-orphan', order_by='FILEPAGES.page')
+
+    # 同じ内容のファイルは同じ研究に1つだけ登録できる(同時にアップロードされた場合もデータベースで弾く)
+    __table_args__ = (
+        db.UniqueConstraint('study_id', 'hashsum', name='uq_files_study_id_hashsum'),
+    )
+
+# PDFのページごとの本文
+class FILEPAGES(db.Model, ModelBase):
+    __tablename__ = 'filepages'
+    file_id = db.Column(db.String(26), ForeignKey('files.id', ondelete='CASCADE'), primary_key=True)
+    page = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    content = db.Column(db.Text())
+
+# 内容のハッシュ値をキーにして保存したファイルと、それを参照しているファイルの数
+class BLOBS(db.Model, ModelBase):
+    __tablename__ = 'blobs'
+    hashsum = db.Column(db.String(64), primary_key=True)
+    create_at = db.Column(db.DateTime, nullable = False, default = datetime.now)
+    size = db.Column(db.BigInteger, nullable = False, default = 0)
+    refcount = db.Column(db.Integer, nullable = False, default = 0)
 
 class FILEGRAVES(db.Model, ModelBase):
     __tablename__ = 'filegraves'
@@ -194,6 +226,40 @@ class USER_NEWS(db.Model, ModelBase):
     user_id = db.Column(db.String(26), ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
     news_id = db.Column(db.String(26), ForeignKey('news.id', ondelete='CASCADE'), primary_key=True)
 
+# 検索用のN-gram転置インデックス
+class NGRAMS(db.Model, ModelBase):
+    __tablename__ = 'ngrams'
+    # MySQLの既定の照合順序ではかなの濁点などが同一視されるためバイナリ照合にする
+    gram = db.Column(db.String(8).with_variant(mysql.VARCHAR(8, collation='utf8mb4_bin'), 'mysql'), primary_key=True)
+    study_id = db.Column(db.String(26), ForeignKey('studies.id', ondelete='CASCADE'), primary_key=True)
+    # 1: 研究タイトル, 2: 研究概要, 3: ファイル概要, 4: ファイル本文
+    field = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    tf = db.Column(db.Integer, nullable = False, default = 0)
+
+    __table_args__ = (
+        db.Index('ix_ngrams_study_id', 'study_id'),
+    )
+
+# インデックス済みの研究とフィールドごとの文書長
+class SEARCHDOCS(db.Model, ModelBase):
+    __tablename__ = 'searchdocs'
+    study_id = db.Column(db.String(26), ForeignKey('studies.id', ondelete='CASCADE'), primary_key=True)
+    indexed_at = db.Column(db.DateTime, nullable = False, default = datetime.now)
+    name_length = db.Column(db.Integer, nullable = False, default = 0)
+    summary_length = db.Column(db.Integer, nullable = False, default = 0)
+    file_summary_length = db.Column(db.Integer, nullable = False, default = 0)
+    content_length = db.Column(db.Integer, nullable = False, default = 0)
+
+# TF-IDFのコサイン類似度で求めた関連研究(研究ごとに上位k件)
+class RELATEDSTUDIES(db.Model, ModelBase):
+    __tablename__ = 'relatedstudies'
+    study_id = db.Column(db.String(26), ForeignKey('studies.id', ondelete='CASCADE'), primary_key=True)
+    related_id = db.Column(db.String(26), ForeignKey('studies.id', ondelete='CASCADE'), primary_key=True)
+    rank = db.Column(db.Integer, nullable = False)
+    score = db.Column(db.Float, nullable = False)
+
+    related = relationship('STUDIES', foreign_keys=[related_id])
+
 class STUDIESSchema(ma.SQLAlchemyAutoSchema):
     class Meta():
         model = STUDIES
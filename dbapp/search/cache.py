@@ -0,0 +1,85 @@
+import hashlib
+import json
+import time
+from redis.exceptions import RedisError
+from dbapp import app, config_watcher
+
+KEY_PREFIX = 'search:result:'
+KEYS_ZSET = 'search:keys'
+GENERATION_KEY = 'search:generation'
+
+def cache_config():
+    search_cache = config_watcher.get_config().get('SearchCache') or {}
+    return {
+        'enabled': search_cache.get('enabled', True),
+        'ttl': int(search_cache.get('ttl', 300)),
+        'max_entries': int(search_cache.get('max_entries', 1000)),
+    }
+
+def get_redis():
+    return app.config['SESSION_REDIS']
+
+# 検索条件を正規化してキャッシュのキーを作成する
+def search_cache_key(search_terms, **kwargs):
+    # 語順や大文字小文字、重複は検索結果に影響しない
+    words = sorted(set(word.lower() for word in (search_terms or '').split()))
+    normalized = dict(kwargs, search_terms=words)
+    digest = hashlib.sha1(json.dumps(normalized, sort_keys=True, default=str).encode()).hexdigest()
+    return digest
+
+# 検索を始める前の世代を返す(検索中に無効化された場合は、結果をこの世代で保存して参照されないようにする)
+def current_generation():
+    if not cache_config()['enabled']:
+        return None
+    try:
+        return int(get_redis().get(GENERATION_KEY) or 0)
+    except RedisError:
+        return None
+
+def get_cached_result(digest, generation):
+    if generation is None:
+        return None
+    try:
+        cached = get_redis().get(f'{KEY_PREFIX}{generation}:{digest}')
+    except RedisError:
+        return None
+    if cached is None:
+        return None
+    return json.loads(cached)
+
+def store_result(digest, value, generation):
+    config = cache_config()
+    if not config['enabled'] or generation is None:
+        return
+    try:
+        redis = get_redis()
+        key = f'{KEY_PREFIX}{generation}:{digest}'
+        pipe = redis.pipeline()
+        pipe.setex(key, config['ttl'], json.dumps(value))
+        pipe.zadd(KEYS_ZSET, {key: time.time()})
+        pipe.zcard(KEYS_ZSET)
+        count = pipe.execute()[-1]
+
+        # 上限を超えた分は古いものから削除する
+        overflow = count - config['max_entries']
+        if overflow > 0:
+            old_keys = [key for key, score in redis.zpopmin(KEYS_ZSET, overflow)]
+            if old_keys:
+                redis.delete(*old_keys)
+    except RedisError:
+        pass
+
+# 研究やファイルが変更されたときにキャッシュを無効化する
+def invalidate_search_cache():
+    try:
+        redis = get_redis()
+        # 世代を進めて、処理中の検索が古い結果を書き込んでも参照されないようにする
+        redis.incr(GENERATION_KEY)
+        keys = redis.zrange(KEYS_ZSET, 0, -1)
+        pipe = redis.pipeline()
+        if keys:
+            pipe.delete(*keys)
+        pipe.delete(KEYS_ZSET)
+        pipe.execute()
+    except RedisError:
+        pass
@@ -0,0 +1,232 @@
+import math
+import re
+import unicodedata
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import select, func, case
+from sqlalchemy.orm import undefer
+from dbapp import db, config_watcher
+from dbapp.models.tables import STUDIES, FILES, NGRAMS, SEARCHDOCS
+
+# N-gramの長さ(日本語の検索ではバイグラムが一般的)
+NGRAM_SIZE = 2
+
+# インデックスのフィールド番号
+FIELD_NAME = 1
+FIELD_SUMMARY = 2
+FIELD_FILE_SUMMARY = 3
+FIELD_CONTENT = 4
+
+# BM25のパラメータとフィールドごとの重みの既定値
+BM25_K1 = 1.2
+BM25_B = 0.75
+DEFAULT_WEIGHTS = {
+    'name': 3.0,
+    'summary': 1.5,
+    'file_summary': 1.5,
+    'content': 1.0,
+}
+
+token_pattern = re.compile(r'\w+')
+
+# 全角半角・大文字小文字の揺れを吸収する
+def normalize(text):
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+# テキストを単語ごとに区切ってN-gramに分解する
+def tokenize(text, n=NGRAM_SIZE):
+    grams = []
+    for token in token_pattern.findall(normalize(text)):
+        if len(token) < n:
+            grams.append(token)
+            continue
+        for i in range(len(token) - n + 1):
+            grams.append(token[i:i + n])
+    return grams
+
+# 検索語をN-gramに分解する(N文字未満の語が含まれる場合はNoneを返す)
+def query_grams(word, n=NGRAM_SIZE):
+    tokens = token_pattern.findall(normalize(word))
+    if not tokens or any(len(token) < n for token in tokens):
+        return None
+    return set(tokenize(word, n))
+
+
+class SearchIndex:
+    # 検索エンジンのバックエンドの基底クラス
+    name = 'like'
+
+    def candidates(self, words):
+        # 検索語ごとに候補となる研究IDのサブクエリを返す(空のリストは絞り込みなし)
+        return []
+
+    def scores(self, words, weights=None, candidates=None):
+        # 関連度のスコアを(study_id, score)のサブクエリで返す(関連度の計算に対応しない場合はNone)
+        # candidatesには絞り込み条件に一致した研究IDのクエリを渡す
+        return None
+
+    def update_study(self, study_id):
+        pass
+
+    def remove_study(self, study_id):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+class NgramIndex(SearchIndex):
+    # データベースのテーブルに格納するN-gram転置インデックス
+    name = 'ngram'
+
+    def candidates(self, words):
+        selects = []
+        for word in words:
+            grams = query_grams(word)
+            # N文字未満の検索語はインデックスを使わずに全件を照合する
+            if grams is None:
+                continue
+            selects.append(
+                select(NGRAMS.study_id)
+                .where(NGRAMS.gram.in_(sorted(grams)))
+                .group_by(NGRAMS.study_id)
+                .having(func.count(func.distinct(NGRAMS.gram)) == len(grams))
+            )
+        return selects
+
+    def scores(self, words, weights=None, candidates=None):
+        grams = set()
+        for word in words:
+            grams |= query_grams(word) or set()
+        if not grams:
+            return None
+        grams = sorted(grams)
+
+        weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        field_weights = {
+            FIELD_NAME: weights['name'],
+            FIELD_SUMMARY: weights['summary'],
+            FIELD_FILE_SUMMARY: weights['file_summary'],
+            FIELD_CONTENT: weights['content'],
+        }
+
+        # コーパス全体の文書数とフィールドごとの平均文書長
+        stats = db.session.query(
+            func.count(SEARCHDOCS.study_id),
+            func.avg(SEARCHDOCS.name_length),
+            func.avg(SEARCHDOCS.summary_length),
+            func.avg(SEARCHDOCS.file_summary_length),
+            func.avg(SEARCHDOCS.content_length)
+        ).one()
+        total_docs = stats[0] or 0
+        average_lengths = {
+            FIELD_NAME: float(stats[1] or 0) or 1,
+            FIELD_SUMMARY: float(stats[2] or 0) or 1,
+            FIELD_FILE_SUMMARY: float(stats[3] or 0) or 1,
+            FIELD_CONTENT: float(stats[4] or 0) or 1,
+        }
+        field_lengths = {
+            FIELD_NAME: SEARCHDOCS.name_length,
+            FIELD_SUMMARY: SEARCHDOCS.summary_length,
+            FIELD_FILE_SUMMARY: SEARCHDOCS.file_summary_length,
+            FIELD_CONTENT: SEARCHDOCS.content_length,
+        }
+
+        # 検索語のN-gramごとの文書頻度からIDFを求める(N-gramの数だけの行しか返らない)
+        idf = {}
+        for gram, df in db.session.query(NGRAMS.gram, func.count(func.distinct(NGRAMS.study_id))).filter(NGRAMS.gram.in_(grams)).group_by(NGRAMS.gram):
+            idf[gram] = math.log(1 + (total_docs - df + 0.5) / (df + 0.5))
+        if not idf:
+            return None
+
+        # BM25F: フィールドごとに文書長で正規化して重み付けしたTFを合算してから飽和させる
+        # 計算はデータベースで行い、候補の研究に限って{研究ID, スコア}のサブクエリを返す
+        normalized_tf = NGRAMS.tf * case(
+            *[
+                (NGRAMS.field == field, field_weights[field] / (1 - BM25_B + BM25_B * field_lengths[field] / average_lengths[field]))
+                for field in field_weights
+            ],
+            else_=0
+        )
+        per_gram = (
+            select(NGRAMS.study_id.label('study_id'), NGRAMS.gram.label('gram'), func.sum(normalized_tf).label('tf'))
+            .join(SEARCHDOCS, SEARCHDOCS.study_id == NGRAMS.study_id)
+            .where(NGRAMS.gram.in_(sorted(idf)))
+            .group_by(NGRAMS.study_id, NGRAMS.gram)
+        )
+        if candidates is not None:
+            per_gram = per_gram.where(NGRAMS.study_id.in_(candidates))
+        per_gram = per_gram.subquery()
+
+        gram_idf = case(idf, value=per_gram.c.gram, else_=0)
+        return (
+            select(per_gram.c.study_id.label('study_id'), func.sum(gram_idf * per_gram.c.tf / (BM25_K1 + per_gram.c.tf)).label('score'))
+            .group_by(per_gram.c.study_id)
+            .subquery()
+        )
+
+    def update_study(self, study_id):
+        self.delete_rows(study_id)
+
+        study = STUDIES.query.filter(STUDIES.id==study_id).one_or_none()
+        if study is None:
+            db.session.commit()
+            return
+
+        files = FILES.query.options(undefer(FILES.content)).filter(FILES.study_id==study_id).all()
+        fields = {
+            FIELD_NAME: tokenize(study.name),
+            # 研究の概要はMarkdownで入力される(summaryカラムは使われていない)
+            FIELD_SUMMARY: tokenize(study.raw_markdown),
+            FIELD_FILE_SUMMARY: [gram for file in files for gram in tokenize(file.summary)],
+            FIELD_CONTENT: [gram for file in files for gram in tokenize(file.content)],
+        }
+
+        rows = []
+        for field, grams in fields.items():
+            for gram, tf in Counter(grams).items():
+                rows.append({'gram': gram, 'study_id': study_id, 'field': field, 'tf': tf})
+        if rows:
+            db.session.execute(NGRAMS.__table__.insert(), rows)
+
+        db.session.add(SEARCHDOCS(
+            study_id=study_id,
+            indexed_at=datetime.now(),
+            name_length=len(fields[FIELD_NAME]),
+            summary_length=len(fields[FIELD_SUMMARY]),
+            file_summary_length=len(fields[FIELD_FILE_SUMMARY]),
+            content_length=len(fields[FIELD_CONTENT])
+        ))
+        db.session.commit()
+
+    def remove_study(self, study_id):
+        self.delete_rows(study_id)
+        db.session.commit()
+
+    def delete_rows(self, study_id):
+        NGRAMS.query.filter(NGRAMS.study_id==study_id).delete()
+        SEARCHDOCS.query.filter(SEARCHDOCS.study_id==study_id).delete()
+
+    def rebuild(self):
+        NGRAMS.query.delete()
+        SEARCHDOCS.query.delete()
+        db.session.commit()
+        for (study_id,) in db.session.query(STUDIES.id).all():
+            self.update_study(study_id)
+
+
+engines = {
+    SearchIndex.name: SearchIndex,
+    NgramIndex.name: NgramIndex,
+}
+
+# 設定ファイルで指定された検索エンジンを返す
+def get_search_index():
+    config = config_watcher.get_config()
+    search_config = config.get('Search') or {}
+    engine = search_config.get('engine', NgramIndex.name)
+    if engine == 'native':
+        # 使用しているデータベースの全文検索機能を使う
+        from dbapp.search.native import SQLiteFTSIndex, MySQLFulltextIndex
+        return SQLiteFTSIndex() if config['database'] == 'SQLite' else MySQLFulltextIndex()
+    return engines.get(engine, NgramIndex)()
@@ -0,0 +1,240 @@
+from sqlalchemy import select, union, union_all, func, literal_column, table, column, text
+from sqlalchemy.dialects.mysql import match
+from dbapp import db
+from dbapp.models.tables import STUDIES, FILES
+from dbapp.search.index import SearchIndex, DEFAULT_WEIGHTS, normalize
+
+# SQLite FTS5のtrigramトークナイザで検索できる最短の長さ
+TRIGRAM_SIZE = 3
+
+# MySQLのngramパーサのトークン長(ngram_token_sizeの既定値)
+MYSQL_NGRAM_SIZE = 2
+
+# 研究ごとにタイトル・概要・ファイル概要・本文を1行にまとめた全文検索用テーブル
+# 行番号は研究IDとの対応表で固定する(INTEGER PRIMARY KEYはVACUUMで振り直されない)
+# マイグレーションと起動時の作成はどちらもここで定義したSQLを使う
+SQLITE_FTS_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS studies_fts_keys ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, study_id VARCHAR(26) NOT NULL UNIQUE)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS studies_fts USING fts5("
+    "study_id UNINDEXED, name, summary, file_summary, content, tokenize='trigram')",
+]
+
+# 研究の概要はMarkdownで入力される(summaryカラムは使われていない)
+def sqlite_document_select(where):
+    return (
+        "INSERT INTO studies_fts(rowid, study_id, name, summary, file_summary, content) "
+        "SELECT k.id, s.id, s.name, s.raw_markdown, "
+        "(SELECT group_concat(f.summary, ' ') FROM files f WHERE f.study_id = s.id), "
+        "(SELECT group_concat(f.content, ' ') FROM files f WHERE f.study_id = s.id) "
+        f"FROM studies s JOIN studies_fts_keys k ON k.study_id = s.id{where};"
+    )
+
+def sqlite_refresh_statements(study_id):
+    return [
+        f"INSERT OR IGNORE INTO studies_fts_keys(study_id) SELECT id FROM studies WHERE id = {study_id};",
+        f"DELETE FROM studies_fts WHERE rowid = (SELECT id FROM studies_fts_keys WHERE study_id = {study_id});",
+        sqlite_document_select(f" WHERE s.id = {study_id}"),
+    ]
+
+SQLITE_FTS_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS studies_fts_ai AFTER INSERT ON studies BEGIN "
+    + " ".join(sqlite_refresh_statements('NEW.id')) + " END",
+    "CREATE TRIGGER IF NOT EXISTS studies_fts_au AFTER UPDATE OF name, raw_markdown ON studies BEGIN "
+    + " ".join(sqlite_refresh_statements('NEW.id')) + " END",
+    "CREATE TRIGGER IF NOT EXISTS studies_fts_ad AFTER DELETE ON studies BEGIN "
+    "DELETE FROM studies_fts WHERE rowid = (SELECT id FROM studies_fts_keys WHERE study_id = OLD.id); "
+    "DELETE FROM studies_fts_keys WHERE study_id = OLD.id; END",
+    "CREATE TRIGGER IF NOT EXISTS files_fts_ai AFTER INSERT ON files BEGIN "
+    + " ".join(sqlite_refresh_statements('NEW.study_id')) + " END",
+    "CREATE TRIGGER IF NOT EXISTS files_fts_au AFTER UPDATE OF summary, content, study_id ON files BEGIN "
+    + " ".join(sqlite_refresh_statements('OLD.study_id')) + " "
+    + " ".join(sqlite_refresh_statements('NEW.study_id')) + " END",
+    "CREATE TRIGGER IF NOT EXISTS files_fts_ad AFTER DELETE ON files BEGIN "
+    + " ".join(sqlite_refresh_statements('OLD.study_id')) + " END",
+]
+
+# 既存の研究をすべて登録し直す
+SQLITE_FTS_FILL = [
+    "DELETE FROM studies_fts",
+    "DELETE FROM studies_fts_keys WHERE study_id NOT IN (SELECT id FROM studies)",
+    "INSERT OR IGNORE INTO studies_fts_keys(study_id) SELECT id FROM studies",
+    sqlite_document_select(''),
+]
+
+SQLITE_FTS_DROP_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS files_fts_ad",
+    "DROP TRIGGER IF EXISTS files_fts_au",
+    "DROP TRIGGER IF EXISTS files_fts_ai",
+    "DROP TRIGGER IF EXISTS studies_fts_ad",
+    "DROP TRIGGER IF EXISTS studies_fts_au",
+    "DROP TRIGGER IF EXISTS studies_fts_ai",
+]
+
+SQLITE_FTS_DROP = SQLITE_FTS_DROP_TRIGGERS + [
+    "DROP TABLE IF EXISTS studies_fts",
+    "DROP TABLE IF EXISTS studies_fts_keys",
+]
+
+# 全文検索用のテーブルとトリガーを作り直して登録する(connectionはセッションか接続)
+def create_sqlite_fts(connection):
+    for statement in SQLITE_FTS_DROP + SQLITE_FTS_SCHEMA + SQLITE_FTS_TRIGGERS + SQLITE_FTS_FILL:
+        connection.execute(text(statement))
+
+def drop_sqlite_fts(connection):
+    for statement in SQLITE_FTS_DROP:
+        connection.execute(text(statement))
+
+# batch_alter_tableでstudies・filesを作り直す間はトリガーを外す(作り直し後に登録し直す)
+def drop_sqlite_fts_triggers(connection):
+    for statement in SQLITE_FTS_DROP_TRIGGERS:
+        connection.execute(text(statement))
+
+def refill_sqlite_fts(connection):
+    for statement in SQLITE_FTS_TRIGGERS + SQLITE_FTS_FILL:
+        connection.execute(text(statement))
+
+# MySQLのFULLTEXTインデックス(マイグレーションで作成する)
+MYSQL_FULLTEXT_INDEXES = {
+    'ft_studies_text': ('studies', 'name, raw_markdown'),
+    'ft_files_text': ('files', 'summary, content'),
+}
+
+# MATCHは列の組み合わせが一致するインデックスが必要なため、フィールドごとの関連度には列ごとのインデックスを使う
+MYSQL_FIELD_INDEXES = {
+    'ft_studies_name': ('studies', 'name'),
+    'ft_studies_summary': ('studies', 'raw_markdown'),
+    'ft_files_summary': ('files', 'summary'),
+    'ft_files_content': ('files', 'content'),
+}
+
+# プロセスごとにテーブルの有無を1回だけ確認する
+fts_ready = False
+
+studies_fts = table('studies_fts', column('study_id'))
+
+# FTS5のクエリ構文として解釈されないようにフレーズとして囲む
+def fts_phrase(word):
+    return '"' + word.replace('"', '""') + '"'
+
+
+class SQLiteFTSIndex(SearchIndex):
+    # SQLiteのFTS5仮想テーブル(trigram)を使う全文検索
+    name = 'sqlite_fts'
+
+    def searchable_words(self, words):
+        return [word for word in words if len(normalize(word)) >= TRIGRAM_SIZE]
+
+    def ensure_table(self):
+        # db.create_all()で作られたデータベースには仮想テーブルがないため、最初の検索時に作成する
+        global fts_ready
+        if fts_ready:
+            return
+        with db.engine.begin() as connection:
+            exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'studies_fts_keys'")).first()
+            if exists is None:
+                create_sqlite_fts(connection)
+        fts_ready = True
+
+    def candidates(self, words):
+        self.ensure_table()
+        # 3文字未満の語はtrigramで検索できないため全件を照合する
+        return [
+            select(studies_fts.c.study_id).where(literal_column('studies_fts').op('MATCH')(fts_phrase(word)))
+            for word in self.searchable_words(words)
+        ]
+
+    def scores(self, words, weights=None, candidates=None):
+        words = self.searchable_words(words)
+        if not words:
+            return None
+        self.ensure_table()
+
+        weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        # bm25()は値が小さいほど関連度が高いので符号を反転する
+        rank = func.bm25(
+            literal_column('studies_fts'),
+            0,
+            weights['name'],
+            weights['summary'],
+            weights['file_summary'],
+            weights['content']
+        )
+        scores = select(studies_fts.c.study_id.label('study_id'), (-rank).label('score')).where(
+            literal_column('studies_fts').op('MATCH')(' OR '.join(fts_phrase(word) for word in words))
+        )
+        if candidates is not None:
+            scores = scores.where(studies_fts.c.study_id.in_(candidates))
+        return scores.subquery()
+
+    def rebuild(self):
+        global fts_ready
+        create_sqlite_fts(db.session)
+        db.session.commit()
+        fts_ready = True
+
+
+class MySQLFulltextIndex(SearchIndex):
+    # MySQLのngramパーサを使うFULLTEXTインデックスによる全文検索
+    # インデックスはInnoDBが更新するため、update_studyやrebuildでは何もしない
+    name = 'mysql_fulltext'
+
+    def searchable_words(self, words):
+        return [word for word in words if len(normalize(word)) >= MYSQL_NGRAM_SIZE]
+
+    def ensure_table(self):
+        # インデックスがないとMATCHが分かりにくいエラーになるため、最初の検索時に確認する
+        global fts_ready
+        if fts_ready:
+            return
+        indexes = set(name for (name,) in db.session.execute(text(
+            "SELECT DISTINCT index_name FROM information_schema.statistics "
+            "WHERE table_schema = DATABASE() AND index_type = 'FULLTEXT'"
+        )))
+        missing = (set(MYSQL_FULLTEXT_INDEXES) | set(MYSQL_FIELD_INDEXES)) - indexes
+        if missing:
+            raise Exception(f"全文検索用のインデックス({', '.join(sorted(missing))})がありません。flask db upgradeを実行してください")
+        fts_ready = True
+
+    def study_match(self, word):
+        return match(STUDIES.name, STUDIES.raw_markdown, against=fts_phrase(word)).in_boolean_mode()
+
+    def file_match(self, word):
+        return match(FILES.summary, FILES.content, against=fts_phrase(word)).in_boolean_mode()
+
+    def candidates(self, words):
+        self.ensure_table()
+        return [
+            union(
+                select(STUDIES.id).where(self.study_match(word)),
+                select(FILES.study_id).where(self.file_match(word))
+            )
+            for word in self.searchable_words(words)
+        ]
+
+    def scores(self, words, weights=None, candidates=None):
+        words = self.searchable_words(words)
+        if not words:
+            return None
+
+        self.ensure_table()
+
+        weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        against = ' '.join(fts_phrase(word) for word in words)
+        def relevance(column):
+            return match(column, against=against).in_boolean_mode()
+
+        # 絞り込みは2列のインデックスで行い、関連度はフィールドごとに重みを掛けて合計する
+        study_relevance = weights['name'] * relevance(STUDIES.name) + weights['summary'] * relevance(STUDIES.raw_markdown)
+        file_relevance = weights['file_summary'] * relevance(FILES.summary) + weights['content'] * relevance(FILES.content)
+        study_scores = select(STUDIES.id.label('study_id'), study_relevance.label('score')).where(match(STUDIES.name, STUDIES.raw_markdown, against=against).in_boolean_mode())
+        file_scores = select(FILES.study_id.label('study_id'), file_relevance.label('score')).where(match(FILES.summary, FILES.content, against=against).in_boolean_mode())
+        if candidates is not None:
+            study_scores = study_scores.where(STUDIES.id.in_(candidates))
+            file_scores = file_scores.where(FILES.study_id.in_(candidates))
+        relevance = union_all(study_scores, file_scores).subquery()
+        return (
+            select(relevance.c.study_id.label('study_id'), func.sum(relevance.c.score).label('score'))
+            .group_by(relevance.c.study_id)
+            .subquery()
+        )
@@ -0,0 +1,196 @@
+import sys
+import time
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from flask import request
+from redis.exceptions import RedisError, WatchError
+from dbapp import app, db, config_watcher
+from dbapp.models.tables import STUDIES, FILES
+from dbapp.search.index import get_search_index
+from dbapp.search.cache import invalidate_search_cache
+from dbapp.search.related import mark_related_dirty
+
+# 索引の更新を待つ研究ID(スコアは最初に登録された時刻)
+QUEUE_KEY = 'search:queue'
+# ワーカーが取り出して処理中の研究ID(異常終了した場合はrecover_queueでキューに戻す)
+PROCESSING_KEY = 'search:processing'
+# 最後に索引へ反映した時刻
+APPLIED_KEY = 'search:applied_at'
+
+# 閲覧数の集計など検索結果に影響しない列
+IGNORED_COLUMNS = {
+    STUDIES: {'total_access_count', 'total_preview_count'},
+    FILES: {'access_count', 'preview_count'},
+}
+
+def pipeline_config():
+    index_queue = config_watcher.get_config().get('IndexQueue') or {}
+    return {
+        # Trueの場合は変更を伴うリクエストの応答後に反映する(ワーカーを常駐させる場合はFalseにする)
+        'inline': index_queue.get('inline', True),
+        'batch': int(index_queue.get('batch', 50)),
+        'interval': float(index_queue.get('interval', 1)),
+    }
+
+def get_redis():
+    return app.config['SESSION_REDIS']
+
+# 検索対象の列が変更されたかどうか
+def has_search_changes(obj):
+    state = inspect(obj)
+    ignored = IGNORED_COLUMNS[type(obj)]
+    for attr in state.mapper.column_attrs:
+        if attr.key not in ignored and state.attrs[attr.key].history.has_changes():
+            return True
+    return False
+
+# フラッシュ時に変更された研究のIDをセッションに記録する
+@event.listens_for(Session, 'after_flush')
+def collect_index_changes(session, flush_context):
+    changes = session.info.setdefault('index_changes', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, STUDIES):
+            if obj in session.dirty and not has_search_changes(obj):
+                continue
+            changes.add(obj.id)
+        elif isinstance(obj, FILES):
+            if obj in session.dirty and not has_search_changes(obj):
+                continue
+            # ファイルを別の研究に移した場合は移動前の研究も更新する
+            changes.update(study_id for study_id in inspect(obj).attrs.study_id.history.sum() if study_id)
+
+# コミットされた変更だけをキューに登録する
+@event.listens_for(Session, 'after_commit')
+def enqueue_index_changes(session):
+    changes = session.info.pop('index_changes', set())
+    if not changes:
+        return
+    enqueue(changes)
+    invalidate_search_cache()
+    for study_id in changes:
+        mark_related_dirty(study_id)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_index_changes(session):
+    session.info.pop('index_changes', None)
+
+def enqueue(study_ids):
+    now = time.time()
+    try:
+        # 同じ研究が続けて変更された場合は1件にまとめ、最初の登録時刻を残す
+        get_redis().zadd(QUEUE_KEY, {study_id: now for study_id in study_ids}, nx=True)
+    except RedisError:
+        pass
+
+# キューの先頭から最大limit件を処理中に移して返す(他のプロセスと同時に取り出さないようにする)
+def claim(redis, limit):
+    with redis.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(QUEUE_KEY)
+                items = pipe.zrange(QUEUE_KEY, 0, limit - 1, withscores=True)
+                if not items:
+                    pipe.unwatch()
+                    return []
+                pipe.multi()
+                pipe.zrem(QUEUE_KEY, *[study_id for study_id, enqueued_at in items])
+                pipe.zadd(PROCESSING_KEY, dict(items))
+                pipe.execute()
+                return items
+            except WatchError:
+                continue
+
+# 処理中の研究をキューに戻す(処理中に再登録されたものは新しい時刻を優先しない)
+def requeue(redis, items):
+    if not items:
+        return
+    pipe = redis.pipeline()
+    pipe.zadd(QUEUE_KEY, dict(items), nx=True)
+    pipe.zrem(PROCESSING_KEY, *[study_id for study_id, enqueued_at in items])
+    pipe.execute()
+
+# 異常終了したワーカーが処理していた研究をキューに戻す
+def recover_queue():
+    redis = get_redis()
+    requeue(redis, redis.zrange(PROCESSING_KEY, 0, -1, withscores=True))
+
+# キューから取り出した研究の索引を更新し、処理した件数を返す
+def process_queue(limit=None):
+    redis = get_redis()
+    limit = limit or pipeline_config()['batch']
+    items = claim(redis, limit)
+    if not items:
+        return 0
+
+    index = get_search_index()
+    processed = 0
+    try:
+        for study_id, enqueued_at in items:
+            index.update_study(study_id.decode())
+            redis.zrem(PROCESSING_KEY, study_id)
+            processed += 1
+    except Exception:
+        db.session.rollback()
+        requeue(redis, items[processed:])
+        raise
+    finally:
+        if processed:
+            redis.set(APPLIED_KEY, time.time())
+            # 索引の更新前に保存された検索結果を破棄する
+            invalidate_search_cache()
+    return processed
+
+# 索引の遅れ(未反映の件数と最も古い変更からの経過秒数)を返す
+def index_lag():
+    redis = get_redis()
+    pending = redis.zcard(QUEUE_KEY) + redis.zcard(PROCESSING_KEY)
+    oldest = [score for key in [QUEUE_KEY, PROCESSING_KEY] for study_id, score in redis.zrange(key, 0, 0, withscores=True)]
+    applied_at = redis.get(APPLIED_KEY)
+    now = time.time()
+    return {
+        'engine': get_search_index().name,
+        'pending': pending,
+        'lag_seconds': round(now - min(oldest), 3) if oldest else 0,
+        'last_applied_at': float(applied_at) if applied_at else None,
+    }
+
+# ワーカーを使わない構成では、変更を伴うリクエストの応答を送り終えてからキューを処理する
+MUTATING_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+def process_queue_after_response():
+    with app.app_context():
+        try:
+            process_queue()
+        except Exception as e:
+            sys.stderr.write(f'Search index update failed: {e}\n')
+
+@app.after_request
+def process_queue_inline(response):
+    if request.method in MUTATING_METHODS and pipeline_config()['inline']:
+        response.call_on_close(process_queue_after_response)
+    return response
+
+def run_worker():
+    while True:
+        config = pipeline_config()
+        try:
+            processed = process_queue(config['batch'])
+        except Exception as e:
+            sys.stderr.write(f'Search index update failed: {e}\n')
+            processed = 0
+        db.session.remove()
+        if not processed:
+            time.sleep(config['interval'])
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    arg = ArgumentParser()
+
+    arg.add_argument('-r', '--recover', action='store_true', help='処理中のまま残っている研究をキューに戻す')
+
+    args = arg.parse_args()
+    with app.app_context():
+        if args.recover:
+            recover_queue()
+        run_worker()
@@ -0,0 +1,176 @@
+import json
+import os
+from collections import Counter
+import numpy as np
+from scipy import sparse
+from sqlalchemy.orm import undefer
+from redis.exceptions import RedisError
+from dbapp import app, db, config_watcher
+from dbapp.models.tables import STUDIES, FILES, RELATEDSTUDIES, FILE_READY
+from dbapp.search.index import tokenize
+
+DIRTY_KEY = 'related:dirty'
+
+def related_config():
+    related = config_watcher.get_config().get('Related') or {}
+    return {
+        'top_k': int(related.get('top_k', 5)),
+        'cache_dir': related.get('cache_dir') or os.path.join(app.config['UPLOAD_FOLDER'], '.related'),
+    }
+
+# 研究の変更を記録し、次回のジョブで近傍を更新する
+def mark_related_dirty(study_id):
+    try:
+        app.config['SESSION_REDIS'].sadd(DIRTY_KEY, study_id)
+    except RedisError:
+        pass
+
+def take_dirty():
+    redis = app.config['SESSION_REDIS']
+    dirty = [study_id.decode() for study_id in redis.smembers(DIRTY_KEY)]
+    if dirty:
+        redis.srem(DIRTY_KEY, *dirty)
+    return dirty
+
+# 研究のタイトル・Markdownの概要・公開中のファイルの概要と本文からN-gramの出現回数を数える
+def study_counts(study):
+    grams = tokenize(study.name) + tokenize(study.raw_markdown)
+    files = FILES.query.options(undefer(FILES.content)).filter(FILES.study_id==study.id, FILES.grave_data==False, FILES.status==FILE_READY).all()
+    for file in files:
+        grams += tokenize(file.summary) + tokenize(file.content)
+    return Counter(grams)
+
+def counts_matrix(counters, vocabulary):
+    rows, cols, values = [], [], []
+    for row, counter in enumerate(counters):
+        for gram, count in counter.items():
+            col = vocabulary.setdefault(gram, len(vocabulary))
+            rows.append(row)
+            cols.append(col)
+            values.append(count)
+    return sparse.csr_matrix((values, (rows, cols)), shape=(len(counters), len(vocabulary)), dtype=np.float64)
+
+# 出現回数の行列から行ごとにL2正規化したTF-IDF行列を作る
+def tfidf(counts):
+    documents = counts.shape[0]
+    df = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = np.log((1 + documents) / (1 + df)) + 1
+    weights = counts.copy()
+    weights.data = 1 + np.log(weights.data)
+    weights = sparse.csr_matrix(weights.multiply(idf))
+    norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms) @ weights
+
+# 指定した行について自分以外で類似度の高い上位k件を返す
+def nearest(vectors, rows, ids, top_k, chunk=256):
+    neighbours = {}
+    for start in range(0, len(rows), chunk):
+        chunk_rows = rows[start:start + chunk]
+        similarities = (vectors[chunk_rows] @ vectors.T).toarray()
+        for i, row in enumerate(chunk_rows):
+            similarities[i, row] = 0
+            candidates = np.argsort(-similarities[i])[:top_k]
+            neighbours[ids[row]] = [(ids[col], float(similarities[i, col])) for col in candidates if similarities[i, col] > 0]
+    return neighbours
+
+def save_neighbours(neighbours):
+    if not neighbours:
+        return
+    RELATEDSTUDIES.query.filter(RELATEDSTUDIES.study_id.in_(list(neighbours.keys()))).delete(synchronize_session=False)
+    rows = [
+        {'study_id': study_id, 'related_id': related_id, 'rank': rank, 'score': score}
+        for study_id, related in neighbours.items()
+        for rank, (related_id, score) in enumerate(related)
+    ]
+    if rows:
+        db.session.execute(RELATEDSTUDIES.__table__.insert(), rows)
+
+def save_cache(cache_dir, counts, ids, vocabulary):
+    os.makedirs(cache_dir, exist_ok=True)
+    sparse.save_npz(os.path.join(cache_dir, 'counts.npz'), counts)
+    with open(os.path.join(cache_dir, 'meta.json'), 'w', encoding='utf8') as f:
+        json.dump({'ids': ids, 'vocabulary': vocabulary}, f, ensure_ascii=False)
+
+def load_cache(cache_dir):
+    try:
+        counts = sparse.load_npz(os.path.join(cache_dir, 'counts.npz')).tocsr()
+        with open(os.path.join(cache_dir, 'meta.json'), encoding='utf8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return counts, meta['ids'], meta['vocabulary']
+
+# 保存済みの近傍と順位・類似度が同じかを返す
+def same_neighbours(related, stored, tolerance=1e-9):
+    if [related_id for related_id, score in related] != [related_id for related_id, score in stored]:
+        return False
+    return all(abs(score - stored_score) <= tolerance for (related_id, score), (stored_id, stored_score) in zip(related, stored))
+
+# すべての研究のベクトルを作り直して近傍を計算する
+def build_related():
+    config = related_config()
+    take_dirty()
+
+    studies = STUDIES.query.filter(STUDIES.grave_data==False).all()
+    ids = [study.id for study in studies]
+    vocabulary = {}
+    counts = counts_matrix([study_counts(study) for study in studies], vocabulary)
+    save_cache(config['cache_dir'], counts, ids, vocabulary)
+
+    neighbours = nearest(tfidf(counts), list(range(len(ids))), ids, config['top_k']) if ids else {}
+    RELATEDSTUDIES.query.delete()
+    save_neighbours(neighbours)
+    db.session.commit()
+
+# 変更された研究の出現回数だけを数え直し、近傍が変わった研究を更新する
+def update_related():
+    config = related_config()
+    cache = load_cache(config['cache_dir'])
+    if cache is None:
+        return build_related()
+    counts, ids, vocabulary = cache
+
+    dirty = set(take_dirty())
+    if not dirty:
+        return
+
+    # 変更された研究の行を取り除き、公開中のものは数え直して末尾に追加する
+    keep_rows = [row for row, study_id in enumerate(ids) if study_id not in dirty]
+    visible = STUDIES.query.filter(STUDIES.id.in_(list(dirty)), STUDIES.grave_data==False).all()
+    new_counts = counts_matrix([study_counts(study) for study in visible], vocabulary)
+    counts = counts[keep_rows]
+    counts.resize((counts.shape[0], len(vocabulary)))
+    counts = sparse.vstack([counts, new_counts]).tocsr()
+    ids = [ids[row] for row in keep_rows] + [study.id for study in visible]
+    save_cache(config['cache_dir'], counts, ids, vocabulary)
+
+    # IDFは全体の文書頻度で変わるため、近傍はすべての研究について現在の行列で求め直す
+    # (時間のかかるN-gramの数え直しは変更された研究だけで済む)
+    neighbours = nearest(tfidf(counts), list(range(len(ids))), ids, config['top_k']) if ids else {}
+
+    existing = {}
+    for relation in RELATEDSTUDIES.query.order_by(RELATEDSTUDIES.study_id, RELATEDSTUDIES.rank).all():
+        existing.setdefault(relation.study_id, []).append((relation.related_id, relation.score))
+
+    # 近傍が変わった研究だけを書き換え、非公開・削除された研究の近傍は削除する
+    changed = {study_id: related for study_id, related in neighbours.items() if not same_neighbours(related, existing.get(study_id, []))}
+    removed = [study_id for study_id in existing if study_id not in neighbours]
+    if removed:
+        RELATEDSTUDIES.query.filter(RELATEDSTUDIES.study_id.in_(removed)).delete(synchronize_session=False)
+    save_neighbours(changed)
+    db.session.commit()
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    arg = ArgumentParser()
+
+    arg.add_argument('-f', '--full', action='store_true', help='すべての研究の近傍を作り直す')
+
+    args = arg.parse_args()
+    with app.app_context():
+        if args.full:
+            build_related()
+        else:
+            update_related()
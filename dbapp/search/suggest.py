@@ -0,0 +1,141 @@
+import heapq
+import threading
+import time
+from bisect import bisect_left, insort
+from itertools import islice
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from dbapp import config_watcher
+from dbapp.models.tables import TAGS, STUDIES
+from dbapp.search.index import normalize
+
+SUGGEST_KINDS = ['tag', 'study']
+
+# タグ名と研究タイトルの前方一致検索に使うソート済み配列(種類ごとに分ける)
+class Suggester:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = {kind: [] for kind in SUGGEST_KINDS}
+        self.entries = {}
+        self.built_at = None
+
+    def refresh_interval(self):
+        suggest_config = config_watcher.get_config().get('Suggest') or {}
+        return int(suggest_config.get('refresh', 600))
+
+    def rebuild(self):
+        keys = {kind: [] for kind in SUGGEST_KINDS}
+        entries = {}
+        for tag in TAGS.query.with_entities(TAGS.id, TAGS.name).all():
+            key = (normalize(tag.name), tag.id)
+            keys['tag'].append(key)
+            entries[('tag', tag.id)] = (key, tag.name)
+        for study in STUDIES.query.with_entities(STUDIES.id, STUDIES.name).filter(STUDIES.grave_data==False).all():
+            key = (normalize(study.name), study.id)
+            keys['study'].append(key)
+            entries[('study', study.id)] = (key, study.name)
+        for kind_keys in keys.values():
+            kind_keys.sort()
+
+        with self.lock:
+            self.keys = keys
+            self.entries = entries
+            self.built_at = time.monotonic()
+
+    def ensure_fresh(self):
+        # 他のワーカープロセスでの変更は定期的な再構築で取り込む
+        if self.built_at is None or time.monotonic() - self.built_at > self.refresh_interval():
+            self.rebuild()
+
+    def put(self, kind, id, name):
+        if name is None:
+            return
+        with self.lock:
+            self.discard_locked(kind, id)
+            key = (normalize(name), id)
+            insort(self.keys[kind], key)
+            self.entries[(kind, id)] = (key, name)
+
+    def discard(self, kind, id):
+        with self.lock:
+            self.discard_locked(kind, id)
+
+    def discard_locked(self, kind, id):
+        entry = self.entries.pop((kind, id), None)
+        if entry is None:
+            return
+        keys = self.keys[kind]
+        index = bisect_left(keys, entry[0])
+        if index < len(keys) and keys[index] == entry[0]:
+            del keys[index]
+
+    # 1種類の配列から前方一致する候補を最大limit件取り出す
+    def search_kind(self, kind, prefix, limit):
+        keys = self.keys[kind]
+        results = []
+        index = bisect_left(keys, (prefix,))
+        while index < len(keys) and len(results) < limit:
+            key = keys[index]
+            if not key[0].startswith(prefix):
+                break
+            results.append((key, kind))
+            index += 1
+        return results
+
+    def search(self, prefix, limit=10, kind=None):
+        self.ensure_fresh()
+        prefix = normalize(prefix).strip()
+        if not prefix:
+            return []
+
+        kinds = [kind] if kind is not None else SUGGEST_KINDS
+        with self.lock:
+            # 種類を指定しない場合は種類ごとの候補を名前順に合わせる
+            matches = heapq.merge(*[self.search_kind(name, prefix, limit) for name in kinds if name in self.keys])
+            return [
+                {'id': key[1], 'name': self.entries[(kind, key[1])][1], 'kind': kind}
+                for key, kind in islice(matches, limit)
+            ]
+
+suggester = Suggester()
+
+# 候補に関係するカラムが変更されたかを返す(閲覧数や更新日時だけの変更では配列を更新しない)
+def has_suggest_changes(obj, keys):
+    state = inspect(obj)
+    return any(state.attrs[key].history.has_changes() for key in keys)
+
+# コミットされた変更だけを候補に反映するため、フラッシュ時の変更をセッションに記録する
+@event.listens_for(Session, 'after_flush')
+def collect_suggest_changes(session, flush_context):
+    changes = session.info.setdefault('suggest_changes', [])
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, TAGS):
+            if obj in session.new or has_suggest_changes(obj, ['name']):
+                changes.append(('put', 'tag', obj.id, obj.name))
+        elif isinstance(obj, STUDIES):
+            if obj in session.dirty and not has_suggest_changes(obj, ['name', 'grave_data']):
+                continue
+            if obj.grave_data:
+                changes.append(('discard', 'study', obj.id, None))
+            else:
+                changes.append(('put', 'study', obj.id, obj.name))
+    for obj in session.deleted:
+        if isinstance(obj, TAGS):
+            changes.append(('discard', 'tag', obj.id, None))
+        elif isinstance(obj, STUDIES):
+            changes.append(('discard', 'study', obj.id, None))
+
+@event.listens_for(Session, 'after_commit')
+def apply_suggest_changes(session):
+    changes = session.info.pop('suggest_changes', [])
+    if suggester.built_at is None:
+        return
+    for action, kind, id, name in changes:
+        if action == 'put':
+            suggester.put(kind, id, name)
+        else:
+            suggester.discard(kind, id)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_suggest_changes(session):
+    session.info.pop('suggest_changes', None)
@@ -1,5 +1,5 @@
-from dbapp import db
-from dbapp.models.tables import FILES, STUDIES
+from dbapp import db, config_watcher
+from dbapp.models.tables import FILES, FILEPAGES, STUDIES, TAGS, STUDY_TAG, FILE_READY
 
 import markdown, bleach
 
@@ -30,10 +30,10 @@ def FilterStudyFiles(study, admin):
     # ファイルを更新日時の降順でソートする
     files = sorted(study.files, key=lambda file: file.create_at, reverse=True)
     if not admin:
-        # 削除されていないファイルのみを選択する
+        # 削除されておらず解析の終わったファイルのみを選択する
         selected_files = []
         for file in files:
-            if file.grave_data == False:
+            if file.grave_data == False and file.status == FILE_READY:
                 selected_files.append(file)
         # 研究オブジェクトのfiles属性を書き換える
         study.files = selected_files
@@ -53,7 +53,7 @@ def FilterStudiesHiddenFiles(studies, admin):
         # 削除されていない上位3ファイルのみを選択する
         selected_files = []
         for file in files:
-            if file.grave_data == False or admin:
+            if (file.grave_data == False and file.status == FILE_READY) or admin:
                 selected_files.append(file)
                 count += 1
                 if count == 4:
@@ -67,7 +67,21 @@ def FilterStudiesHiddenFiles(studies, admin):
 
 
 # SEARCH ENGIN
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, func, select, literal, cast, union_all, case, String
+from sqlalchemy.orm.attributes import set_committed_value
+from markupsafe import Markup, escape
+from dbapp.search.index import get_search_index
+from dbapp.search.cache import search_cache_key, current_generation, get_cached_result, store_result
+
+# 検索結果の1ページ分と総件数を保持する
+class SearchResult:
+    def __init__(self, items, total, page, per_page, title, facets=None):
+        self.items = items
+        self.total = total
+        self.page = page
+        self.per_page = per_page
+        self.title = title
+        self.facets = facets
 
 def SearchEngine(
         search_terms=None,
@@ -76,13 +90,44 @@ def SearchEngine(
         create_at_range=None,
         field=0,
         sort_column="update_at",
-        admin=False
+        admin=False,
+        page=1,
+        per_page=10,
+        pubyear=None,
+        filetype=None,
+        tag=None,
+        facets=False
     ):
-    # STUDIESとFILESのJOINを作成します。
-    query = db.session.query(STUDIES).outerjoin(FILES)
+    page = max(page, 1)
+
+    # 空の場合はタイトルを変えて返します。
+    title = '"' + search_terms + '"の検索結果' if search_terms else "研究一覧"
+
+    # 絞り込み候補の件数はページや並び順によらないため、検索条件だけで別にキャッシュします。
+    filters = dict(
+        update_at_range=update_at_range,
+        create_at_range=create_at_range,
+        field=field,
+        admin=admin,
+        pubyear=pubyear,
+        filetype=filetype,
+        tag=tag
+    )
+    cache_key = search_cache_key(search_terms, ascending=ascending, sort_column=sort_column, page=page, per_page=per_page, **filters)
+    facet_key = search_cache_key(search_terms, facets=True, **filters)
+
+    # 同じ条件の検索結果がキャッシュにあればそれを返します。
+    generation = current_generation()
+    cached = get_cached_result(cache_key, generation)
+    cached_facets = get_cached_result(facet_key, generation) if facets else None
+    if cached is not None and (not facets or cached_facets is not None):
+        return SearchResult(LoadCachedStudies(cached), cached['total'], page, per_page, title, cached_facets['facets'] if facets else None)
+
+    # FILESはJOINせずにEXISTSで照合し、研究の重複を避けます。
+    query = db.session.query(STUDIES)
 
     # 検索対象のカラムを定義します。
-    study_columns = [STUDIES.name, STUDIES.summary]
+    study_columns = [STUDIES.name, STUDIES.raw_markdown]
     file_columns = [FILES.summary, FILES.content]
 
     # 検索条件を準備します。
@@ -94,11 +139,16 @@ def SearchEngine(
         search_conditions = []
         for word in search_words:
             word_conditions = []
-            for column in study_columns + file_columns:
+            for column in study_columns:
                 word_conditions.append(column.ilike(f"%{word}%"))
+            word_conditions.append(STUDIES.files.any(or_(*[column.ilike(f"%{word}%") for column in file_columns])))
             search_conditions.append(or_(*word_conditions))
         search_filters.append(and_(*search_conditions))
 
+        # 転置インデックスで候補となる研究を先に絞り込みます。
+        for candidates in get_search_index().candidates(search_words):
+            search_filters.append(STUDIES.id.in_(candidates))
+
     if not admin:
         search_filters.append(STUDIES.grave_data == False)
 
@@ -117,36 +167,239 @@ def SearchEngine(
         # STUDIESのfieldの値
         search_filters.append(STUDIES.field == field)
 
+    # 非公開や解析中のファイルは管理者以外の絞り込みに使いません。
+    visible_file = and_(FILES.grave_data == False, FILES.status == FILE_READY) if not admin else True
+
+    if pubyear:
+        # FILESのpubyearの値
+        search_filters.append(STUDIES.files.any(and_(FILES.pubyear == pubyear, visible_file)))
+
+    if filetype:
+        # FILESのtypeの値
+        search_filters.append(STUDIES.files.any(and_(FILES.type == filetype, visible_file)))
+
+    if tag:
+        # タグのID
+        search_filters.append(STUDIES.tags.any(TAGS.id == tag))
+
     # 絞り込み条件を適用します。
     if search_filters:
         query = query.filter(and_(*search_filters))
 
-    # 並び替え条件を設定します。
-    if sort_column == 'update_at':
-        query = query.order_by(STUDIES.update_at.asc() if ascending else STUDIES.update_at.desc())
-    elif sort_column == 'get_total_access_count':
-        query = query.order_by(STUDIES.get_total_access_count().asc() if ascending else STUDIES.get_total_access_count().desc())
-    elif sort_column == 'get_total_preview_count':
-        query = query.order_by(STUDIES.get_total_preview_count().asc() if ascending else STUDIES.get_total_preview_count().desc())
-    else:
-        query = query.order_by(STUDIES.create_at.asc() if ascending else STUDIES.create_at.desc())
+    # 総件数はCOUNTで別に取得します。
+    total = query.order_by(None).count()
 
-    # 結果を返します。FILESオブジェクトも取得します。
-    studies = query.all()
+    # 絞り込み候補ごとの件数を1回のクエリで集計します。
+    facet_counts = None
+    if facets:
+        if cached_facets is not None:
+            facet_counts = cached_facets['facets']
+        else:
+            facet_counts = CountFacets(query, admin)
+            store_result(facet_key, {'facets': facet_counts}, generation)
 
-    filtered_studies = FilterStudiesHiddenFiles(studies, admin)
+    # 関連度順の場合は転置インデックスのスコアを絞り込み後の研究に限って計算します。
+    scores = None
+    if sort_column == 'relevance' and search_terms:
+        search_config = config_watcher.get_config().get('Search') or {}
+        scores = get_search_index().scores(search_words, search_config.get('weights'), query.order_by(None).with_entities(STUDIES.id))
 
-    # 空の場合はタイトルを変えて返します。
-    if not search_terms:
-        return [filtered_studies, "研究一覧"]
+    if scores is not None:
+        # 関連度は常に高い順に並べ、表示するページの研究のみを取得します。
+        query = query.outerjoin(scores, scores.c.study_id == STUDIES.id)
+        query = query.order_by(func.coalesce(scores.c.score, 0).desc(), STUDIES.id.asc())
+        studies = query.limit(per_page).offset((page - 1) * per_page).all()
 
-    # FILESオブジェクトを取得します。
-    for study in studies:
-        study.files = db.session.query(FILES).filter(FILES.study_id==study.id, or_(*[or_(FILES.summary.contains(f"%{term}%"), FILES.content.contains(f"%{term}%")) for term in search_words])).all()
+    else:
+        # 並び替え条件を設定します。同じ値の研究はIDで順序を固定します。
+        if sort_column == 'update_at':
+            query = query.order_by(STUDIES.update_at.asc() if ascending else STUDIES.update_at.desc())
+        elif sort_column in ('access_count', 'get_total_access_count'):
+            query = query.order_by(STUDIES.total_access_count.asc() if ascending else STUDIES.total_access_count.desc())
+        elif sort_column in ('preview_count', 'get_total_preview_count'):
+            query = query.order_by(STUDIES.total_preview_count.asc() if ascending else STUDIES.total_preview_count.desc())
+        else:
+            query = query.order_by(STUDIES.create_at.asc() if ascending else STUDIES.create_at.desc())
+        query = query.order_by(STUDIES.id.asc() if ascending else STUDIES.id.desc())
+
+        # 表示するページの研究のみを取得します。
+        studies = query.limit(per_page).offset((page - 1) * per_page).all()
+
+    # 検索語に一致したFILESオブジェクトを一括で取得します。
+    filtered_studies = FetchMatchedFiles(studies, search_words if search_terms else None, admin)
+
+    store_result(cache_key, {
+        'total': total,
+        'studies': [study.id for study in filtered_studies],
+        'files': {study.id: [file.id for file in study.files] for study in filtered_studies},
+        'snippets': {file.id: file.snippet_text for study in filtered_studies for file in study.files if file.snippet_text},
+        'pages': {file.id: file.hit_pages for study in filtered_studies for file in study.files if file.hit_pages},
+        'search_words': search_words if search_terms else None,
+    }, generation)
+
+    return SearchResult(filtered_studies, total, page, per_page, title, facet_counts)
+
+# 検索結果の研究を分野・発表年度・ファイルの種類・タグごとに数える
+# 検索インデックスには分野・発表年度・種類・タグを持たない(FTS5とMySQLのインデックスも本文のみ)ため、
+# 候補の研究IDをCTEにして1回のUNION ALLで数え、結果は検索条件ごとにキャッシュする
+def CountFacets(query, admin):
+    candidates = query.order_by(None).with_entities(STUDIES.id.label('id')).cte('candidates')
+    file_filters = [FILES.study_id.in_(select(candidates.c.id))]
+    if not admin:
+        file_filters.append(FILES.grave_data == False)
+        file_filters.append(FILES.status == FILE_READY)
+
+    facet_queries = [
+        select(
+            literal('field').label('facet'),
+            cast(STUDIES.field, String).label('value'),
+            literal(None, String).label('label'),
+            func.count(STUDIES.id).label('count')
+        ).where(STUDIES.id.in_(select(candidates.c.id))).group_by(STUDIES.field),
+        select(
+            literal('pubyear'),
+            cast(FILES.pubyear, String),
+            literal(None, String),
+            func.count(func.distinct(FILES.study_id))
+        ).where(*file_filters).group_by(FILES.pubyear),
+        select(
+            literal('filetype'),
+            cast(FILES.type, String),
+            literal(None, String),
+            func.count(func.distinct(FILES.study_id))
+        ).where(*file_filters).group_by(FILES.type),
+        select(
+            literal('tag'),
+            TAGS.id,
+            TAGS.name,
+            func.count(STUDY_TAG.study_id)
+        ).join(STUDY_TAG, STUDY_TAG.tag_id == TAGS.id).where(STUDY_TAG.study_id.in_(select(candidates.c.id))).group_by(TAGS.id, TAGS.name),
+    ]
+
+    facet_counts = {'field': [], 'pubyear': [], 'filetype': [], 'tag': []}
+    for facet, value, label, count in db.session.execute(union_all(*facet_queries)).all():
+        if value is None:
+            continue
+        facet_counts[facet].append({'value': value, 'label': label or value, 'count': count})
+
+    for counts in facet_counts.values():
+        counts.sort(key=lambda item: (-item['count'], item['value']))
+
+    return facet_counts
+
+# キャッシュされた研究IDとFILESのIDから検索結果を復元する
+def LoadCachedStudies(cached):
+    if not cached['studies']:
+        return []
+
+    studies = {study.id: study for study in STUDIES.query.filter(STUDIES.id.in_(cached['studies'])).all()}
+    file_ids = [file_id for ids in cached['files'].values() for file_id in ids]
+    files = {file.id: file for file in FILES.query.filter(FILES.id.in_(file_ids)).all()} if file_ids else {}
+    for file in files.values():
+        snippet = cached.get('snippets', {}).get(file.id)
+        file.snippet = HighlightSnippet(snippet, cached.get('search_words')) if snippet else None
+        file.hit_pages = cached.get('pages', {}).get(file.id, [])
+
+    results = []
+    for study_id in cached['studies']:
+        # キャッシュ後に削除された研究は除外します。
+        study = studies.get(study_id)
+        if study is None:
+            continue
+        set_committed_value(study, 'files', [files[file_id] for file_id in cached['files'].get(study_id, []) if file_id in files])
+        results.append(study)
+
+    return results
+
+# 複数の研究について検索語に一致するFILESを1回のクエリで取得し、研究ごとに上位4件を割り当てる
+def FetchMatchedFiles(studies, search_words, admin, limit=4):
+    if not studies:
+        return studies
+
+    file_filters = [FILES.study_id.in_([study.id for study in studies])]
+    if search_words:
+        file_filters.append(or_(*[or_(FILES.summary.ilike(f"%{term}%"), FILES.content.ilike(f"%{term}%")) for term in search_words]))
+    if not admin:
+        file_filters.append(FILES.grave_data == False)
+        file_filters.append(FILES.status == FILE_READY)
 
-    filtered_studies = FilterStudiesHiddenFiles(studies, admin)
+    # 研究ごとに作成日時の降順で順位を付けます。
+    rank = func.row_number().over(partition_by=FILES.study_id, order_by=(FILES.create_at.desc(), FILES.id.desc())).label('rank')
+    ranked = db.session.query(FILES.id.label('id'), rank).filter(*file_filters).subquery()
 
-    return [filtered_studies, '"' + search_terms + '"の検索結果']
+    # 本文は読み込まず、検索語ごとに一致箇所の周辺だけをデータベース側で切り出します。
+    snippets = SnippetColumns(search_words) if search_words else [literal(None, String)]
+    rows = db.session.query(FILES, *snippets).join(ranked, FILES.id == ranked.c.id).filter(ranked.c.rank <= limit).order_by(ranked.c.rank).all()
+
+    hit_pages = FetchHitPages([row[0].id for row in rows], search_words) if search_words else {}
+
+    grouped_files = {}
+    for file, *candidates in rows:
+        file_snippet = ChooseSnippet(candidates, search_words) if search_words else None
+        file.snippet_text = file_snippet
+        file.snippet = HighlightSnippet(file_snippet, search_words) if file_snippet else None
+        file.hit_pages = hit_pages.get(file.id, [])
+        grouped_files.setdefault(file.study_id, []).append(file)
+
+    # 変更として記録されないように読み込み済みの値としてfiles属性を設定します。
+    for study in studies:
+        set_committed_value(study, 'files', grouped_files.get(study.id, []))
+
+    return studies
+
+# ファイルごとに検索語を含むページ番号を先頭から最大limit件返す
+def FetchHitPages(file_ids, search_words, limit=5):
+    if not file_ids:
+        return {}
+
+    rows = db.session.query(FILEPAGES.file_id, FILEPAGES.page).filter(
+        FILEPAGES.file_id.in_(file_ids),
+        or_(*[FILEPAGES.content.ilike(f"%{term}%") for term in search_words])
+    ).order_by(FILEPAGES.file_id, FILEPAGES.page).all()
+
+    pages = {}
+    for file_id, page in rows:
+        file_pages = pages.setdefault(file_id, [])
+        if len(file_pages) < limit:
+            file_pages.append(page)
+    return pages
+
+# 検索語ごとに最初に現れる位置の前後を切り出すSQL式のリスト
+def SnippetColumns(search_words, before=40, length=120):
+    columns = []
+    for index, word in enumerate(dict.fromkeys(word.lower() for word in search_words)):
+        position = func.instr(func.lower(FILES.content), word)
+        start = case((position > before, position - before), else_=1)
+        columns.append(case((position > 0, func.substr(FILES.content, start, length)), else_=None).label(f'snippet_{index}'))
+    return columns
+
+# 切り出した候補のうち最も多くの検索語を含むものを返す(同数の場合は先の検索語のもの)
+def ChooseSnippet(candidates, search_words):
+    words = set(word.lower() for word in search_words)
+    best = None
+    best_count = 0
+    for candidate in candidates:
+        if candidate is None:
+            continue
+        text = candidate.lower()
+        count = sum(1 for word in words if word in text)
+        if count > best_count:
+            best = candidate
+            best_count = count
+    return best
+
+# スニペット中の検索語を強調表示する
+def HighlightSnippet(snippet, search_words):
+    snippet = ' '.join(snippet.split())
+    if not search_words:
+        return escape(snippet)
+    pattern = re.compile('|'.join(re.escape(word) for word in sorted(search_words, key=len, reverse=True)), re.IGNORECASE)
+    highlighted = Markup('')
+    last = 0
+    for match in pattern.finditer(snippet):
+        highlighted += escape(snippet[last:match.start()]) + Markup('<mark>') + escape(match.group()) + Markup('</mark>')
+        last = match.end()
+    return highlighted + escape(snippet[last:])
 
 import wikipedia
 from nltk.corpus import wordnet
@@ -5,8 +5,9 @@ from flask_paginate import Pagination, get_page_parameter
 from dbapp import app, db
 from dbapp.models.tables import NEWS, TAGS, STUDIES, STUDYGRAVES, FILES, FILEGRAVES, USERS, ROLES, USER_ROLE
 from dbapp.form import PostNewsForm, TagForm, DeleteForm, AddRoleForm, DelRoleForm
+from dbapp.search.pipeline import index_lag
+from dbapp.file_operation.storage import release
 import os
-import shutil
 import psutil
 
 admin_bp = Blueprint('admin_bp', __name__, template_folder='templates')
@@ -62,6 +63,12 @@ def upload_result():
 
     return render_template('admin-pages/result.html', title="結果", result=result)
 
+@admin_bp.route('/index_status')
+@login_required
+@admin_permission.require(403)
+def index_status():
+    return jsonify({'status': 'ok', 'index': index_lag()})
+
 @admin_bp.route('/user')
 @login_required
 @admin_permission.require(403)
@@ -200,7 +207,6 @@ def delete():
                 try:
                     study = STUDIES.query.filter(STUDIES.id==form_id).one_or_none()
                     if form_delete:
-                        filepath = os.path.join(app.config['UPLOAD_FOLDER'], str(form_id))
                         deleted = True
 
                     grave_check = STUDYGRAVES.query.filter(STUDYGRAVES.study_id==study.id).one_or_none()
@@ -227,7 +233,10 @@ def delete():
 
                     db.session.flush()
                     if form_delete:
-                        shutil.rmtree(filepath)
+                        # 削除済みのファイルを除いて参照を外す(参照がなくなった実体はコミット後に削除される)
+                        deleted_files = db.session.query(FILEGRAVES.file_id).filter(FILEGRAVES.deleted==True)
+                        for file in FILES.query.filter(FILES.study_id==study.id, FILES.id.notin_(deleted_files)).all():
+                            release(file)
                     db.session.commit()
 
                 except Exception as e:
@@ -242,7 +251,6 @@ def delete():
                 try:
                     file = FILES.query.filter(FILES.id==form_id).one_or_none()
                     if form_delete:
-                        filepath = os.path.join(app.config['UPLOAD_FOLDER'], str(file.study_id), str(file.filename))
                         deleted = True
 
                     grave_check = FILEGRAVES.query.filter(FILEGRAVES.file_id==file.id).one_or_none()
@@ -268,9 +276,9 @@ def delete():
                         db.session.add(grave)
 
                     db.session.flush()
-                    db.session.commit()
                     if form_delete:
-                        os.remove(filepath)
+                        release(file)
+                    db.session.commit()
 
                 except Exception as e:
                     status = 'is-danger'
@@ -1,11 +1,16 @@
-from flask import Blueprint, jsonify, request
-from flask_login import login_required
+from flask import Blueprint, jsonify, request, url_for
+from flask_login import login_required, current_user
 from flask_principal import Permission, RoleNeed
-from dbapp.models.tables import TAGS, TAGSSchema
+from werkzeug.datastructures import MultiDict
+from dbapp.models.tables import TAGS, TAGSSchema, USERS
 from sqlalchemy import or_, and_
 # from dbapp.file_operation.smb_operation import get_files
-from dbapp.file_operation.pdf import PDF_extractor
+from dbapp.file_operation.pdf import PDF_metadata
 from dbapp.tools import convertMarkdown
+from dbapp.search.suggest import suggester
+from dbapp.file_operation.ingest import get_job, can_view_job, JOB_SUCCESS
+from dbapp.file_operation.chunked import create_upload, get_upload, write_chunk, complete_upload
+from dbapp.form import ChunkedUploadForm
 
 api = Blueprint('api_bp', __name__)
 
@@ -18,9 +23,102 @@ def tag_search():
 
     return jsonify({'status': 'ok', 'tagList': TAGSSchema(many=True, exclude=('id', )).dump(results)})
 
+@api.route('/suggest', methods=['GET'])
+def suggest():
+    query = request.args.get('query', default='')
+    limit = max(1, min(request.args.get('limit', default=10, type=int), 50))
+    kind = request.args.get('kind')
+    results = suggester.search(query, limit=limit, kind=kind)
+
+    return jsonify({'status': 'ok', 'suggestions': results})
+
+@api.route('/job/<id>', methods=['GET'])
+@login_required
+def job(id):
+    job = get_job(id)
+    if job is None or not can_view_job(job, current_user):
+        return jsonify({'status': 'error', 'reason': 'ジョブが存在しません'}), 404
+
+    result = {'status': 'ok', 'job': job}
+    if job['status'] == JOB_SUCCESS:
+        result['url'] = url_for('user_bp.file', id=job['file_id'])
+    return jsonify(result)
+
+# 分割アップロードの開始(ファイルの情報をJSONで受け取る)
+@api.route('/upload', methods=['POST'])
+@login_required
+def start_upload():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'status': 'error', 'reason': 'ファイルの情報をJSONで送ってください'}), 400
+
+    parent_id = data.get('study_id')
+    if not parent_id in [x.id for x in current_user.studies] and not current_user.has_role('Admin'):
+        return jsonify({'status': 'error', 'reason': 'この研究グループにはアップロードできません'}), 403
+
+    # 通常のアップロードと同じ条件で確認する(文字列と数値以外の値は受け付けない)
+    form = ChunkedUploadForm(formdata=MultiDict({key: str(value) for key, value in data.items() if isinstance(value, (str, int)) and not isinstance(value, bool)}))
+    if not form.validate():
+        reason = '、'.join(f'{field}: {message}' for field, messages in form.errors.items() for message in messages)
+        return jsonify({'status': 'error', 'reason': reason}), 400
+
+    try:
+        upload = create_upload(str(current_user.id), form.study_id.data, form.name.data, form.size.data, form.summary.data, int(form.type.data), int(form.pubyear.data))
+    except Exception as e:
+        return jsonify({'status': 'error', 'reason': str(e)}), 400
+
+    return jsonify({'status': 'ok', 'upload': upload})
+
+def own_upload(id):
+    upload = get_upload(id)
+    if upload is None or upload['user_id'] != str(current_user.id):
+        return None
+    return upload
+
+# 再開するために受信済みのチャンクを返す
+@api.route('/upload/<id>', methods=['GET'])
+@login_required
+def upload_status(id):
+    upload = own_upload(id)
+    if upload is None:
+        return jsonify({'status': 'error', 'reason': 'アップロードが存在しません'}), 404
+
+    return jsonify({'status': 'ok', 'upload': upload})
+
+# チャンクの本文をそのまま受け取り、X-Chunk-SHA256ヘッダーの値と照合する
+@api.route('/upload/<id>/<int:index>', methods=['PUT'])
+@login_required
+def upload_chunk(id, index):
+    upload = own_upload(id)
+    if upload is None:
+        return jsonify({'status': 'error', 'reason': 'アップロードが存在しません'}), 404
+
+    try:
+        received = write_chunk(upload, index, request.stream, request.headers.get('X-Chunk-SHA256'))
+    except Exception as e:
+        return jsonify({'status': 'error', 'reason': str(e)}), 400
+
+    return jsonify({'status': 'ok', 'received': received})
+
+@api.route('/upload/<id>/complete', methods=['POST'])
+@login_required
+def finish_upload(id):
+    upload = own_upload(id)
+    if upload is None:
+        return jsonify({'status': 'error', 'reason': 'アップロードが存在しません'}), 404
+
+    try:
+        user = USERS.query.filter(USERS.id==str(current_user.id)).one()
+        file_id, job_id = complete_upload(upload, user)
+    except Exception as e:
+        return jsonify({'status': 'error', 'reason': str(e)}), 400
+
+    return jsonify({'status': 'ok', 'file_id': file_id, 'job_id': job_id, 'url': url_for('logined_bp.upload_result', parent_id=upload['study_id'], job_id=job_id)})
+
 @api.route('/summarize_api', methods=['POST'])
 def file_receive():
-    pdf = PDF_extractor(request.files['file'])
+    # 発表年度は文書情報辞書の作成日時から求めるため、本文の解析は行わない
+    pdf = PDF_metadata(request.files['file'])
 
     return jsonify({"status": "ok", "pubyear":pdf["pubyear"]})
 
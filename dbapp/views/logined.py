@@ -3,13 +3,14 @@ from flask import Blueprint, render_template, jsonify, request, abort, url_for,
 from flask_login import login_required, current_user
 from flask_paginate import get_page_parameter, Pagination
 from werkzeug.utils import secure_filename
-from cv2 import VideoCapture
 from PIL import Image, UnidentifiedImageError
 from datetime import datetime
 from dbapp import app, db
 from dbapp.models.tables import USERS, FILES, STUDIES, TAGS, VOTES, FILEACCESS
 from dbapp.form import UploadForm, StudyForm, AddAuthorForm, DelAuthorForm, FileEditForm
-from dbapp.file_operation.pdf import PDF_extractor
+from dbapp.file_operation.ingest import upload_filename, accept_upload, get_job, can_view_job, JOB_QUEUED, JOB_SUCCESS, JOB_FAILED
+from dbapp.file_operation.chunked import chunked_config
+from dbapp.file_operation.storage import save_stream
 from dbapp.tools import wikipedia_summary, sha256_hash, convertMarkdown, FilterStudiesHiddenFiles
 from flask import url_for, redirect, flash
 from PIL import Image, UnidentifiedImageError
@@ -62,9 +63,6 @@ def create_study():
 
                 db.session.add(add_study)
                 db.session.flush()
-
-                os.mkdir(os.path.join(app.config['UPLOAD_FOLDER'], id))
-
                 db.session.commit()
 
             except Exception as e:
@@ -244,117 +242,59 @@ def upload(parent_id):
     if not parent_id in [x.id for x in current_user.studies] and not current_user.has_role('Admin'):
         abort(403)
     form = UploadForm()
+    chunk_size = chunked_config()['chunk_size']
     if request.method == 'GET':
-        return render_template('user-pages/upload.html', title='ファイルの追加', form=form, parent_id=parent_id)
+        return render_template('user-pages/upload.html', title='ファイルの追加', form=form, parent_id=parent_id, chunk_size=chunk_size)
     if request.method == 'POST':
         if form.validate_on_submit():
-            status = 'success'
+            status = 'queued'
             reason = ''
-            savepath = ''
+            file_id = None
+            job_id = None
             try:
                 form_summary = form.summary.data
                 form_type = form.type.data
                 form_pubyear = form.pubyear.data
-                file_id = ulid.new().str
 
                 file = form.file.data
+                name = file.filename
 
-                filename = file.filename
-
-                filename = datetime.now().strftime('%Y%m%d%H%M%S') + '-' + filename
-
-                filename = secure_filename(filename)
-
-                savepath = os.path.join(app.config['UPLOAD_FOLDER'], parent_id, filename)
-                file.save(savepath)
-
-                content = ''
-                file_extension = os.path.splitext(savepath)[1].lower()
-                if file_extension == ".pdf":
-                    with open(savepath, "rb") as f:
-                        pdf = PDF_extractor(f)
-
-                        if pdf is None:
-                            raise Exception("PDFドキュメントの解析に失敗しました。PDFドキュメントが破損している可能性があります。")
-
-                        content = pdf["content"]
-
-                elif file_extension == ".mp4":
-                    check_mp4 = VideoCapture(savepath)
-                    if not check_mp4.isOpened():
-                        raise Exception("MP4動画の解析に失敗しました。MP4動画が破損している可能性があります。")
-
-                    form_type = 5
-                    check_mp4.release()
-
-                elif file_extension == ".png":
-                    check_png = Image.open(savepath)
-
-                    check_png.verify()
-                    
-                    form_type = 6
-                    check_png.close()
-                
-                else:
-                    raise Exception("不正なファイルがアップロードされました")
-
-                filehash = sha256_hash(savepath)
-
-                fileUniqueCheck = FILES.query.filter(FILES.hashsum == filehash).one_or_none()
-                if fileUniqueCheck is not None:
-                    raise Exception("このファイルはすでにアップロードされています")
+                filename = upload_filename(file.filename)
 
                 user = USERS.query.filter(USERS.id==str(current_user.id)).one()
 
-                add_file = FILES(
-                    id=file_id,
-                    name=file.filename,
-                    hashsum=filehash,
-                    summary=form_summary,
-                    type=form_type,
-                    content=content,
-                    filename=filename,
-                    pubyear=form_pubyear,
-                    author=[user],
-                    study_id=parent_id
-                )
-
-                db.session.add(add_file)
-
-                parent = STUDIES.query.filter(STUDIES.id==parent_id).one()
-                parent.update_at = datetime.now()
-
-                db.session.flush()
-                db.session.commit()
-
-                name = add_file.name
-
-            except UnidentifiedImageError:
-                status = 'failed'
-                reason = 'PNG画像の解析に失敗しました。PNG画像が破損している可能性があります'
-                name = file.filename
-
-                if os.path.exists(savepath):
-                    os.remove(savepath)
-
-                db.session.rollback()
+                # 一時ファイルに書き込みながらハッシュ値を計算する
+                temppath, filehash = save_stream(file.stream)
+                file_id, job_id = accept_upload(temppath, filehash, name, filename, parent_id, user, form_summary, form_type, form_pubyear)
 
             except Exception as e:
                 status = 'failed'
                 reason = e
-                name = file.filename
-
-                if os.path.exists(savepath):
-                    os.remove(savepath)
 
-                db.session.rollback()
-
-            result = {'status': status, 'name': name, 'reason': reason, 'id': file_id, 'parent_id': parent_id}
+            result = {'status': status, 'name': name, 'reason': reason, 'id': file_id, 'parent_id': parent_id, 'job_id': job_id}
             print(result)
 
             return render_template('user-pages/result_page.html', title='結果', result=result)
 
-        return render_template('user-pages/upload.html', title='ファイルの追加(エラー)', form=form, parent_id=parent_id)
+        return render_template('user-pages/upload.html', title='ファイルの追加(エラー)', form=form, parent_id=parent_id, chunk_size=chunk_size)
+
+# 分割アップロードが完了した後の結果ページ
+@logined_bp.route('/edit_study/<parent_id>/upload/<job_id>', methods=['GET'])
+@login_required
+def upload_result(parent_id, job_id):
+    if not parent_id in [x.id for x in current_user.studies] and not current_user.has_role('Admin'):
+        abort(403)
+    job = get_job(job_id)
+    if job is None or not can_view_job(job, current_user):
+        abort(404)
+
+    file = FILES.query.filter(FILES.id==job['file_id']).one_or_none()
+    status = job['status'] if job['status'] in [JOB_SUCCESS, JOB_FAILED] else JOB_QUEUED
+    name = job.get('name') or (file.name if file is not None else '')
+
+    result = {'status': status, 'name': name, 'reason': job['reason'], 'id': job['file_id'], 'parent_id': parent_id, 'job_id': job_id}
+
+    return render_template('user-pages/result_page.html', title='結果', result=result)
 
 @logined_bp.route('/edit_file/<id>', methods=['GET', 'POST'])
 @login_required
@@ -7,14 +7,16 @@ from datetime import datetime
 from dbapp import app, db
 from dbapp.models.tables import FILES, TAGS, VOTES, NEWS, STUDIES, FILEACCESS, FILEPREVIEW
 from dbapp.tools import convertMarkdown, SearchEngine, FilterStudyFiles, FilterStudiesHiddenFiles
-from dbapp.models.tables import FILES, TAGS, VOTES, NEWS, STUDIES, FILEACCESS, FILEPREVIEW, STUDYGRAVES, FILEGRAVES
+from dbapp.file_operation.storage import file_path
+from dbapp.file_operation.delivery import send_stored_file
+from dbapp.models.tables import FILES, TAGS, VOTES, NEWS, STUDIES, FILEACCESS, FILEPREVIEW, STUDYGRAVES, FILEGRAVES, RELATEDSTUDIES, FILE_READY
 
 user_bp = Blueprint('user_bp', __name__, template_folder='templates')
 
 @user_bp.route('/')
 def index():
-    access_rank = STUDIES.query.join(FILES).filter(STUDIES.grave_data==False).group_by(STUDIES.id).order_by(desc(func.sum(FILES.access_count))).limit(10).all()
-    preview_rank = STUDIES.query.join(FILES).filter(STUDIES.grave_data==False).group_by(STUDIES.id).order_by(desc(func.sum(FILES.preview_count))).limit(10).all()
+    access_rank = STUDIES.query.filter(STUDIES.grave_data==False).order_by(STUDIES.total_access_count.desc()).limit(10).all()
+    preview_rank = STUDIES.query.filter(STUDIES.grave_data==False).order_by(STUDIES.total_preview_count.desc()).limit(10).all()
     helpful_rank = db.session.query(
         STUDIES.id,
         STUDIES.name,
@@ -72,6 +74,8 @@ def study(id):
 
     summary = convertMarkdown(data.raw_markdown)
 
+    related_studies = STUDIES.query.join(RELATEDSTUDIES, RELATEDSTUDIES.related_id==STUDIES.id).filter(RELATEDSTUDIES.study_id==data.id, STUDIES.grave_data==False).order_by(RELATEDSTUDIES.rank).all()
+
     return render_template(
         'user-pages/study.html',
         title=data.name,
@@ -80,7 +84,8 @@ def study(id):
         helpful_votes=helpful_votes,
         unhelpful_votes=unhelpful_votes,
         user_vote=user_vote,
-        editable=editable
+        editable=editable,
+        related_studies=related_studies
     )
 
 @user_bp.route('/file/<id>')
@@ -95,6 +100,8 @@ def file(id):
         admin = current_user.has_role('Admin')
     if grave is not None and not admin:
         return render_template("user-pages/grave.html", title="削除されたファイル", data=grave), 404
+    if data.status != FILE_READY and not admin:
+        abort(404)
     parent_grave = STUDYGRAVES.query.filter(STUDYGRAVES.study_id==data.study_id).one_or_none()
     if parent_grave is not None and not admin:
         return render_template("user-pages/grave.html", title="削除された研究", data=parent_grave), 404
@@ -107,7 +114,9 @@ def file(id):
     # ファイルIDがアクセス情報にない場合、アクセスカウントを増加
     if data.id not in session['accessed_files']:
         # ここでアクセスカウントを増加させる操作を行う
-        data.access_count += 1
+        # 同時に閲覧されても数え漏れがないようにデータベース側で加算する
+        FILES.query.filter(FILES.id==data.id).update({FILES.access_count: FILES.access_count + 1}, synchronize_session=False)
+        STUDIES.query.filter(STUDIES.id==data.study_id).update({STUDIES.total_access_count: STUDIES.total_access_count + 1}, synchronize_session=False)
         session['accessed_files'][data.id] = True
 
         if current_user.is_authenticated:
@@ -145,6 +154,11 @@ def preview(id):
         admin = current_user.has_role('Admin')
     if grave is not None and not admin:
         return render_template("user-pages/grave.html", title="削除されたファイル", data=grave), 404
+    if data.status != FILE_READY and not admin:
+        abort(404)
+    parent_grave = STUDYGRAVES.query.filter(STUDYGRAVES.study_id==data.study_id).one_or_none()
+    if parent_grave is not None and not admin:
+        return render_template("user-pages/grave.html", title="削除された研究", data=parent_grave), 404
 
     # セッションにプレビュー情報がまだ存在しない場合、プレビュー情報をセッションに追加
     if 'previewed_files' not in session:
@@ -153,7 +167,8 @@ def preview(id):
     # ファイルIDがプレビュー情報にない場合、プレビューカウントを増加
     if data.id not in session['previewed_files']:
         # ここでプレビューカウントを増加させる操作を行う
-        data.preview_count += 1
+        FILES.query.filter(FILES.id==data.id).update({FILES.preview_count: FILES.preview_count + 1}, synchronize_session=False)
+        STUDIES.query.filter(STUDIES.id==data.study_id).update({STUDIES.total_preview_count: STUDIES.total_preview_count + 1}, synchronize_session=False)
         session['previewed_files'][data.id] = True
 
         if current_user.is_authenticated:
@@ -166,11 +181,11 @@ def preview(id):
 
         # データベースに変更を保存
         db.session.commit()
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], data.study.id, data.filename)
+    filepath = file_path(data)
     if not os.path.isfile(filepath):
         abort(500)
 
-    file_extension = filepath.split(".")[-1]
+    file_extension = data.filename.split(".")[-1]
     if file_extension == "pdf":
         mimetype = 'application/pdf'
     elif file_extension == "mp4":
@@ -178,14 +193,9 @@ def preview(id):
     elif file_extension == "png":
         mimetype = 'image/png'
 
-    return make_response(
-        send_file(
-            filepath,
-            as_attachment=False,
-            download_name=data.name,
-            mimetype=mimetype
-        )
-    )
+    # 削除・非公開・解析中のファイルと、削除された研究のファイルは管理者にしか見えないため共有キャッシュに保存させない
+    public = grave is None and parent_grave is None and data.status == FILE_READY
+    return make_response(send_stored_file(filepath, mimetype, data.name, etag=data.hashsum, created_at=data.create_at, public=public))
 
 @user_bp.route('/news/')
 def newslist():
@@ -225,6 +235,9 @@ def search():
     update_date_end = update_date_end if update_date_end else "9999-12-31"
 
     field = request.args.get('field', default=0, type=int)
+    pubyear = request.args.get('pubyear', default=None, type=int)
+    filetype = request.args.get('filetype', default=None, type=int)
+    tag = request.args.get('tag', default=None)
 
     ascending = request.args.get('ascending', default="True") == "True"
     sort_column = request.args.get('sort_column', default="update_at")
@@ -236,26 +249,44 @@ def search():
     if current_user.is_authenticated:
         admin = current_user.has_role('Admin')
 
-    result_pages = SearchEngine(
+    page = request.args.get(get_page_parameter(), type=int, default=1)
+    per_page = min(max(request.args.get('pp', type=int, default=10), 1), 100)
+
+    result = SearchEngine(
         search_terms=raw_query,
         ascending=ascending,
         create_at_range=create_at_range,
         update_at_range=update_at_range,
         sort_column=sort_column,
         field=field,
-        admin=admin
+        admin=admin,
+        page=page,
+        per_page=per_page,
+        pubyear=pubyear,
+        filetype=filetype,
+        tag=tag,
+        facets=True
     )
 
-    page = request.args.get(get_page_parameter(), type=int, default=1)
-    per_page = request.args.get('pp', type=int, default=10)
-    rows = result_pages[0][(page - 1)*per_page: page*per_page]
-    pagination = Pagination(page=page, total=len(result_pages[0]), per_page=per_page, css_framework="BULMA")
+    pagination = Pagination(page=result.page, total=result.total, per_page=per_page, css_framework="BULMA")
+
+    # 適用中の絞り込みを解除するリンク
+    remove_urls = {}
+    for key, value in [('field', field), ('pubyear', pubyear), ('filetype', filetype), ('tag', tag)]:
+        if value:
+            args = request.args.to_dict()
+            args.pop(key, None)
+            args[get_page_parameter()] = 1
+            remove_urls[key] = url_for('user_bp.search', **args)
 
     return render_template(
         'user-pages/search.html',
-        title=result_pages[1],
-        rows=rows,
-        pagination=pagination
+        title=result.title,
+        rows=result.items,
+        pagination=pagination,
+        facets=result.facets,
+        remove_urls=remove_urls,
+        filetypes=['ポスター発表','プレゼンテーション', '報告書', '要旨', '動画', '画像']
     )
 
 
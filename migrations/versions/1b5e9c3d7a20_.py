@@ -0,0 +1,31 @@
+"""add per-field full-text indexes for relevance
+
+Revision ID: 1b5e9c3d7a20
+Revises: f2b7d4c8e1a6
+Create Date: 2026-10-19 10:12:44.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from dbapp.search.native import MYSQL_FIELD_INDEXES
+
+
+# revision identifiers, used by Alembic.
+revision = '1b5e9c3d7a20'
+down_revision = 'f2b7d4c8e1a6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # MySQLでフィールドごとの関連度を求めるため、列ごとのFULLTEXTインデックスを追加する
+    # SQLiteのFTS5は1つの仮想テーブルで列ごとに重みを付けられるため何もしない
+    if op.get_bind().dialect.name == 'mysql':
+        for name, (table, columns) in MYSQL_FIELD_INDEXES.items():
+            op.execute(f"ALTER TABLE {table} ADD FULLTEXT INDEX {name} ({columns}) WITH PARSER ngram")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'mysql':
+        for name, (table, columns) in MYSQL_FIELD_INDEXES.items():
+            op.execute(f"ALTER TABLE {table} DROP INDEX {name}")
@@ -0,0 +1,48 @@
+"""forbid duplicate files in a study
+
+Revision ID: 5d2a8e6f4c31
+Revises: 1b5e9c3d7a20
+Create Date: 2026-10-19 11:03:27.846190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from dbapp.search.native import drop_sqlite_fts_triggers, refill_sqlite_fts
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2a8e6f4c31'
+down_revision = '1b5e9c3d7a20'
+branch_labels = None
+depends_on = None
+
+
+def fts_triggers():
+    bind = op.get_bind()
+    return bind.dialect.name == 'sqlite' and sa.inspect(bind).has_table('studies_fts')
+
+
+def upgrade():
+    # SQLiteではfilesを作り直すため、全文検索のトリガーを外しておく
+    triggers = fts_triggers()
+    if triggers:
+        drop_sqlite_fts_triggers(op.get_bind())
+
+    # 同時にアップロードされた同じファイルを同じ研究に登録しないようにする
+    with op.batch_alter_table('files', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_files_study_id_hashsum', ['study_id', 'hashsum'])
+
+    if triggers:
+        refill_sqlite_fts(op.get_bind())
+
+
+def downgrade():
+    triggers = fts_triggers()
+    if triggers:
+        drop_sqlite_fts_triggers(op.get_bind())
+
+    with op.batch_alter_table('files', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_files_study_id_hashsum', type_='unique')
+
+    if triggers:
+        refill_sqlite_fts(op.get_bind())
@@ -0,0 +1,42 @@
+"""add native full-text search index
+
+Revision ID: a4e8f61b2d93
+Revises: 7c52d0e4a9b1
+Create Date: 2026-10-18 13:26:05.771342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+# テーブルとトリガーのSQLは検索エンジンと共通にする
+from dbapp.search.native import create_sqlite_fts, drop_sqlite_fts, MYSQL_FULLTEXT_INDEXES
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4e8f61b2d93'
+down_revision = '7c52d0e4a9b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'sqlite':
+        # FTS5(trigram)の仮想テーブルとトリガーで研究とファイルの変更を同期する
+        create_sqlite_fts(op.get_bind())
+
+    elif dialect == 'mysql':
+        # InnoDBのFULLTEXTインデックスは更新時に自動で同期される
+        for name, (table, columns) in MYSQL_FULLTEXT_INDEXES.items():
+            op.execute(f"ALTER TABLE {table} ADD FULLTEXT INDEX {name} ({columns}) WITH PARSER ngram")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'sqlite':
+        drop_sqlite_fts(op.get_bind())
+
+    elif dialect == 'mysql':
+        for name, (table, columns) in MYSQL_FULLTEXT_INDEXES.items():
+            op.execute(f"ALTER TABLE {table} DROP INDEX {name}")
@@ -0,0 +1,79 @@
+"""share blobs between files
+
+Revision ID: f2b7d4c8e1a6
+Revises: e6c4a1f9d237
+Create Date: 2026-10-18 19:20:37.104825
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from dbapp.search.native import drop_sqlite_fts_triggers, refill_sqlite_fts
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b7d4c8e1a6'
+down_revision = 'e6c4a1f9d237'
+branch_labels = None
+depends_on = None
+
+# SQLiteではdb.create_all()で作られた一意制約に名前がないため、この規則で名前を付けて削除する
+naming_convention = {
+    'uq': 'uq_%(table_name)s_%(column_0_name)s',
+}
+
+
+def fts_triggers():
+    bind = op.get_bind()
+    return bind.dialect.name == 'sqlite' and sa.inspect(bind).has_table('studies_fts')
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    unique_constraints = [
+        constraint['name'] or 'uq_files_hashsum'
+        for constraint in inspector.get_unique_constraints('files')
+        if constraint['column_names'] == ['hashsum']
+    ]
+    unique_indexes = [
+        index['name']
+        for index in inspector.get_indexes('files')
+        if index['column_names'] == ['hashsum'] and index['unique'] and index['name'] not in unique_constraints
+    ]
+
+    # SQLiteではfilesを作り直すため、全文検索のトリガーを外しておく
+    triggers = fts_triggers()
+    if triggers:
+        drop_sqlite_fts_triggers(op.get_bind())
+
+    # 同じ内容のファイルを複数の研究で登録できるように、hashsumの一意制約を通常のインデックスにする
+    with op.batch_alter_table('files', schema=None, naming_convention=naming_convention) as batch_op:
+        for name in unique_constraints:
+            batch_op.drop_constraint(name, type_='unique')
+        for name in unique_indexes:
+            batch_op.drop_index(name)
+        batch_op.alter_column('hashsum',
+               existing_type=sa.Text(),
+               type_=sa.String(length=64),
+               existing_nullable=True)
+        batch_op.create_index(batch_op.f('ix_files_hashsum'), ['hashsum'], unique=False)
+
+    if triggers:
+        refill_sqlite_fts(op.get_bind())
+
+
+def downgrade():
+    # 同じ内容のファイルが複数登録されている場合は一意制約を戻せないため失敗する
+    triggers = fts_triggers()
+    if triggers:
+        drop_sqlite_fts_triggers(op.get_bind())
+
+    with op.batch_alter_table('files', schema=None, naming_convention=naming_convention) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_files_hashsum'))
+        batch_op.alter_column('hashsum',
+               existing_type=sa.String(length=64),
+               type_=sa.Text(),
+               existing_nullable=True)
+        batch_op.create_unique_constraint('uq_files_hashsum', ['hashsum'])
+
+    if triggers:
+        refill_sqlite_fts(op.get_bind())
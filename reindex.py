@@ -0,0 +1,5 @@
+from dbapp import app
+from dbapp.search.index import get_search_index
+
+with app.app_context():
+    get_search_index().rebuild()
@@ -0,0 +1,125 @@
+import os
+import shutil
+import sys
+import tempfile
+import yaml
+import fakeredis
+import pytest
+import redis
+from flask import g
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# dbappはカレントディレクトリのconfig/config.ymlを読み込むため、テスト用の設定を一時ディレクトリに作る
+WORK_DIR = tempfile.mkdtemp(prefix='hsrepository-test-')
+SAVE_DIR = os.path.join(WORK_DIR, 'save')
+
+def write_config():
+    with open(os.path.join(ROOT, 'config', 'config.default.yml'), encoding='utf8') as f:
+        config = yaml.safe_load(f)
+    config['database'] = 'SQLite'
+    config['SaveDir'] = SAVE_DIR
+    os.makedirs(os.path.join(WORK_DIR, 'config'))
+    with open(os.path.join(WORK_DIR, 'config', 'config.yml'), 'w', encoding='utf8') as f:
+        yaml.safe_dump(config, f, allow_unicode=True)
+
+# Redisサーバーの代わりにプロセス内のfakeredisを使う
+REDIS_SERVER = fakeredis.FakeServer()
+
+class FakeRedis(fakeredis.FakeRedis):
+    def __init__(self, *args, **kwargs):
+        super().__init__(server=REDIS_SERVER)
+
+write_config()
+os.chdir(WORK_DIR)
+redis.Redis = FakeRedis
+
+from dbapp import app as flask_app, db, config_watcher
+from dbapp.models.tables import USERS, ROLES, STUDIES, FILES, FILE_READY
+from werkzeug.security import generate_password_hash
+
+# テスト中に設定ファイルを読み込み直さないようにする
+config_watcher.observer.stop()
+os.chdir(ROOT)
+
+flask_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(WORK_DIR, 'test.db')
+flask_app.config['WTF_CSRF_ENABLED'] = False
+flask_app.config['TESTING'] = True
+
+PASSWORD = 'password'
+
+# テスト中はアプリケーションコンテキストを使い続けるため、ログイン中のユーザーをリクエストごとに読み込み直す
+@flask_app.teardown_request
+def forget_current_user(exception):
+    g.pop('_login_user', None)
+    g.pop('identity', None)
+
+@pytest.fixture(scope='session')
+def app():
+    with flask_app.app_context():
+        yield flask_app
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+# テストごとにデータベース・Redis・保存先を空にし、設定を元に戻す
+@pytest.fixture(autouse=True)
+def clean(app):
+    config = config_watcher.get_config()
+    saved = {key: value for key, value in config.items()}
+    db.drop_all()
+    db.create_all()
+    flask_app.config['SESSION_REDIS'].flushall()
+    shutil.rmtree(SAVE_DIR, ignore_errors=True)
+    os.makedirs(SAVE_DIR)
+    yield
+    db.session.remove()
+    config.clear()
+    config.update(saved)
+
+@pytest.fixture
+def config():
+    return config_watcher.get_config()
+
+@pytest.fixture
+def redis_client(app):
+    return app.config['SESSION_REDIS']
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+def make_user(name='student', admin=False):
+    user = USERS(name=name, display_name=name, password=generate_password_hash(PASSWORD))
+    if admin:
+        role = ROLES.query.filter(ROLES.name == 'Admin').one_or_none() or ROLES(name='Admin')
+        user.roles = [role]
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+def make_study(user, name='研究', raw_markdown='', field=1, **kwargs):
+    study = STUDIES(name=name, summary='', raw_markdown=raw_markdown, field=field, authors=[user], **kwargs)
+    db.session.add(study)
+    db.session.commit()
+    return study
+
+def make_file(study, user, name='file.pdf', content='', hashsum=None, **kwargs):
+    kwargs.setdefault('status', FILE_READY)
+    file = FILES(
+        study_id=study.id,
+        name=name,
+        filename=name,
+        summary=kwargs.pop('summary', ''),
+        content=content,
+        hashsum=hashsum,
+        type=kwargs.pop('type', 1),
+        pubyear=kwargs.pop('pubyear', 2023),
+        author=[user],
+        **kwargs
+    )
+    db.session.add(file)
+    db.session.commit()
+    return file
+
+def login(client, user):
+    return client.post('/login', data={'name': user.name, 'password': PASSWORD, 'ad_disable': 'True'})
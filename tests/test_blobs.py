@@ -0,0 +1,80 @@
+import io
+import os
+import pytest
+from dbapp import db
+from dbapp.models.tables import BLOBS, FILES
+from dbapp.file_operation.ingest import accept_upload
+from dbapp.file_operation.storage import get_blob_store, save_stream, release, migrate_legacy, legacy_path
+from conftest import make_user, make_study, make_file
+
+CONTENT = b'%PDF-1.4 shared poster'
+
+def upload(study, user, content=CONTENT):
+    temppath, filehash = save_stream(io.BytesIO(content))
+    file_id, job_id = accept_upload(temppath, filehash, 'poster.pdf', 'poster.pdf', study.id, user, '概要', 1, 2023)
+    return db.session.get(FILES, file_id)
+
+def refcount(hashsum):
+    db.session.expire_all()
+    blob = db.session.get(BLOBS, hashsum)
+    return blob.refcount if blob is not None else None
+
+def delete(file):
+    release(file)
+    db.session.delete(file)
+    db.session.commit()
+
+def test_same_content_shares_one_blob():
+    user = make_user()
+    first = upload(make_study(user, name='研究1'), user)
+    second = upload(make_study(user, name='研究2'), user)
+
+    assert first.hashsum == second.hashsum
+    assert refcount(first.hashsum) == 2
+    path = get_blob_store().path(first.hashsum)
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]
+
+    # 参照が残っている間は実体を消さない
+    hashsum = first.hashsum
+    delete(first)
+    assert refcount(hashsum) == 1
+    assert os.path.isfile(path)
+
+    delete(db.session.get(FILES, second.id))
+    assert refcount(hashsum) is None
+    assert not os.path.exists(path)
+
+def test_same_study_rejects_duplicate():
+    user = make_user()
+    study = make_study(user)
+    file = upload(study, user)
+    with pytest.raises(Exception, match='同じファイル'):
+        upload(study, user)
+    assert refcount(file.hashsum) == 1
+    assert FILES.query.count() == 1
+    assert os.listdir(get_blob_store().temp_dir()) == []
+
+def test_rollback_keeps_blob():
+    user = make_user()
+    file = upload(make_study(user), user)
+    release(file)
+    db.session.delete(file)
+    db.session.rollback()
+    assert refcount(file.hashsum) == 1
+    assert os.path.isfile(get_blob_store().path(file.hashsum))
+
+def test_migrate_legacy_counts_every_file(app):
+    user = make_user()
+    files = [make_file(make_study(user, name=f'研究{i}'), user, name=f'file{i}.pdf', hashsum='a' * 64) for i in range(2)]
+    for file in files:
+        path = legacy_path(file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(CONTENT)
+
+    migrate_legacy()
+    assert refcount('a' * 64) == 2
+    assert not any(os.path.exists(legacy_path(file)) for file in files)
+    # 移した後に実行しても数え直さない
+    migrate_legacy()
+    assert refcount('a' * 64) == 2
@@ -0,0 +1,75 @@
+import math
+from dbapp import db
+from dbapp.search.index import NgramIndex, tokenize, BM25_K1, BM25_B, DEFAULT_WEIGHTS
+from dbapp.tools import SearchEngine
+from conftest import make_user, make_study, make_file
+
+def index_all():
+    NgramIndex().rebuild()
+
+def scores(words, candidates=None):
+    subquery = NgramIndex().scores(words, candidates=candidates)
+    return dict(db.session.execute(db.select(subquery.c.study_id, subquery.c.score)).all())
+
+def test_score_matches_bm25f():
+    user = make_user()
+    study = make_study(user, name='水質調査', raw_markdown='河川の水質')
+    make_study(user, name='土壌の研究')
+    index_all()
+
+    # 「水質」の1つのN-gramについてBM25Fを手で計算する
+    total_docs = 2
+    idf = math.log(1 + (total_docs - 1 + 0.5) / (1 + 0.5))
+    name_length = len(tokenize('水質調査'))
+    summary_length = len(tokenize('河川の水質'))
+    average_name = (name_length + len(tokenize('土壌の研究'))) / 2
+    average_summary = summary_length / 2
+    weighted_tf = (
+        DEFAULT_WEIGHTS['name'] / (1 - BM25_B + BM25_B * name_length / average_name)
+        + DEFAULT_WEIGHTS['summary'] / (1 - BM25_B + BM25_B * summary_length / average_summary)
+    )
+    expected = idf * weighted_tf / (BM25_K1 + weighted_tf)
+
+    result = scores(['水質'])
+    assert list(result) == [study.id]
+    assert math.isclose(result[study.id], expected)
+
+def test_name_outranks_content():
+    user = make_user()
+    in_content = make_study(user, name='研究A')
+    make_file(in_content, user, content='地域の水質について')
+    in_name = make_study(user, name='水質の研究')
+    index_all()
+
+    result = scores(['水質'])
+    assert result[in_name.id] > result[in_content.id]
+
+def test_raw_markdown_is_indexed():
+    user = make_user()
+    study = make_study(user, name='研究', raw_markdown='## 目的\n\n河川の水質を調べる')
+    index_all()
+    assert study.id in scores(['水質'])
+
+def test_candidates_limit_scoring():
+    user = make_user()
+    first = make_study(user, name='水質の研究')
+    second = make_study(user, name='水質の調査')
+    index_all()
+    result = scores(['水質'], candidates=db.select(db.literal(first.id)))
+    assert list(result) == [first.id]
+    assert second.id not in result
+
+def test_relevance_sort_pages(config):
+    config['Search'] = dict(config['Search'], engine='ngram')
+    user = make_user()
+    weak = make_study(user, name='研究B')
+    make_file(weak, user, content='水質')
+    strong = make_study(user, name='水質の水質調査', raw_markdown='水質')
+    middle = make_study(user, name='水質の研究')
+    index_all()
+
+    first_page = SearchEngine(search_terms='水質', sort_column='relevance', per_page=2)
+    assert first_page.total == 3
+    assert [study.id for study in first_page.items] == [strong.id, middle.id]
+    second_page = SearchEngine(search_terms='水質', sort_column='relevance', per_page=2, page=2)
+    assert [study.id for study in second_page.items] == [weak.id]
@@ -0,0 +1,123 @@
+import hashlib
+import pytest
+from dbapp import db
+from dbapp.models.tables import FILES
+from dbapp.file_operation.ingest import get_job
+from conftest import make_user, make_study, login
+
+CHUNK_SIZE = 1024 * 1024
+CONTENT = b'%PDF-1.4\n' + bytes(range(256)) * (CHUNK_SIZE * 5 // 2 // 256)
+
+@pytest.fixture
+def owner(client, config):
+    config['ChunkedUpload'] = {'chunk_size_mb': 1, 'max_size_mb': 4}
+    user = make_user()
+    login(client, user)
+    return user
+
+def upload_info(study, **kwargs):
+    info = {'study_id': study.id, 'name': 'poster.pdf', 'size': len(CONTENT), 'summary': '概要', 'type': '1', 'pubyear': '2023'}
+    info.update(kwargs)
+    return info
+
+def chunk(index):
+    return CONTENT[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+
+def put_chunk(client, upload_id, index, data=None, checksum=None):
+    data = chunk(index) if data is None else data
+    checksum = checksum or hashlib.sha256(data).hexdigest()
+    return client.put(f'/api/upload/{upload_id}/{index}', data=data, headers={'X-Chunk-SHA256': checksum})
+
+@pytest.mark.parametrize('info', [
+    {'type': 0},
+    {'type': '7'},
+    {'type': 'poster'},
+    {'pubyear': 1999},
+    {'pubyear': ['2023']},
+    {'name': ''},
+    {'name': 'a' * 252 + '.pdf'},
+    {'name': 'poster.exe'},
+    {'summary': ''},
+    {'size': 0},
+    {'size': 'large'},
+    {'size': 5 * CHUNK_SIZE},
+])
+def test_start_rejects_invalid_info(client, owner, info):
+    study = make_study(owner)
+    response = client.post('/api/upload', json=upload_info(study, **info))
+    assert response.status_code == 400
+    assert response.json['status'] == 'error'
+
+def test_start_rejects_missing_or_hidden_study(client, config):
+    config['ChunkedUpload'] = {'chunk_size_mb': 1, 'max_size_mb': 4}
+    admin = make_user('manager', admin=True)
+    login(client, admin)
+    hidden = make_study(admin, grave_data=True)
+    assert client.post('/api/upload', json=upload_info(hidden)).status_code == 400
+    assert client.post('/api/upload', json=dict(upload_info(hidden), study_id='missing')).status_code == 400
+
+def test_start_rejects_non_json_body(client, owner):
+    study = make_study(owner)
+    assert client.post('/api/upload', data='study_id=' + study.id).status_code == 400
+    assert client.post('/api/upload', json=['poster.pdf']).status_code == 400
+
+def test_start_rejects_other_study(client, owner):
+    other = make_user('other')
+    study = make_study(other, name='他の研究')
+    assert client.post('/api/upload', json=upload_info(study)).status_code == 403
+
+def test_resume_and_complete(client, owner):
+    study = make_study(owner)
+    response = client.post('/api/upload', json=upload_info(study))
+    assert response.status_code == 200
+    upload = response.json['upload']
+    assert upload['chunks'] == 3
+
+    assert put_chunk(client, upload['id'], 0).json['received'] == 1
+    # SHA-256が一致しないチャンクは受信済みにならない
+    response = put_chunk(client, upload['id'], 2, checksum='0' * 64)
+    assert response.status_code == 400
+    assert put_chunk(client, upload['id'], 3).status_code == 400
+    assert client.post(f"/api/upload/{upload['id']}/complete").status_code == 400
+
+    # 中断した後は受信済みのチャンクを確認して残りを送る
+    status = client.get(f"/api/upload/{upload['id']}").json['upload']
+    assert status['received'] == [0]
+    for index in range(status['chunks']):
+        if index not in status['received']:
+            assert put_chunk(client, upload['id'], index).status_code == 200
+
+    response = client.post(f"/api/upload/{upload['id']}/complete")
+    assert response.status_code == 200
+    file = db.session.get(FILES, response.json['file_id'])
+    assert file.study_id == study.id
+    assert file.hashsum == hashlib.sha256(CONTENT).hexdigest()
+    assert (file.type, file.pubyear) == (1, 2023)
+    assert get_job(response.json['job_id'])['file_id'] == file.id
+
+    # 完了したアップロードは再開できない
+    assert client.get(f"/api/upload/{upload['id']}").status_code == 404
+
+def test_other_user_cannot_resume(app, client, owner):
+    study = make_study(owner)
+    upload = client.post('/api/upload', json=upload_info(study)).json['upload']
+    other = app.test_client()
+    login(other, make_user('other'))
+    assert other.get(f"/api/upload/{upload['id']}").status_code == 404
+    assert put_chunk(other, upload['id'], 0).status_code == 404
+
+def test_corrupt_resend_keeps_received_chunk(client, owner):
+    study = make_study(owner)
+    upload = client.post('/api/upload', json=upload_info(study)).json['upload']
+    for index in range(upload['chunks']):
+        assert put_chunk(client, upload['id'], index).status_code == 200
+
+    # 受信済みのチャンクを壊れた内容で送り直しても元の内容が残る
+    assert put_chunk(client, upload['id'], 1, data=chunk(1) + b'\0').status_code == 400
+    assert put_chunk(client, upload['id'], 1, data=b'\0' * (len(chunk(1)) - 1)).status_code == 400
+    corrupt = b'\0' * len(chunk(1))
+    assert put_chunk(client, upload['id'], 1, data=corrupt, checksum=hashlib.sha256(chunk(1)).hexdigest()).status_code == 400
+
+    response = client.post(f"/api/upload/{upload['id']}/complete")
+    assert response.status_code == 200
+    assert db.session.get(FILES, response.json['file_id']).hashsum == hashlib.sha256(CONTENT).hexdigest()
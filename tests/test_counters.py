@@ -0,0 +1,52 @@
+import os
+from dbapp import db
+from dbapp.models.tables import FILES, STUDIES
+from dbapp.file_operation.storage import file_path
+from dbapp.tools import SearchEngine
+from conftest import make_user, make_study, make_file
+
+def write_file(file):
+    path = file_path(file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'%PDF-1.4')
+
+def test_file_view_increments_counts(client):
+    user = make_user()
+    study = make_study(user)
+    file = make_file(study, user)
+    # 別のセッションで数えられた閲覧数に加算されること
+    STUDIES.query.filter(STUDIES.id == study.id).update({STUDIES.total_access_count: 5})
+    db.session.commit()
+
+    assert client.get(f'/file/{file.id}').status_code == 200
+    # 同じセッションからの閲覧は数えない
+    assert client.get(f'/file/{file.id}').status_code == 200
+    db.session.expire_all()
+    assert db.session.get(FILES, file.id).access_count == 1
+    assert db.session.get(STUDIES, study.id).total_access_count == 6
+
+def test_preview_increments_counts(client):
+    user = make_user()
+    study = make_study(user)
+    file = make_file(study, user)
+    write_file(file)
+
+    assert client.get(f'/file/{file.id}/preview').status_code == 200
+    assert client.get(f'/file/{file.id}/preview').status_code == 200
+    db.session.expire_all()
+    assert db.session.get(FILES, file.id).preview_count == 1
+    assert db.session.get(STUDIES, study.id).total_preview_count == 1
+
+def test_sort_by_counts():
+    user = make_user()
+    few = make_study(user, name='少ない', total_access_count=1, total_preview_count=9)
+    many = make_study(user, name='多い', total_access_count=9, total_preview_count=1)
+
+    # 検索フォームの値と、以前のメソッド名のどちらでも並び替えられる
+    for sort_column in ['access_count', 'get_total_access_count']:
+        result = SearchEngine(sort_column=sort_column, ascending=False)
+        assert [study.id for study in result.items] == [many.id, few.id]
+    for sort_column in ['preview_count', 'get_total_preview_count']:
+        result = SearchEngine(sort_column=sort_column, ascending=False)
+        assert [study.id for study in result.items] == [few.id, many.id]
@@ -0,0 +1,93 @@
+import hashlib
+import os
+from werkzeug.http import http_date
+from dbapp import db
+from dbapp.models.tables import FILE_PENDING, STUDYGRAVES
+from dbapp.file_operation.storage import get_blob_store
+from conftest import make_user, make_study, make_file, login
+
+CONTENT = b'%PDF-1.4 poster body'
+HASHSUM = hashlib.sha256(CONTENT).hexdigest()
+
+def stored_file(user=None, **kwargs):
+    user = user or make_user()
+    file = make_file(make_study(user), user, name='poster.pdf', hashsum=HASHSUM, **kwargs)
+    path = get_blob_store().path(HASHSUM)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(CONTENT)
+    return file
+
+def test_ready_file_is_public_and_tagged(client):
+    file = stored_file()
+    response = client.get(f'/file/{file.id}/preview')
+    assert response.status_code == 200
+    assert response.data == CONTENT
+    assert response.get_etag() == (HASHSUM, False)
+    assert response.last_modified is not None
+    assert response.cache_control.public
+    assert response.cache_control.max_age == 604800
+
+def test_if_none_match_returns_304(client):
+    file = stored_file()
+    response = client.get(f'/file/{file.id}/preview', headers={'If-None-Match': f'"{HASHSUM}"'})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.get_etag() == (HASHSUM, False)
+
+    response = client.get(f'/file/{file.id}/preview', headers={'If-None-Match': '"other"'})
+    assert response.status_code == 200
+
+def test_if_modified_since_returns_304(client):
+    file = stored_file()
+    last_modified = client.get(f'/file/{file.id}/preview').headers['Last-Modified']
+    response = client.get(f'/file/{file.id}/preview', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    response = client.get(f'/file/{file.id}/preview', headers={'If-Modified-Since': http_date(0)})
+    assert response.status_code == 200
+
+def test_pending_file_is_private_for_admin(client):
+    admin = make_user('manager', admin=True)
+    file = stored_file(admin, status=FILE_PENDING)
+    login(client, admin)
+    response = client.get(f'/file/{file.id}/preview')
+    assert response.status_code == 200
+    assert response.cache_control.private
+    assert response.cache_control.no_cache
+    assert not response.cache_control.public
+
+def test_file_of_hidden_study(app, client):
+    admin = make_user('manager', admin=True)
+    file = stored_file(admin)
+    db.session.add(STUDYGRAVES(study_id=file.study_id, reason='非公開'))
+    db.session.commit()
+
+    assert client.get(f'/file/{file.id}/preview').status_code == 404
+    # 管理者には見えるが、共有キャッシュには保存させない
+    login(client, admin)
+    response = client.get(f'/file/{file.id}/preview')
+    assert response.status_code == 200
+    assert response.cache_control.private
+    assert not response.cache_control.public
+
+def test_range_returns_partial_content(client):
+    file = stored_file()
+    response = client.get(f'/file/{file.id}/preview', headers={'Range': 'bytes=0-7'})
+    assert response.status_code == 206
+    assert response.data == CONTENT[:8]
+    # If-Rangeが一致しなければ全体を返す
+    response = client.get(f'/file/{file.id}/preview', headers={'Range': 'bytes=0-7', 'If-Range': '"other"'})
+    assert response.status_code == 200
+    assert response.data == CONTENT
+
+def test_accel_leaves_body_to_frontend(client, config):
+    config['Delivery'] = {'mode': 'x-accel', 'accel_root': get_blob_store().directory, 'accel_prefix': '/protected/'}
+    file = stored_file()
+    response = client.get(f'/file/{file.id}/preview')
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == '/protected/' + '/'.join([HASHSUM[:2], HASHSUM[2:4], HASHSUM])
+    assert 'X-Sendfile' not in response.headers
+    assert 'Content-Length' not in response.headers
+    assert response.get_etag() == (HASHSUM, False)
@@ -0,0 +1,63 @@
+import json
+import os
+from dbapp.file_operation import extract_cache
+from dbapp.file_operation.extract_cache import ExtractCache, cached_PDF_extractor, get_extract_cache
+
+RESULT = {'content': '河川の水質', 'pages': ['河川の水質'], 'pubyear': 2023}
+
+def digest(n):
+    return f'{n:064x}'
+
+def age(cache, key, seconds):
+    path = cache.path(key)
+    os.utime(path, (os.path.getmtime(path) - seconds,) * 2)
+
+def test_evicts_least_recently_used(tmp_path):
+    # 2件分だけ保存できる大きさにする
+    size = len(json.dumps({'version': extract_cache.EXTRACT_VERSION, 'result': RESULT}, ensure_ascii=False).encode())
+    cache = ExtractCache(str(tmp_path), max_bytes=size * 2)
+    cache.put(digest(1), RESULT)
+    cache.put(digest(2), RESULT)
+    age(cache, digest(1), 300)
+    age(cache, digest(2), 200)
+
+    # 参照した結果は最後に使われたものとして残る
+    assert cache.get(digest(1)) == RESULT
+    cache.put(digest(3), RESULT)
+    assert os.path.exists(cache.path(digest(1)))
+    assert not os.path.exists(cache.path(digest(2)))
+    assert os.path.exists(cache.path(digest(3)))
+
+def test_hit_touches_mtime(tmp_path):
+    cache = ExtractCache(str(tmp_path), max_bytes=1024 * 1024)
+    cache.put(digest(1), RESULT)
+    age(cache, digest(1), 3600)
+    before = os.path.getmtime(cache.path(digest(1)))
+    assert cache.get(digest(1)) == RESULT
+    assert os.path.getmtime(cache.path(digest(1))) > before
+
+def test_other_version_is_ignored(tmp_path, monkeypatch):
+    cache = ExtractCache(str(tmp_path), max_bytes=1024 * 1024)
+    cache.put(digest(1), RESULT)
+    monkeypatch.setattr(extract_cache, 'EXTRACT_VERSION', extract_cache.EXTRACT_VERSION + 1)
+    assert cache.get(digest(1)) is None
+    # 壊れたファイルも使わない
+    with open(cache.path(digest(1)), 'w') as f:
+        f.write('{')
+    assert cache.get(digest(1)) is None
+
+def test_cached_extractor_analyses_once(config, monkeypatch):
+    calls = []
+    def PDF_extractor(source, **kwargs):
+        calls.append(source)
+        return RESULT
+    monkeypatch.setattr(extract_cache, 'PDF_extractor', PDF_extractor)
+
+    assert cached_PDF_extractor('a.pdf', digest(1)) == RESULT
+    assert cached_PDF_extractor('b.pdf', digest(1)) == RESULT
+    assert calls == ['a.pdf']
+
+    config['ExtractCache'] = {'enabled': False}
+    assert get_extract_cache() is None
+    assert cached_PDF_extractor('c.pdf', digest(1)) == RESULT
+    assert calls == ['a.pdf', 'c.pdf']
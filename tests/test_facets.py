@@ -0,0 +1,44 @@
+import dbapp.tools
+from dbapp.tools import SearchEngine
+from conftest import make_user, make_study, make_file
+
+def test_facets_are_cached_across_pages(config, monkeypatch):
+    config['SearchCache'] = {'enabled': True}
+    user = make_user()
+    for i in range(3):
+        make_file(make_study(user, name=f'研究{i}'), user, pubyear=2020 + i)
+
+    calls = []
+    count_facets = dbapp.tools.CountFacets
+    def counting(*args):
+        calls.append(args)
+        return count_facets(*args)
+    monkeypatch.setattr(dbapp.tools, 'CountFacets', counting)
+
+    first = SearchEngine(per_page=1, facets=True)
+    second = SearchEngine(per_page=1, page=2, facets=True)
+    resorted = SearchEngine(per_page=1, page=3, sort_column='create_at', facets=True)
+    assert len(calls) == 1
+    assert first.facets == second.facets == resorted.facets
+    assert sorted(item['value'] for item in first.facets['pubyear']) == ['2020', '2021', '2022']
+
+    # 絞り込み条件が変われば集計し直す
+    filtered = SearchEngine(per_page=1, pubyear=2021, facets=True)
+    assert len(calls) == 2
+    assert [item['value'] for item in filtered.facets['pubyear']] == ['2021']
+
+def test_remove_links(client):
+    user = make_user()
+    make_file(make_study(user, name='研究'), user, pubyear=2021, type=3)
+
+    html = client.get('/search?query=&pubyear=2021&filetype=3').get_data(as_text=True)
+    assert html.count('絞り込みを解除') == 2
+    assert 'href="/search?query=&amp;filetype=3&amp;page=1"' in html
+    assert 'href="/search?query=&amp;pubyear=2021&amp;page=1"' in html
+
+    # 一致する研究がなくても解除できる
+    html = client.get('/search?query=&pubyear=1999').get_data(as_text=True)
+    assert 'href="/search?query=&amp;page=1"' in html
+
+    html = client.get('/search?query=').get_data(as_text=True)
+    assert '絞り込みを解除' not in html
@@ -0,0 +1,96 @@
+import pytest
+from dbapp import db
+from dbapp.search import pipeline
+from dbapp.search.pipeline import QUEUE_KEY, PROCESSING_KEY, process_queue, recover_queue, index_lag
+from dbapp.search.index import NgramIndex
+from dbapp.tools import SearchEngine
+from conftest import make_user, make_study, make_file, login
+
+def queued(redis_client, key=QUEUE_KEY):
+    return sorted(study_id.decode() for study_id in redis_client.zrange(key, 0, -1))
+
+def test_commit_enqueues_changed_studies(redis_client):
+    user = make_user()
+    study = make_study(user)
+    assert queued(redis_client) == [study.id]
+
+    redis_client.delete(QUEUE_KEY)
+    make_file(study, user, content='河川の水質')
+    assert queued(redis_client) == [study.id]
+
+def test_rollback_and_counters_do_not_enqueue(redis_client):
+    user = make_user()
+    study = make_study(user)
+    redis_client.delete(QUEUE_KEY)
+
+    study.name = '水質の研究'
+    db.session.flush()
+    db.session.rollback()
+    # 閲覧数だけの変更は索引に影響しない
+    study.total_access_count = 3
+    db.session.commit()
+    assert queued(redis_client) == []
+
+def test_process_queue_updates_index(redis_client):
+    user = make_user()
+    study = make_study(user, name='水質の研究')
+    assert process_queue() == 1
+    assert queued(redis_client) == [] and queued(redis_client, PROCESSING_KEY) == []
+    assert db.session.execute(NgramIndex().candidates(['水質'])[0]).scalars().all() == [study.id]
+
+def test_failed_batch_is_requeued(redis_client, monkeypatch):
+    user = make_user()
+    first = make_study(user, name='研究1')
+    second = make_study(user, name='研究2')
+
+    calls = []
+    def update_study(self, study_id):
+        calls.append(study_id)
+        if len(calls) == 2:
+            raise RuntimeError('failed')
+    monkeypatch.setattr(NgramIndex, 'update_study', update_study)
+    with pytest.raises(RuntimeError):
+        process_queue()
+    # 処理できなかった研究だけがキューに戻る
+    assert queued(redis_client) == [calls[1]]
+    assert queued(redis_client, PROCESSING_KEY) == []
+
+def test_recover_moves_abandoned_items_back(redis_client):
+    user = make_user()
+    study = make_study(user)
+    # 取り出した後にプロセスが終了した状態を再現する
+    items = pipeline.claim(redis_client, 10)
+    assert [study_id.decode() for study_id, enqueued_at in items] == [study.id]
+    assert queued(redis_client) == []
+    assert index_lag()['pending'] == 1
+
+    recover_queue()
+    assert queued(redis_client) == [study.id]
+    assert queued(redis_client, PROCESSING_KEY) == []
+
+def test_inline_drains_only_after_mutating_requests(client, config, redis_client):
+    user = make_user()
+    study_id = make_study(user, name='水質の研究').id
+    assert queued(redis_client) == [study_id]
+
+    # ワーカーを常駐させる場合は応答後に処理しない
+    config['IndexQueue'] = dict(config.get('IndexQueue') or {}, inline=False)
+    login(client, user).close()
+    assert queued(redis_client) == [study_id]
+
+    # 既定では変更を伴うリクエストの応答を送り終えた(閉じた)後に処理する
+    config['IndexQueue'] = dict(config['IndexQueue'], inline=True)
+    client.get('/').close()
+    assert queued(redis_client) == [study_id]
+    response = login(client, user)
+    assert queued(redis_client) == [study_id]
+    response.close()
+    assert queued(redis_client) == []
+
+def test_default_config_indexes_new_studies(client, config):
+    config['Search'] = dict(config['Search'], engine='ngram')
+    user = make_user()
+    make_study(user, name='河川の水質調査')
+    # ワーカーを動かさなくても、次の変更を伴うリクエストの後には検索できる
+    login(client, user).close()
+    assert SearchEngine(search_terms='水質').total == 1
@@ -0,0 +1,69 @@
+import io
+import os
+import pytest
+from PIL import Image
+from dbapp import db
+from dbapp.models.tables import BLOBS, FILES, FILE_READY
+from dbapp.file_operation import ingest
+from dbapp.file_operation.ingest import accept_upload, process_job, get_job, JOB_SUCCESS
+from dbapp.file_operation.storage import get_blob_store, save_stream
+from conftest import make_user, make_study
+
+def png():
+    buffer = io.BytesIO()
+    Image.new('RGB', (4, 4), 'white').save(buffer, 'PNG')
+    buffer.seek(0)
+    return buffer
+
+def upload(study, user, stream):
+    temppath, filehash = save_stream(stream)
+    return accept_upload(temppath, filehash, 'image.png', 'image.png', study.id, user, '概要', 1, 2023)
+
+def test_duplicate_is_rejected_before_storing(monkeypatch):
+    user = make_user()
+    study = make_study(user)
+    upload(study, user, png())
+
+    stored = []
+    monkeypatch.setattr(ingest, 'store_upload', lambda *args: stored.append(args))
+    with pytest.raises(Exception, match='同じファイル'):
+        upload(study, user, png())
+    # 保存や解析の前に取り消し、一時ファイルも残さない
+    assert stored == []
+    assert os.listdir(get_blob_store().temp_dir()) == []
+
+def test_concurrent_duplicate_is_rejected_by_constraint(monkeypatch):
+    user = make_user()
+    study = make_study(user)
+    store_upload = ingest.store_upload
+
+    # 重複の確認の後に、別のリクエストが同じファイルを登録した状態を再現する
+    def store_after_other_request(temppath, filehash):
+        with db.engine.begin() as connection:
+            connection.execute(FILES.__table__.insert(), {'id': 'other', 'study_id': study.id, 'hashsum': filehash, 'create_at': study.create_at, 'status': FILE_READY})
+            connection.execute(BLOBS.__table__.insert(), {'hashsum': filehash, 'size': os.path.getsize(temppath), 'refcount': 1, 'create_at': study.create_at})
+        store_upload(temppath, filehash)
+    monkeypatch.setattr(ingest, 'store_upload', store_after_other_request)
+
+    with pytest.raises(Exception, match='同じファイル'):
+        upload(study, user, png())
+    db.session.expire_all()
+    assert [file.id for file in FILES.query.all()] == ['other']
+    assert BLOBS.query.one().refcount == 1
+    assert os.listdir(get_blob_store().temp_dir()) == []
+
+def test_worker_reuses_stored_hash(monkeypatch):
+    user = make_user()
+    study = make_study(user)
+    file_id, job_id = upload(study, user, png())
+
+    # アップロード時に計算したハッシュ値を使い、ファイルを読み直さない
+    def sha256_hash(path):
+        raise AssertionError('hashed again')
+    monkeypatch.setattr(ingest, 'sha256_hash', sha256_hash)
+    process_job(job_id)
+
+    assert get_job(job_id)['status'] == JOB_SUCCESS
+    db.session.expire_all()
+    file = db.session.get(FILES, file_id)
+    assert (file.status, file.type) == (FILE_READY, 6)
@@ -0,0 +1,27 @@
+from dbapp.file_operation.ingest import enqueue_ingest, get_job
+from conftest import make_user, make_study, make_file, login
+
+def test_job_records_uploader():
+    user = make_user()
+    file = make_file(make_study(user), user)
+    job_id = enqueue_ingest(file.id, user.id)
+    assert get_job(job_id)['user_id'] == user.id
+
+def test_only_owner_and_admin_can_read_job(app):
+    owner = make_user('owner')
+    other = make_user('other')
+    admin = make_user('manager', admin=True)
+    study = make_study(owner)
+    file = make_file(study, owner)
+    job_id = enqueue_ingest(file.id, owner.id)
+
+    for user, status in [(owner, 200), (other, 404), (admin, 200)]:
+        client = app.test_client()
+        login(client, user)
+        assert client.get(f'/api/job/{job_id}').status_code == status
+        assert client.get(f'/edit_study/{study.id}/upload/{job_id}').status_code == (403 if user is other else status)
+
+def test_unknown_job(client):
+    user = make_user()
+    login(client, user)
+    assert client.get('/api/job/missing').status_code == 404
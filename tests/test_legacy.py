@@ -0,0 +1,91 @@
+import io
+import os
+import pytest
+from PIL import Image
+from dbapp import db
+from dbapp.models.tables import BLOBS, FILES, STUDIES
+from dbapp.file_operation import legacy
+from dbapp.file_operation.legacy import import_tree
+from dbapp.file_operation.storage import get_blob_store, add_reference
+from dbapp.tools import sha256_hash
+from conftest import make_user, make_study, make_file
+
+def write_png(path, color):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new('RGB', (4, 4), color).save(path, 'PNG')
+
+# 研究Aに2つ(うち1つは研究Bと同じ内容)、研究Bに2つのファイルを置く
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'legacy'
+    write_png(str(root / '研究A' / 'a.png'), 'red')
+    write_png(str(root / '研究A' / '図' / 'shared.png'), 'green')
+    write_png(str(root / '研究B' / 'b.png'), 'blue')
+    write_png(str(root / '研究B' / 'shared.png'), 'green')
+    return str(root)
+
+def run(tree, tmp_path, **kwargs):
+    kwargs.setdefault('batch_size', 1)
+    return import_tree(tree, 'student', workers=1, state_path=str(tmp_path / 'state.json'), **kwargs)
+
+def stored_blobs():
+    store = get_blob_store()
+    return sorted(
+        name
+        for directory, dirnames, filenames in os.walk(store.directory)
+        if os.path.abspath(directory) != os.path.abspath(store.temp_dir())
+        for name in filenames
+    )
+
+def assert_consistent(expected_files):
+    db.session.expire_all()
+    files = FILES.query.all()
+    hashes = [file.hashsum for file in files]
+    assert len(files) == expected_files
+    assert len(set(hashes)) == len(hashes)
+    assert {blob.hashsum: blob.refcount for blob in BLOBS.query.all()} == {hashsum: 1 for hashsum in hashes}
+    assert stored_blobs() == sorted(hashes)
+
+def test_import_twice_adds_nothing(tree, tmp_path):
+    make_user()
+    assert run(tree, tmp_path) == (3, 0)
+    assert sorted(study.name for study in STUDIES.query.all()) == ['研究A', '研究B']
+    assert_consistent(3)
+
+    assert run(tree, tmp_path) == (0, 0)
+    assert_consistent(3)
+    # 進み具合のファイルを消しても登録済みのハッシュ値で重複を除く
+    os.remove(str(tmp_path / 'state.json'))
+    assert run(tree, tmp_path) == (0, 0)
+    assert_consistent(3)
+
+def test_existing_files_are_skipped(tree, tmp_path):
+    user = make_user()
+    hashsum = sha256_hash(os.path.join(tree, '研究A', 'a.png'))
+    make_file(make_study(user, name='登録済み'), user, hashsum=hashsum)
+    add_reference(hashsum, 1)
+    db.session.commit()
+
+    assert run(tree, tmp_path) == (2, 0)
+    db.session.expire_all()
+    assert FILES.query.filter(FILES.hashsum == hashsum).count() == 1
+    assert db.session.get(BLOBS, hashsum).refcount == 1
+
+def test_resume_after_interrupted_batch(tree, tmp_path, monkeypatch):
+    make_user()
+    calls = []
+    def interrupted(hashsum, size):
+        calls.append(hashsum)
+        # 2つ目のバッチの途中で中断した状態を再現する
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+        add_reference(hashsum, size)
+    monkeypatch.setattr(legacy, 'add_reference', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        run(tree, tmp_path, batch_size=2)
+    # 完了したバッチだけが登録され、中断したバッチの実体は残らない
+    assert_consistent(2)
+
+    monkeypatch.setattr(legacy, 'add_reference', add_reference)
+    assert run(tree, tmp_path, batch_size=2) == (1, 0)
+    assert_consistent(3)
@@ -0,0 +1,77 @@
+import re
+import pytest
+from sqlalchemy import select
+from dbapp import db
+from dbapp.models.tables import STUDIES
+from dbapp.search import native
+from dbapp.search.native import drop_sqlite_fts
+from dbapp.tools import SearchEngine
+from conftest import make_user, make_study, make_file
+
+@pytest.fixture(autouse=True)
+def native_engine(config):
+    config['Search'] = dict(config['Search'], engine='native')
+    # drop_allでは仮想テーブルが削除されないため、テストごとに作り直す
+    drop_sqlite_fts(db.session)
+    db.session.commit()
+    native.fts_ready = False
+    yield
+    db.session.remove()
+    drop_sqlite_fts(db.session)
+    db.session.commit()
+    native.fts_ready = False
+
+def search(terms):
+    return [study.name for study in SearchEngine(search_terms=terms, sort_column='relevance').items]
+
+def test_created_on_first_search():
+    user = make_user()
+    make_study(user, name='河川の水質調査')
+    # db.create_all()で作ったデータベースでも最初の検索で作成して登録する
+    assert search('水質調査') == ['河川の水質調査']
+
+def test_triggers_follow_changes():
+    user = make_user()
+    search('水質調査')
+    study = make_study(user, name='研究', raw_markdown='河川の水質調査')
+    assert search('水質調査') == ['研究']
+
+    file = make_file(study, user, content='土壌の微生物')
+    assert search('微生物') == ['研究']
+    file.content = '大気の観測'
+    db.session.commit()
+    assert search('微生物') == []
+    assert search('大気の観測') == ['研究']
+
+def test_vacuum_does_not_mix_up_rows():
+    user = make_user()
+    search('水質調査')
+    first = make_study(user, name='最初の研究')
+    make_study(user, name='水質調査の研究')
+    last_id = make_study(user, name='土壌調査の研究').id
+    db.session.delete(first)
+    db.session.commit()
+
+    # VACUUMでstudiesのrowidが振り直されても研究IDで同期される
+    db.session.remove()
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql('VACUUM')
+
+    last = db.session.get(STUDIES, last_id)
+    last.name = '大気観測の研究'
+    db.session.commit()
+    assert search('水質調査') == ['水質調査の研究']
+    assert search('大気観測') == ['大気観測の研究']
+    assert search('土壌調査') == []
+
+# MySQLのMATCHは列の組み合わせが一致するFULLTEXTインデックスがないと失敗する
+def test_mysql_matches_use_indexed_columns():
+    from sqlalchemy.dialects import mysql
+    native.fts_ready = True
+    scores = native.MySQLFulltextIndex().scores(['水質'])
+    sql = str(select(scores).compile(dialect=mysql.dialect()))
+    indexed = {columns for table, columns in list(native.MYSQL_FULLTEXT_INDEXES.values()) + list(native.MYSQL_FIELD_INDEXES.values())}
+    matched = set(re.findall(r'MATCH \(([^)]*)\)', sql))
+    assert matched
+    for columns in matched:
+        assert ', '.join(column.split('.')[-1] for column in columns.split(', ')) in indexed
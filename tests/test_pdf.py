@@ -0,0 +1,58 @@
+from dbapp.file_operation import pdf
+from dbapp.file_operation.pdf import PDF_extractor
+
+# 見出し(18pt)と本文(10pt)のページが続くPDFを作る
+def write_pdf(path, pages=20, lines=12):
+    objects = ['<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>', None]
+    kids = []
+    for page in range(pages):
+        parts = [f'BT /F1 18 Tf 50 780 Td (Heading {page}) Tj ET']
+        # 段落がページをまたぐように、一部のページは見出しを付けずに本文から始める
+        if page % 3 == 1:
+            parts = []
+        for line in range(lines):
+            parts.append(f'BT /F1 10 Tf 50 {750 - line * 30} Td (Body {page}-{line} water quality) Tj ET')
+        stream = '\n'.join(parts)
+        objects.append(f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream')
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] /Contents {len(objects)} 0 R /Resources << /Font << /F1 1 0 R >> >> >>')
+        kids.append(len(objects))
+    objects[1] = f'<< /Type /Pages /Kids [{" ".join(f"{kid} 0 R" for kid in kids)}] /Count {pages} >>'
+    objects.append('<< /Type /Catalog /Pages 2 0 R >>')
+    objects.append("<< /CreationDate (D:20230615120000+09'00') /Producer (test) >>")
+
+    out = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f'{number} 0 obj\n{body}\nendobj\n'.encode('latin1')
+    xref = len(out)
+    out += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    out += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode()
+    out += f'trailer\n<< /Size {len(objects) + 1} /Root {len(objects) - 1} 0 R /Info {len(objects)} 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+    with open(path, 'wb') as f:
+        f.write(out)
+
+def test_parallel_extraction_matches_serial(tmp_path, monkeypatch):
+    path = str(tmp_path / 'report.pdf')
+    write_pdf(path)
+
+    serial = PDF_extractor(path, workers=1)
+    assert serial is not None
+    assert len(serial['pages']) == 20
+    assert serial['pubyear'] == 2023
+
+    calls = []
+    parallel_page_lines = pdf.parallel_page_lines
+    def spy(*args):
+        calls.append(args)
+        return parallel_page_lines(*args)
+    monkeypatch.setattr(pdf, 'parallel_page_lines', spy)
+
+    # ページの区切りが分割の境界と重ならない並列数でも同じ結果になる
+    for workers in [2, 3]:
+        assert PDF_extractor(path, workers=workers, min_pages=8) == serial
+    assert len(calls) == 2
+
+    # ページ数が少なければ並列にしない
+    assert PDF_extractor(path, workers=3, min_pages=21) == serial
+    assert len(calls) == 2
@@ -0,0 +1,59 @@
+import pytest
+from dbapp import db
+from dbapp.models.tables import RELATEDSTUDIES
+from dbapp.search.related import build_related, update_related, mark_related_dirty
+from conftest import make_user, make_study
+
+def stored():
+    return {
+        (relation.study_id, relation.rank): (relation.related_id, pytest.approx(relation.score))
+        for relation in RELATEDSTUDIES.query.all()
+    }
+
+def related_ids(study_id):
+    return [relation.related_id for relation in RELATEDSTUDIES.query.filter(RELATEDSTUDIES.study_id == study_id).order_by(RELATEDSTUDIES.rank)]
+
+def test_evicted_neighbour_is_refilled(config):
+    config['Related'] = {'top_k': 1}
+    user = make_user()
+    study = make_study(user, name='河川の水質調査', raw_markdown='河川の水質を調べた')
+    near = make_study(user, name='河川の水質調査の結果', raw_markdown='河川の水質を調べた')
+    other = make_study(user, name='湖の水質調査', raw_markdown='湖の水質を調べた')
+    make_study(user, name='宇宙の観測', raw_markdown='星を観測した')
+    build_related()
+    assert related_ids(study.id) == [near.id]
+
+    # 近傍だった研究が無関係になっても、残りの研究から選び直される
+    near.name = '土壌の微生物'
+    near.raw_markdown = '微生物を数えた'
+    db.session.commit()
+    mark_related_dirty(near.id)
+    update_related()
+    assert related_ids(study.id) == [other.id]
+
+def test_incremental_matches_full_rebuild(config):
+    config['Related'] = {'top_k': 2}
+    user = make_user()
+    studies = [
+        make_study(user, name=name, raw_markdown=markdown)
+        for name, markdown in [
+            ('河川の水質調査', '河川の水質と水温'),
+            ('湖の水質調査', '湖の水質と透明度'),
+            ('河川の生物', '河川の魚と水生昆虫'),
+            ('土壌の微生物', '畑の土壌の微生物'),
+        ]
+    ]
+    build_related()
+
+    # 追加と非公開化でIDFが変わっても全件の再計算と同じ結果になる
+    added = make_study(user, name='河川の水温', raw_markdown='河川の水温の季節変化')
+    studies[1].grave_data = True
+    db.session.commit()
+    mark_related_dirty(added.id)
+    mark_related_dirty(studies[1].id)
+    update_related()
+    incremental = stored()
+
+    build_related()
+    assert incremental == stored()
+    assert not RELATEDSTUDIES.query.filter(RELATEDSTUDIES.study_id == studies[1].id).count()
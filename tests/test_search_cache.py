@@ -0,0 +1,51 @@
+import dbapp.tools
+from dbapp.tools import SearchEngine
+from dbapp.search.cache import search_cache_key, current_generation, get_cached_result, store_result, invalidate_search_cache
+from conftest import make_user, make_study, make_file
+
+def test_store_and_get(config):
+    config['SearchCache'] = {'enabled': True}
+    generation = current_generation()
+    store_result('digest', {'total': 1}, generation)
+    assert get_cached_result('digest', current_generation()) == {'total': 1}
+
+def test_invalidate_hides_stored_results(config):
+    config['SearchCache'] = {'enabled': True}
+    store_result('digest', {'total': 1}, current_generation())
+    invalidate_search_cache()
+    assert get_cached_result('digest', current_generation()) is None
+
+# 検索中に無効化された場合、検索前の世代で保存されて次の検索では使われない
+def test_result_of_search_racing_invalidation_is_not_served(config):
+    config['SearchCache'] = {'enabled': True}
+    generation = current_generation()
+    invalidate_search_cache()
+    store_result('digest', {'total': 1}, generation)
+    assert get_cached_result('digest', current_generation()) is None
+
+def test_search_engine_racing_invalidation(config, monkeypatch):
+    config['SearchCache'] = {'enabled': True}
+    config['Search'] = dict(config['Search'], engine='like')
+    user = make_user()
+    make_file(make_study(user, name='水質の調査'), user, content='河川の水質')
+
+    fetch = dbapp.tools.FetchMatchedFiles
+    def fetch_then_invalidate(*args, **kwargs):
+        # 検索の途中で研究が変更された状態を再現する
+        invalidate_search_cache()
+        return fetch(*args, **kwargs)
+    monkeypatch.setattr(dbapp.tools, 'FetchMatchedFiles', fetch_then_invalidate)
+
+    SearchEngine(search_terms='水質')
+    key = search_cache_key('水質', ascending=True, update_at_range=None, create_at_range=None, field=0, sort_column='update_at', admin=False, page=1, per_page=10, pubyear=None, filetype=None, tag=None)
+    assert get_cached_result(key, current_generation()) is None
+
+    monkeypatch.setattr(dbapp.tools, 'FetchMatchedFiles', fetch)
+    SearchEngine(search_terms='水質')
+    assert get_cached_result(key, current_generation())['total'] == 1
+
+def test_disabled_cache(config):
+    config['SearchCache'] = {'enabled': False}
+    assert current_generation() is None
+    store_result('digest', {'total': 1}, None)
+    assert get_cached_result('digest', None) is None
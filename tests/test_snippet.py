@@ -0,0 +1,25 @@
+from dbapp.tools import FetchMatchedFiles, ChooseSnippet
+from conftest import make_user, make_study, make_file
+
+def test_window_with_most_terms():
+    user = make_user()
+    study = make_study(user)
+    content = '水質' + 'あ' * 200 + '河川の水質と水温を測定した' + 'い' * 200
+    make_file(study, user, content=content)
+
+    file, = FetchMatchedFiles([study], ['水質', '河川', '水温'], admin=False)[0].files
+    assert '河川' in file.snippet_text
+    assert '水温' in file.snippet_text
+    assert str(file.snippet).count('<mark>') == 3
+
+def test_first_term_when_counts_tie():
+    assert ChooseSnippet(['水質の調査', None, '河川の調査'], ['水質', '河川']) == '水質の調査'
+    assert ChooseSnippet([None, None], ['水質', '河川']) is None
+
+def test_case_insensitive_terms():
+    user = make_user()
+    study = make_study(user)
+    make_file(study, user, content='x' * 200 + 'The pH of river water')
+
+    file, = FetchMatchedFiles([study], ['PH', 'River'], admin=False)[0].files
+    assert 'pH of river' in file.snippet_text
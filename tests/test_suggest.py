@@ -0,0 +1,72 @@
+from dbapp import db
+from dbapp.models.tables import TAGS, STUDIES
+from dbapp.search.suggest import suggester
+from conftest import make_user, make_study
+
+def names(results):
+    return [(result['kind'], result['name']) for result in results]
+
+def test_search_by_kind():
+    user = make_user()
+    db.session.add(TAGS(name='水質'))
+    db.session.commit()
+    make_study(user, name='水質の研究')
+    make_study(user, name='水温の研究')
+    suggester.rebuild()
+
+    assert names(suggester.search('水', kind='tag')) == [('tag', '水質')]
+    assert names(suggester.search('水', kind='study')) == [('study', '水温の研究'), ('study', '水質の研究')]
+    # 種類を指定しない場合は名前順に合わせる
+    assert names(suggester.search('水')) == [('study', '水温の研究'), ('tag', '水質'), ('study', '水質の研究')]
+    assert names(suggester.search('水', limit=2)) == [('study', '水温の研究'), ('tag', '水質')]
+    assert suggester.search('水', kind='unknown') == []
+
+def test_commit_updates_suggestions():
+    user = make_user()
+    study = make_study(user, name='水質の研究')
+    suggester.rebuild()
+
+    study.name = '土壌の研究'
+    db.session.commit()
+    assert suggester.search('水') == []
+    assert names(suggester.search('土')) == [('study', '土壌の研究')]
+
+    study.grave_data = True
+    db.session.commit()
+    assert suggester.search('土') == []
+
+def test_counter_changes_do_not_touch_arrays(monkeypatch):
+    user = make_user()
+    study = make_study(user, name='水質の研究')
+    suggester.rebuild()
+
+    calls = []
+    monkeypatch.setattr(suggester, 'put', lambda *args: calls.append(args))
+    study.total_access_count = 10
+    db.session.commit()
+    assert calls == []
+
+    study.name = '水質の調査'
+    db.session.commit()
+    assert calls == [('study', study.id, '水質の調査')]
+
+def test_rollback_discards_changes():
+    user = make_user()
+    study = make_study(user, name='水質の研究')
+    suggester.rebuild()
+
+    study.name = '土壌の研究'
+    db.session.flush()
+    db.session.rollback()
+    assert names(suggester.search('水')) == [('study', '水質の研究')]
+
+def test_api_clamps_limit(client):
+    user = make_user()
+    make_study(user, name='水質の研究')
+    make_study(user, name='水温の研究')
+    suggester.rebuild()
+
+    for limit, count in [(-1, 1), (0, 1), (100, 2)]:
+        response = client.get('/api/suggest', query_string={'query': '水', 'limit': limit})
+        assert response.status_code == 200
+        assert len(response.json['suggestions']) == count